@@ -0,0 +1,264 @@
+# ---------------------------------------------------------
+#    bench.py
+#
+#    Timings and peak memory of the panel workflow, stage by stage
+#
+#        python bench.py                              # rice and 1e4..1e6 rows
+#        python bench.py --sizes rice,1e5 --out new.json --baseline old.json
+#
+#    The stages follow panel_clab.py / panel_estimators.py /
+#    boot_cluster.py:
+#       load         read the raw columns (prod, area, labor, fert)
+#       derive       logs, year dummies, entity means (derive.py), panel index
+#       design       patsy design matrices of the CD model
+#       moments      per-entity moments (PanelMoments)
+#       POLS FD FE RE CRE
+#       cluster_cov  OLS residuals and the entity clustered covariance
+#       wald         CRS and year effect tests for FE and CRE
+#       bootstrap    pairs cluster bootstrap (BOOT_REPS replicates)
+#
+#    The sizes are 'rice' (rice3.csv) and numbers of rows of a
+#    rice-shaped synthetic panel (panel_sim.py, 8 years), which
+#    is made once and kept under bench_data/. Each stage is timed
+#    repeat times (the best is kept) and then run once more under
+#    tracemalloc for its peak allocation, so tracing does not slow
+#    the timings. Stages left out by --stages run once, untimed,
+#    for the results the later stages use.
+#
+#    The results go to a JSON file. With --baseline the run is
+#    compared to an earlier file, and the exit status is 1 when a
+#    stage is more than --threshold times slower (stages faster
+#    than --min-seconds in the baseline are not compared, they are
+#    mostly noise).
+#
+
+#
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import patsy
+
+from panel_sim import simulate_panel, load_panel
+from panel_transform import PanelIndex, first_difference
+from derive import Derive
+from panel_moments import PanelMoments
+from cluster_cov import cluster_cov
+from cluster_boot import cluster_bootstrap
+from wald_batch import wald_batch
+
+
+SIZES = ['rice', '1e4', '1e5', '1e6']
+THRESHOLD = 1.25
+MIN_SECONDS = 0.01
+BOOT_REPS = 99
+FORMULA = 'lnQ ~ 1 + lnD + lnL + lnF + year'
+MEANS = ['lnD', 'lnL', 'lnF']
+RAW = ['farmid', 'year', 'prod', 'area', 'labor', 'fert']
+DERIVE = Derive('''
+    lnQ   = log(prod)
+    lnD   = log(area)
+    lnL   = log(labor)
+    lnF   = log(fert)
+    lnD_b = entity_mean(lnD)
+    lnL_b = entity_mean(lnL)
+    lnF_b = entity_mean(lnF)
+    yd    = dummies(year)
+''', entity='farmid', time='year')
+
+
+#
+# raw rice-like columns of a synthetic panel, in levels so the
+# derive stage takes the same logs as for the rice data
+def synthetic(rows, T=8, folder='bench_data'):
+    path = os.path.join(folder, 'rice_{}'.format(rows))
+    if not os.path.exists(os.path.join(path, 'prod.npy')):
+        sim = os.path.join(path, 'sim')
+        simulate_panel(sim, shape='rice', N=max(rows // T, 2), T=T,
+                       beta=[0.2, 0.3, 0.2], seed=301)
+        data, _ = load_panel(sim, frame=False)
+        for new, old in [('prod', 'lnQ'), ('area', 'lnD'),
+                         ('labor', 'lnL'), ('fert', 'lnF')]:
+            np.save(os.path.join(path, new + '.npy'), np.exp(data[old]))
+        for c in ('farmid', 'year'):
+            np.save(os.path.join(path, c + '.npy'), data[c])
+    return path
+
+
+def source(size):
+    if size == 'rice':
+        return './rice3.csv'
+    return synthetic(int(float(size)))
+
+
+#
+# stages; each takes the results so far and returns new ones
+def load(ctx):
+    src = ctx['source']
+    if src.endswith('.csv'):
+        return {'raw': pd.read_csv(src)[RAW]}
+    return {'raw': pd.DataFrame({c: np.load(os.path.join(src, c + '.npy'))
+                                 for c in RAW})}
+
+
+def derive(ctx):
+    df = DERIVE.apply(ctx['raw'])
+    pidx = PanelIndex.from_data(df, 'farmid', 'year')
+    df.index = pd.MultiIndex.from_arrays([df['farmid'], df['year']], names=['i', 't'])
+    df['year'] = pd.Categorical(df['year'])
+    return {'data': df, 'pidx': pidx}
+
+
+def design(ctx):
+    y, X = patsy.dmatrices(FORMULA, ctx['data'], return_type='dataframe')
+    return {'y': y.iloc[:, 0].to_numpy(), 'X': X}
+
+
+def moments(ctx):
+    return {'pm': PanelMoments.from_formula(FORMULA, ctx['data'])}
+
+
+def pooled(ctx):
+    return {'POLS': ctx['pm'].pooled()}
+
+
+def fdiff(ctx):
+    return {'FD': first_difference(FORMULA, ctx['data'])}
+
+
+def fixed(ctx):
+    return {'FE': ctx['pm'].fixed_effects()}
+
+
+def random(ctx):
+    return {'RE': ctx['pm'].random_effects()}
+
+
+def cre(ctx):
+    return {'CRE': ctx['pm'].correlated_random_effects(MEANS)}
+
+
+def covariance(ctx):
+    X = ctx['X'].to_numpy()
+    b = np.linalg.lstsq(X, ctx['y'], rcond=None)[0]
+    return {'V': cluster_cov(X, ctx['y'] - X @ b, ctx['pidx'])}
+
+
+def wald(ctx):
+    years = [n for n in ctx['FE'].params.index if n.startswith('year[')]
+    hyp = {'CRS': 'lnD + lnL + lnF = 1',
+           'year': ['{} = 0'.format(n) for n in years]}
+    return {'tests': wald_batch({'FE': ctx['FE'], 'CRE': ctx['CRE']}, hyp)}
+
+
+def bootstrap(ctx):
+    return {'boot': cluster_bootstrap('lnQ ~ lnD + lnL + lnF', ctx['data'],
+                                      'farmid', reps=BOOT_REPS, random_state=301)}
+
+
+STAGES = [('load', load), ('derive', derive), ('design', design),
+          ('moments', moments), ('POLS', pooled), ('FD', fdiff), ('FE', fixed),
+          ('RE', random), ('CRE', cre), ('cluster_cov', covariance),
+          ('wald', wald), ('bootstrap', bootstrap)]
+
+
+#
+# best of repeat wall times, then one traced run for the peak
+def measure(func, ctx, repeat=3, memory=True):
+    best = np.inf
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = func(ctx)
+        best = min(best, time.perf_counter() - t0)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        func(ctx)
+        peak = tracemalloc.get_traced_memory()[1] / 2**20
+        tracemalloc.stop()
+    return out, best, peak
+
+
+def run(sizes=SIZES, stages=None, repeat=3, memory=True, verbose=True):
+    rows = []
+    for size in sizes:
+        ctx = {'source': source(size)}
+        for name, func in STAGES:
+            #
+            # stages left out still run once, for the results that
+            # later stages need, but are not timed or traced
+            if stages is not None and name not in stages:
+                ctx.update(func(ctx))
+                continue
+            out, seconds, peak = measure(func, ctx, repeat, memory)
+            ctx.update(out)
+            rows.append({'size': size, 'nobs': len(ctx['raw']), 'stage': name,
+                         'seconds': seconds, 'peak_mb': peak})
+            if verbose:
+                print('{:>6} {:>12} {:10.4f} s {:>10}'.format(
+                    size, name, seconds,
+                    '' if peak is None else '{:.1f} MB'.format(peak)))
+    return rows
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def save(rows, path):
+    meta = {'commit': _commit(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'pandas': pd.__version__, 'machine': platform.machine(),
+            'cpus': os.cpu_count()}
+    with open(path, 'w') as f:
+        json.dump({'meta': meta, 'results': rows}, f, indent=1)
+
+
+#
+# current against baseline timings by (size, stage)
+def compare_runs(baseline, current, threshold=THRESHOLD, min_seconds=MIN_SECONDS):
+    base = pd.DataFrame(baseline['results']).set_index(['size', 'stage'])
+    cur = pd.DataFrame(current['results']).set_index(['size', 'stage'])
+    both = base[['seconds']].join(cur[['seconds']], lsuffix='_base', how='inner')
+    both['ratio'] = both['seconds'] / both['seconds_base']
+    both['slower'] = (both['ratio'] > threshold) & (both['seconds_base'] >= min_seconds)
+    return both
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Lab07 panel benchmarks')
+    parser.add_argument('--sizes', default=','.join(SIZES))
+    parser.add_argument('--stages', default=None)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-memory', action='store_true')
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--min-seconds', type=float, default=MIN_SECONDS)
+    args = parser.parse_args()
+
+    stages = None if args.stages is None else args.stages.split(',')
+    rows = run(args.sizes.split(','), stages, args.repeat, not args.no_memory)
+    save(rows, args.out)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.out) as f:
+            current = json.load(f)
+        cmp = compare_runs(baseline, current, args.threshold, args.min_seconds)
+        print(cmp.round(4))
+        if cmp['slower'].any():
+            print('slower than {}x the baseline:'.format(args.threshold))
+            print(cmp[cmp['slower']].round(4))
+            sys.exit(1)
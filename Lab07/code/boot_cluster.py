@@ -8,14 +8,17 @@
 
 #
 import numpy as np
-import pandas as pd
 import sys
 import statsmodels.formula.api as smf
 import matplotlib.pyplot as plt
 
+from cluster_boot import cluster_bootstrap, cluster_bootstrap_ci
+from boot_stream import adaptive_bootstrap
+from lab_data import load_data
+
 #
 # load data
-rice = pd.read_csv('./rice2.csv')
+rice = load_data('./rice2.csv')
 print(rice.info())
 #
 # create new variables
@@ -63,26 +66,15 @@ print()
 #
 
 #
-# create dataframe to keep results
-boot_df  = pd.DataFrame(columns=['rep','lnL','lnD','lnF'])
-
-
-#
-# use unique farmids
-farmers = rice[['farmid']].drop_duplicates()
-
+# resample farms with replacement
+#   each farm's X'X and X'y blocks are computed once, and a
+#   replicate is a count-weighted sum of those blocks
+#   (same draws as farmers.sample(frac=1,replace=True) per rep)
 b_reps = 10000
-for i in range(b_reps):
-    bfarms = farmers.sample(frac=1,replace=True)
-    bdf = None
-    for f, fid in bfarms.iterrows():
-        if bdf is None:
-            bdf = rice[rice['farmid']==fid['farmid']]
-        else:
-            bdf = bdf.append(rice[rice['farmid']==fid['farmid']])
-
-    br = smf.ols(formula= 'lnQ ~ lnL + lnD + lnF',data=bdf).fit()
-    boot_df  = boot_df.append({'rep': i,'lnL': br.params[1], 'lnD': br.params[2],'lnF': br.params[3]},ignore_index=True)
+b_seed = 301
+boot_df = cluster_bootstrap('lnQ ~ lnL + lnD + lnF', data=rice,
+                            cluster='farmid', reps=b_reps,
+                            random_state=b_seed)
 
 
 print('Bootstrap estimate (reps=%3d)' % (b_reps))
@@ -90,6 +82,31 @@ print('    parameter: %6.4f' % (boot_df['lnF'].mean()))
 print('    std error: %6.4f' % (boot_df['lnF'].std()))
 print()
 
+#
+# streaming bootstrap without storing the replicates, stops
+# when the Monte Carlo error of the std error and percentile
+# bounds of lnF is below 2% of its std error
+sboot = adaptive_bootstrap('lnQ ~ lnL + lnD + lnF', data=rice,
+                           cluster='farmid', tol=0.02, watch='lnF',
+                           random_state=b_seed)
+print('Adaptive bootstrap estimate (reps=%3d)' % (sboot.reps))
+print('    parameter: %6.4f' % (sboot.params['lnF']))
+print('    std error: %6.4f' % (sboot.std_errors['lnF']))
+print('    95%% interval: [%6.4f, %6.4f]' % (sboot.lower['lnF'], sboot.upper['lnF']))
+print()
+
+#
+# percentile, BCa and percentile-t intervals for all parameters
+#   BCa uses a delete-one-farm jackknife, and percentile-t the
+#   cluster robust std errors of each replicate
+bci = cluster_bootstrap_ci('lnQ ~ lnL + lnD + lnF', data=rice,
+                           cluster='farmid', reps=b_reps,
+                           random_state=b_seed)
+print('Bootstrap 95% confidence intervals')
+print(bci[['estimate', 'pct_lower', 'pct_upper', 'bca_lower', 'bca_upper',
+           't_lower', 't_upper']].round(4))
+print()
+
 
 #
 # plot distribution of parameter estimates
@@ -0,0 +1,235 @@
+# ---------------------------------------------------------
+#    boot_runner.py
+#
+#    Parallel, reproducible and resumable cluster bootstrap
+#    for any formula estimator used in Lab07
+#       smf.ols, plm.PooledOLS, plm.PanelOLS, plm.RandomEffects
+#
+#    Replicate i always uses the random stream
+#        SeedSequence(seed, spawn_key=(i,))
+#    (the i'th child of SeedSequence(seed).spawn), so the
+#    results do not depend on the number of workers or on how
+#    the job was interrupted and resumed.
+#
+#    Replicates are run in blocks. With a checkpoint directory
+#    every finished block is saved as block_NNNNNN.npy, and a
+#    rerun with the same settings and the same data (a digest of
+#    the columns used and the index) only computes missing blocks.
+#
+#    A replicate whose fit fails (singular design, ...) is a row
+#    of NaN; their number is in boot.attrs['failed'] and a
+#    RuntimeWarning is given.
+#
+
+#
+import os
+import json
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from panel_transform import PanelIndex
+from fit_cache import data_digest
+
+
+#
+# fit one data set, return the parameter estimates
+def fit_params(estimator, formula, data, fit_kwargs=None):
+    fit_kwargs = {} if fit_kwargs is None else fit_kwargs
+    if hasattr(estimator, 'from_formula'):
+        #
+        # linearmodels panel estimators
+        res = estimator.from_formula(formula, data=data).fit(**fit_kwargs)
+    else:
+        #
+        # statsmodels formula functions, e.g. smf.ols
+        res = estimator(formula, data=data).fit(**fit_kwargs)
+    return res.params
+
+
+#
+# name used to check that a checkpoint belongs to this job
+def estimator_name(estimator):
+    mod = getattr(estimator, '__module__', '')
+    name = getattr(estimator, '__qualname__', repr(estimator))
+    return '{}.{}'.format(mod, name)
+
+
+#
+# rows of the data for each cluster (PanelIndex, CSR layout)
+#   the cluster is either a column or an index level; clusters
+#   are numbered in order of appearance
+class ClusterRows:
+
+    def __init__(self, data, cluster):
+        self.index = PanelIndex.from_data(data, cluster, sort=False)
+        self.level = None if cluster in data.columns else \
+            data.index.names.index(cluster)
+        self.cluster = cluster
+
+    @property
+    def nclusters(self):
+        return self.index.nentity
+
+    #
+    # build the resampled data set for an array of drawn
+    # clusters; each draw becomes a new cluster 0, 1, ...
+    # so repeated farms are treated as distinct entities
+    def resample(self, data, draws):
+        bdf = data.iloc[self.index.rows(draws)]
+        newid = np.repeat(np.arange(len(draws)), self.index.counts[draws])
+        if self.level is None:
+            bdf = bdf.copy()
+            bdf[self.cluster] = newid
+        else:
+            idx = bdf.index
+            arrays = [idx.get_level_values(i) for i in range(idx.nlevels)]
+            arrays[self.level] = newid
+            bdf = bdf.set_axis(pd.MultiIndex.from_arrays(arrays, names=idx.names))
+        return bdf
+
+
+#
+# worker side: the data set is sent once per process
+_job = {}
+
+
+def _init_worker(job):
+    _job.clear()
+    _job.update(job)
+    _job['rows'] = ClusterRows(job['data'], job['cluster'])
+
+
+def _run_block(block):
+    job = _job
+    first = block * job['block_size']
+    last = min(first + job['block_size'], job['reps'])
+    rows = job['rows']
+    out = np.full((last - first, job['nparams']), np.nan)
+    for r, i in enumerate(range(first, last)):
+        ss = np.random.SeedSequence(job['seed'], spawn_key=(i,))
+        rng = np.random.default_rng(ss)
+        draws = rng.integers(0, rows.nclusters, size=rows.nclusters)
+        bdf = rows.resample(job['data'], draws)
+        try:
+            params = fit_params(job['estimator'], job['formula'], bdf,
+                                job['fit_kwargs'])
+            out[r] = params.reindex(job['names']).to_numpy()
+        except (np.linalg.LinAlgError, ValueError):
+            pass
+    return block, out
+
+
+#
+# checkpoint files
+def _meta_path(checkpoint):
+    return os.path.join(checkpoint, 'meta.json')
+
+
+def _block_path(checkpoint, block):
+    return os.path.join(checkpoint, 'block_{:06d}.npy'.format(block))
+
+
+def _open_checkpoint(checkpoint, meta):
+    os.makedirs(checkpoint, exist_ok=True)
+    path = _meta_path(checkpoint)
+    if os.path.exists(path):
+        with open(path) as f:
+            old = json.load(f)
+        if old != meta:
+            raise ValueError('checkpoint {} was written by a different '
+                             'bootstrap job'.format(checkpoint))
+    else:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(path + '.tmp', path)
+
+
+def _save_block(checkpoint, block, out):
+    path = _block_path(checkpoint, block)
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, out)
+    os.replace(path + '.tmp', path)
+
+
+#
+# cluster bootstrap runner
+#   estimator  : smf.ols or a linearmodels estimator class
+#   cluster    : column or index level that identifies clusters
+#   seed       : integer seed for the SeedSequence
+#   workers    : number of processes (1 runs in this process)
+#   checkpoint : directory for completed blocks, or None
+#
+#   returns a DataFrame with one row per replicate
+def run_bootstrap(formula, data, estimator, cluster, reps=999, seed=None,
+                  workers=1, block_size=100, checkpoint=None, fit_kwargs=None):
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    names = list(fit_params(estimator, formula, data, fit_kwargs).index)
+    nblocks = -(-reps // block_size)
+    job = {'data': data, 'formula': formula, 'estimator': estimator,
+           'cluster': cluster, 'fit_kwargs': fit_kwargs, 'seed': seed,
+           'reps': reps, 'block_size': block_size, 'names': names,
+           'nparams': len(names)}
+
+    results = {}
+    if checkpoint is not None:
+        meta = {'formula': formula, 'estimator': estimator_name(estimator),
+                'cluster': str(cluster), 'seed': str(seed), 'reps': reps,
+                'block_size': block_size, 'names': names,
+                'fit_kwargs': repr(fit_kwargs),
+                'data': data_digest(data, formula, [cluster])}
+        _open_checkpoint(checkpoint, meta)
+        for b in range(nblocks):
+            if os.path.exists(_block_path(checkpoint, b)):
+                results[b] = np.load(_block_path(checkpoint, b))
+    todo = [b for b in range(nblocks) if b not in results]
+
+    def done(block, out):
+        results[block] = out
+        if checkpoint is not None:
+            _save_block(checkpoint, block, out)
+
+    if workers == 1 or len(todo) <= 1:
+        _init_worker(job)
+        for b in todo:
+            done(*_run_block(b))
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(job,)) as pool:
+            futures = [pool.submit(_run_block, b) for b in todo]
+            for fut in as_completed(futures):
+                done(*fut.result())
+
+    out = np.vstack([results[b] for b in range(nblocks)])
+    boot = pd.DataFrame(out, columns=names)
+    boot.index.name = 'rep'
+    #
+    # failed fits are the rows left all NaN by _run_block
+    failed = int(np.isnan(out).all(axis=1).sum())
+    boot.attrs['failed'] = failed
+    if failed:
+        warnings.warn('{} of {} bootstrap replicates failed to fit and are '
+                      'NaN'.format(failed, reps), RuntimeWarning, stacklevel=2)
+    return boot
+
+
+#
+# example: fixed effects on the rice panel
+if __name__ == '__main__':
+    import linearmodels as plm
+    from lab_data import load_data
+
+    rice = load_data('./rice3.csv')
+    rice['lnQ'] = np.log(rice['prod'])
+    rice['lnD'] = np.log(rice['area'])
+    rice['lnL'] = np.log(rice['labor'])
+    rice['lnF'] = np.log(rice['fert'])
+    rice = rice.set_index(['farmid', 'year'])
+
+    boot = run_bootstrap('lnQ ~ lnD + lnL + lnF + EntityEffects', rice,
+                         plm.PanelOLS, cluster='farmid', reps=999,
+                         seed=301, workers=os.cpu_count(),
+                         checkpoint='./boot_fe_rice')
+    print(boot.describe())
@@ -0,0 +1,210 @@
+# ---------------------------------------------------------
+#    boot_stream.py
+#
+#    Streaming cluster bootstrap with adaptive stopping
+#
+#    Replicates are drawn in batches and folded into fixed size
+#    accumulators, nothing is stored per replicate:
+#       - mean and central moments up to order four, merged
+#         batch by batch with the Welford/Chan/Pebay updates
+#       - P-square quantile markers (Jain and Chlamtac, 1985)
+#         for the percentile bounds and two neighbouring
+#         quantiles that give the density at each bound
+#
+#    The Monte Carlo standard errors are
+#       se(sd)  = sqrt(m4 - s^4 (n-3)/(n-1)) / (2 s sqrt(n))
+#       se(q_p) = sqrt(p(1-p)/n) / f(q_p)
+#    with f(q_p) = 2h / (q_{p+h} - q_{p-h}). The bootstrap stops
+#    when all of them are below tol times the bootstrap
+#    standard error of the parameter.
+#
+
+#
+import numpy as np
+import pandas as pd
+
+from cluster_boot import ClusterMoments, draw_counts
+
+
+#
+# running mean and central moments M2, M3, M4 per column
+class MomentAccumulator:
+
+    def __init__(self, k):
+        self.n = 0
+        self.mean = np.zeros(k)
+        self.m2 = np.zeros(k)
+        self.m3 = np.zeros(k)
+        self.m4 = np.zeros(k)
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        nb = x.shape[0]
+        if nb == 0:
+            return
+        mb = x.mean(axis=0)
+        d = x - mb
+        m2b = (d ** 2).sum(axis=0)
+        m3b = (d ** 3).sum(axis=0)
+        m4b = (d ** 4).sum(axis=0)
+        na = self.n
+        n = na + nb
+        delta = mb - self.mean
+        self.m4 = (self.m4 + m4b
+                   + delta ** 4 * na * nb * (na * na - na * nb + nb * nb) / n ** 3
+                   + 6 * delta ** 2 * (na * na * m2b + nb * nb * self.m2) / n ** 2
+                   + 4 * delta * (na * m3b - nb * self.m3) / n)
+        self.m3 = (self.m3 + m3b
+                   + delta ** 3 * na * nb * (na - nb) / n ** 2
+                   + 3 * delta * (na * m2b - nb * self.m2) / n)
+        self.m2 = self.m2 + m2b + delta ** 2 * na * nb / n
+        self.mean = self.mean + delta * nb / n
+        self.n = n
+
+    @property
+    def std(self):
+        return np.sqrt(self.m2 / (self.n - 1))
+
+    #
+    # Monte Carlo standard error of the standard deviation
+    @property
+    def std_error(self):
+        n = self.n
+        s2 = self.m2 / (n - 1)
+        var_s2 = (self.m4 / n - s2 ** 2 * (n - 3) / (n - 1)) / n
+        return np.sqrt(np.maximum(var_s2, 0.0)) / (2 * np.sqrt(s2))
+
+
+#
+# P-square estimates of several quantiles for several columns,
+# five markers per (column, quantile) pair
+class P2Quantiles:
+
+    def __init__(self, probs, k):
+        self.probs = np.asarray(probs, dtype=np.float64)
+        self.k = k
+        p = np.tile(self.probs, k)
+        self.dn = np.column_stack([0 * p, p / 2, p, (1 + p) / 2, 1 + 0 * p])
+        self.q = None
+        self.n = None
+        self.want = None
+        self._init = []
+
+    def update(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        start = 0
+        if self.q is None:
+            need = 5 - len(self._init)
+            self._init.extend(x[:need])
+            start = need
+            if len(self._init) < 5:
+                return
+            first = np.sort(np.repeat(np.asarray(self._init), len(self.probs),
+                                      axis=1).T, axis=1)
+            self.q = first
+            self.n = np.tile(np.arange(5.0), (first.shape[0], 1))
+            self.want = 4 * self.dn
+            self._init = []
+        for row in x[start:]:
+            self._step(np.repeat(row, len(self.probs)))
+
+    def _step(self, x):
+        q, n = self.q, self.n
+        rows = np.arange(q.shape[0])
+        q[:, 0] = np.minimum(q[:, 0], x)
+        q[:, 4] = np.maximum(q[:, 4], x)
+        k = (q[:, 1:4] <= x[:, None]).sum(axis=1)
+        n += np.arange(5) > k[:, None]
+        self.want += self.dn
+        for i in (1, 2, 3):
+            d = self.want[:, i] - n[:, i]
+            up = (d >= 1) & (n[:, i + 1] - n[:, i] > 1)
+            dn = (d <= -1) & (n[:, i - 1] - n[:, i] < -1)
+            move = up | dn
+            if not move.any():
+                continue
+            s = np.where(up, 1.0, -1.0)
+            qi, qm, qp = q[:, i], q[:, i - 1], q[:, i + 1]
+            ni, nm, np_ = n[:, i], n[:, i - 1], n[:, i + 1]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                para = qi + s / (np_ - nm) * ((ni - nm + s) * (qp - qi) / (np_ - ni)
+                                              + (np_ - ni - s) * (qi - qm) / (ni - nm))
+                j = i + s.astype(int)
+                lin = qi + s * (q[rows, j] - qi) / (n[rows, j] - ni)
+            new = np.where((qm < para) & (para < qp), para, lin)
+            q[:, i] = np.where(move, new, qi)
+            n[:, i] = np.where(move, ni + s, ni)
+
+    #
+    # (k x len(probs)) array of current estimates
+    @property
+    def quantiles(self):
+        return self.q[:, 2].reshape(self.k, len(self.probs))
+
+
+class StreamResult:
+
+    def __init__(self, names, moments, sketch, alpha, h, converged):
+        self.names = names
+        self.reps = moments.n
+        self.alpha = alpha
+        self.converged = converged
+        qs = sketch.quantiles
+        p = np.array([alpha / 2, 1 - alpha / 2])
+        dens = 2 * h / (qs[:, [2, 5]] - qs[:, [0, 3]])
+        self.params = pd.Series(moments.mean, index=names)
+        self.std_errors = pd.Series(moments.std, index=names)
+        self.lower = pd.Series(qs[:, 1], index=names)
+        self.upper = pd.Series(qs[:, 4], index=names)
+        mc_q = np.sqrt(p * (1 - p) / moments.n) / dens
+        self.mc_error = pd.DataFrame({'std_error': moments.std_error,
+                                      'lower': mc_q[:, 0],
+                                      'upper': mc_q[:, 1]}, index=names)
+
+    @property
+    def summary(self):
+        return pd.DataFrame({'mean': self.params,
+                             'std_error': self.std_errors,
+                             'lower': self.lower,
+                             'upper': self.upper})
+
+
+#
+# cluster bootstrap that stops when the Monte Carlo error of
+# the standard errors and percentile bounds is small
+#   tol    : allowed Monte Carlo error relative to the SE
+#   alpha  : percentile interval (alpha/2, 1-alpha/2)
+#   watch  : parameters used for the stopping rule (all if None)
+#   h      : half width used for the density at the bounds
+#   with a given random_state the replicates are the same as
+#   the first reps of cluster_bootstrap
+def adaptive_bootstrap(formula, data, cluster, tol=0.01, alpha=0.05,
+                       batch=500, min_reps=1000, max_reps=100000,
+                       watch=None, h=0.01, random_state=None):
+    cm = ClusterMoments.from_formula(formula, data, cluster)
+    if isinstance(random_state, np.random.RandomState):
+        rs = random_state
+    else:
+        rs = np.random.RandomState(random_state)
+    names = cm.names
+    cols = np.arange(len(names)) if watch is None else \
+        np.array([names.index(w) for w in np.atleast_1d(watch)])
+    probs = [alpha / 2 - h, alpha / 2, alpha / 2 + h,
+             1 - alpha / 2 - h, 1 - alpha / 2, 1 - alpha / 2 + h]
+    moments = MomentAccumulator(len(names))
+    sketch = P2Quantiles(probs, len(names))
+    converged = False
+    while moments.n < max_reps:
+        n = min(batch, max_reps - moments.n)
+        draws = cm.weighted_params(draw_counts(rs, cm.nclusters, n))
+        draws = draws[~np.isnan(draws).any(axis=1)]
+        moments.update(draws)
+        sketch.update(draws)
+        if moments.n >= min_reps:
+            res = StreamResult(names, moments, sketch, alpha, h, False)
+            err = res.mc_error.to_numpy()[cols] / \
+                res.std_errors.to_numpy()[cols, None]
+            if np.all(err < tol):
+                converged = True
+                break
+    return StreamResult(names, moments, sketch, alpha, h, converged)
@@ -0,0 +1,298 @@
+# ---------------------------------------------------------
+#    categorical.py
+#
+#    Period and categorical effects as integer codes instead of
+#    dense dummy columns
+#
+#        y, D, index = factor_design('lnQ ~ 1 + lnD + lnL + lnF + year', rice)
+#        D.names                        # same columns as patsy
+#        D.crossprod()                  # X'X without building X
+#        pm = PanelMoments.from_formula(formula, rice)     # uses D
+#
+#    A Factor keeps the column of every row as int32 (-1 for the
+#    reference level or a missing value). For an indicator block
+#    D and dense columns x
+#       D'x      segment sums of x by level (np.bincount)
+#       D'D      the counts on the diagonal
+#       D1'D2    counts of pairs of levels
+#       X b      x b_x + b_D[code]
+#    and the per-entity or per-cluster versions are the same sums
+#    over the codes entity * ncols + col. Nothing of size
+#    (rows x levels) is allocated, and the results are those of
+#    the dense design up to rounding.
+#
+#    factor_design() lets patsy parse the formula and learn the
+#    levels, then encodes every term that is a single categorical
+#    factor with an indicator contrast (treatment coding, or the
+#    full set of levels without an intercept) as a Factor; all
+#    other terms, interactions included, are built densely by
+#    patsy. Column names and order are those of patsy.dmatrices.
+#
+
+#
+import numpy as np
+import pandas as pd
+import patsy
+
+from cluster_cov import cluster_scores
+from panel_transform import PanelIndex, strip_effects
+
+
+class Factor:
+
+    #
+    # codes  : level of each row, 0..L-1 (-1 missing)
+    # levels : the L levels
+    # column : indicator column of each level, -1 for none
+    def __init__(self, codes, levels, names, column=None):
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.levels = pd.Index(levels)
+        self.names = list(names)
+        if column is None:
+            column = np.arange(-1, len(levels) - 1)
+        self.column = np.asarray(column, dtype=np.int32)
+        col = np.r_[self.column, -1].astype(np.int32)
+        self.cols = col[self.codes]
+
+    #
+    # treatment coding of a column; prefix gives the names of
+    # pd.get_dummies(values, prefix=prefix, drop_first=...)
+    @classmethod
+    def from_values(cls, values, name=None, drop_first=True, prefix=None):
+        name = getattr(values, 'name', None) if name is None else name
+        codes, levels = pd.factorize(np.asarray(values), sort=True)
+        keep = levels[1:] if drop_first else levels
+        if prefix is not None:
+            names = ['{}_{}'.format(prefix, lev) for lev in keep]
+        elif drop_first:
+            names = ['{}[T.{}]'.format(name, lev) for lev in keep]
+        else:
+            names = ['{}[{}]'.format(name, lev) for lev in keep]
+        column = np.arange(len(levels)) - int(drop_first)
+        return cls(codes, levels, names, column)
+
+    @property
+    def nobs(self):
+        return len(self.codes)
+
+    @property
+    def ncols(self):
+        return len(self.names)
+
+    @property
+    def counts(self):
+        ok = self.cols >= 0
+        return np.bincount(self.cols[ok], minlength=self.ncols).astype(np.float64)
+
+    #
+    # sums of values by indicator column (ncols x K), D'values
+    def sums(self, values):
+        ok = self.cols >= 0
+        return cluster_scores(np.asarray(values, dtype=np.float64)[ok],
+                              self.cols[ok], self.ncols)
+
+    #
+    # (rows x ncols) scipy.sparse indicator matrix
+    def indicators(self):
+        from scipy import sparse
+        rows = np.flatnonzero(self.cols >= 0)
+        return sparse.csr_matrix((np.ones(len(rows)), (rows, self.cols[rows])),
+                                 shape=(self.nobs, self.ncols))
+
+    #
+    # the dense columns, as pd.get_dummies
+    def dummies(self, index=None, dtype=bool):
+        out = np.zeros((self.nobs, self.ncols), dtype=dtype)
+        rows = np.flatnonzero(self.cols >= 0)
+        out[rows, self.cols[rows]] = 1
+        return pd.DataFrame(out, index=index, columns=self.names)
+
+    def take(self, rows):
+        new = Factor.__new__(Factor)
+        new.levels, new.names, new.column = self.levels, self.names, self.column
+        new.codes, new.cols = self.codes[rows], self.cols[rows]
+        return new
+
+
+#
+# codes of rows in cells of a grouping (G) and a factor
+def _cells(group, G, f):
+    ok = f.cols >= 0
+    return ok, group[ok].astype(np.int64) * f.ncols + f.cols[ok]
+
+
+class FactorDesign:
+
+    #
+    # X      : (n x k) dense columns
+    # factors: list of Factor
+    # dpos, fpos : positions of the dense and factor columns
+    #              among the names
+    def __init__(self, X, factors, names, dpos, fpos):
+        self.X = np.asarray(X, dtype=np.float64)
+        self.factors = list(factors)
+        self.names = list(names)
+        self.dpos = np.asarray(dpos, dtype=np.int64)
+        self.fpos = [np.asarray(p, dtype=np.int64) for p in fpos]
+
+    @property
+    def shape(self):
+        return (self.X.shape[0], len(self.names))
+
+    def take(self, rows):
+        return FactorDesign(self.X[rows], [f.take(rows) for f in self.factors],
+                            self.names, self.dpos, self.fpos)
+
+    def dense(self):
+        out = np.zeros(self.shape)
+        out[:, self.dpos] = self.X
+        for f, pos in zip(self.factors, self.fpos):
+            out[:, pos] = f.dummies(dtype=np.float64).to_numpy()
+        return out
+
+    #
+    # X b
+    def matvec(self, b):
+        b = np.asarray(b, dtype=np.float64)
+        out = self.X @ b[self.dpos]
+        for f, pos in zip(self.factors, self.fpos):
+            out += np.r_[b[pos], 0.0][f.cols]
+        return out
+
+    #
+    # X'v
+    def rmatvec(self, v):
+        v = np.asarray(v, dtype=np.float64)
+        out = np.zeros(len(self.names))
+        out[self.dpos] = self.X.T @ v
+        for f, pos in zip(self.factors, self.fpos):
+            out[pos] = f.sums(v)
+        return out
+
+    #
+    # per-group moments of z = [X, extra]: sum z z' (G x P x P)
+    # and sum z (G x P), from bincounts over the group codes and
+    # the (group, level) cells
+    def group_moments(self, group, G, extra=None):
+        Zd = self.X if extra is None else np.column_stack([self.X, extra])
+        K = len(self.names)
+        dcols = np.r_[self.dpos, np.arange(K, K + Zd.shape[1] - self.X.shape[1])]
+        P = K + len(dcols) - len(self.dpos)
+        Q = np.zeros((G, P, P))
+        s = np.zeros((G, P))
+        for j, c in enumerate(dcols):
+            Q[:, c, dcols[j:]] = cluster_scores(Zd[:, j:] * Zd[:, j:j+1], group, G)
+            Q[:, dcols[j:], c] = Q[:, c, dcols[j:]]
+        s[:, dcols] = cluster_scores(Zd, group, G)
+        for a, (f, pos) in enumerate(zip(self.factors, self.fpos)):
+            ok, cell = _cells(group, G, f)
+            n = np.bincount(cell, minlength=G * f.ncols).reshape(G, f.ncols)
+            s[:, pos] = n
+            Q[:, pos, pos] = n
+            cs = cluster_scores(Zd[ok], cell, G * f.ncols).reshape(G, f.ncols, -1)
+            Q[:, pos[:, None], dcols] = cs
+            Q[:, dcols[:, None], pos] = cs.transpose(0, 2, 1)
+            for f2, pos2 in zip(self.factors[a + 1:], self.fpos[a + 1:]):
+                both = ok & (f2.cols >= 0)
+                cell2 = (group[both].astype(np.int64) * f.ncols
+                         + f.cols[both]) * f2.ncols + f2.cols[both]
+                n2 = np.bincount(cell2, minlength=G * f.ncols * f2.ncols)
+                n2 = n2.reshape(G, f.ncols, f2.ncols)
+                Q[:, pos[:, None], pos2] = n2
+                Q[:, pos2[:, None], pos] = n2.transpose(0, 2, 1)
+        return Q, s
+
+    #
+    # X'X
+    def crossprod(self):
+        return self.group_moments(np.zeros(self.shape[0], dtype=np.int64), 1)[0][0]
+
+    #
+    # per-cluster scores X_g'e_g (G x K)
+    def cluster_scores(self, e, codes, G):
+        out = np.zeros((G, len(self.names)))
+        out[:, self.dpos] = cluster_scores(self.X * e[:, None], codes, G)
+        for f, pos in zip(self.factors, self.fpos):
+            ok, cell = _cells(codes, G, f)
+            out[:, pos] = np.bincount(cell, e[ok],
+                                      minlength=G * f.ncols).reshape(G, f.ncols)
+        return out
+
+    #
+    # X_g'X_g for every cluster (G x K x K)
+    def cluster_blocks(self, codes, G):
+        return self.group_moments(codes, G)[0]
+
+
+#
+# level of every value (-1 missing), vectorized in place of
+# patsy's categorical_to_int
+def _level_codes(values, levels):
+    values = getattr(values, 'data', values)
+    values = np.asarray(values, dtype=object) if not hasattr(values, 'dtype') else values
+    codes = pd.Categorical(values, categories=list(levels)).codes
+    bad = (codes < 0) & ~pd.isna(values)
+    if bad.any():
+        raise patsy.PatsyError('value {!r} is not one of the levels {}'.format(
+            np.asarray(values)[bad][0], list(levels)))
+    return codes
+
+
+#
+# column of each level for an indicator contrast, None for
+# any other coding
+def _indicator_columns(contrast):
+    M = np.asarray(contrast.matrix)
+    if not np.all((M == 0) | (M == 1)) or np.any(M.sum(axis=0) != 1) \
+            or np.any(M.sum(axis=1) > 1):
+        return None
+    return np.where(M.sum(axis=1) > 0, M.argmax(axis=1), -1)
+
+
+#
+# y and a FactorDesign from a formula
+#   returns y, the design and the positions of the rows used
+#   (rows with a missing value are dropped, as patsy does)
+def factor_design(formula, data, eval_env=0):
+    env = patsy.EvalEnvironment.capture(eval_env + 1)
+    yinfo, xinfo = patsy.incr_dbuilders(formula, lambda: iter([data]), env)
+    factors, fpos, dense = [], [], []
+    for term, sl in xinfo.term_slices.items():
+        coding = xinfo.term_codings[term]
+        column = None
+        if len(term.factors) == 1 and len(coding) == 1:
+            f = term.factors[0]
+            info = xinfo.factor_infos[f]
+            if info.type == 'categorical':
+                column = _indicator_columns(coding[0].contrast_matrices[f])
+        if column is None:
+            dense.append(term)
+            continue
+        values = f.eval(info.state, data)
+        codes = _level_codes(values, info.categories)
+        factors.append(Factor(codes, info.categories,
+                              xinfo.column_names[sl], column))
+        fpos.append(np.arange(sl.start, sl.stop))
+    dinfo = xinfo.subset(dense)
+    na = patsy.NAAction(NA_types=[])
+    y, X = patsy.build_design_matrices([yinfo, dinfo], data, NA_action=na)
+    y, X = np.asarray(y)[:, 0], np.asarray(X)
+    keep = ~(np.isnan(y) | np.isnan(X).any(axis=1))
+    for f in factors:
+        keep &= f.codes >= 0
+    names = xinfo.column_names
+    dpos = [names.index(n) for n in dinfo.column_names]
+    design = FactorDesign(X, factors, names, dpos, fpos)
+    rows = np.flatnonzero(keep)
+    if len(rows) < len(keep):
+        design, y = design.take(rows), y[rows]
+    return y, design, rows
+
+
+#
+# as panel_design() in panel_transform.py: entities from index
+# level 0, the EntityEffects term dropped
+def panel_factor_design(formula, data):
+    y, design, rows = factor_design(strip_effects(formula), data, eval_env=1)
+    index = PanelIndex(data.index.get_level_values(0).to_numpy()[rows])
+    return y, design, index
@@ -0,0 +1,225 @@
+# ---------------------------------------------------------
+#    cluster_boot.py
+#
+#    Pairs cluster bootstrap for OLS from per-cluster
+#    sufficient statistics
+#
+#    Each cluster's X'X and X'y blocks are computed once.
+#    A bootstrap replicate that draws cluster g c_g times has
+#        X*'X* = sum_g c_g X_g'X_g,   X*'y* = sum_g c_g X_g'y_g
+#    so a batch of replicates is a matrix product of the
+#    (reps x G) count matrix with the stacked blocks, followed
+#    by one batched solve.
+#
+#    The same blocks give the cluster scores X_g'y_g - X_g'X_g b
+#    for any b, so cluster robust standard errors of every
+#    replicate (percentile-t) and the delete-one-cluster
+#    jackknife (BCa acceleration) are downdates of the totals
+#    rather than refits.
+#
+
+#
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import stats
+
+from panel_transform import PanelIndex
+
+
+#
+# per-cluster cross products
+#   xx[g] = X_g'X_g  (G x K x K)
+#   xy[g] = X_g'y_g  (G x K)
+#   sizes[g] = number of observations in cluster g
+#   labels are in order of first appearance, the same order
+#   as data[[cluster]].drop_duplicates()
+class ClusterMoments:
+
+    def __init__(self, xx, xy, sizes, labels, names=None):
+        self.xx = xx
+        self.xy = xy
+        self.sizes = sizes
+        self.labels = labels
+        self.names = names
+
+    @property
+    def nclusters(self):
+        return self.xx.shape[0]
+
+    @property
+    def nparams(self):
+        return self.xx.shape[1]
+
+    @classmethod
+    def from_arrays(cls, X, y, groups, names=None):
+        X = np.asarray(X, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64).reshape(-1)
+        #
+        # rows sorted by cluster once, then every block is a
+        # segment sum over contiguous rows
+        index = PanelIndex(groups, sort=False)
+        k = X.shape[1]
+        xx = np.empty((index.nentity, k, k))
+        for j in range(k):
+            xx[:, j, :] = index.sums(X * X[:, j:j+1])
+        xy = index.sums(X * y[:, None])
+        sizes = index.counts.astype(np.float64)
+        return cls(xx, xy, sizes, np.asarray(index.labels), names)
+
+    @classmethod
+    def from_formula(cls, formula, data, cluster):
+        y, X = patsy.dmatrices(formula, data, return_type='dataframe')
+        groups = data.loc[X.index, cluster]
+        return cls.from_arrays(X.values, y.values, groups.values,
+                               names=list(X.columns))
+
+    #
+    # full sample estimate
+    def params(self):
+        return np.linalg.solve(self.xx.sum(axis=0), self.xy.sum(axis=0))
+
+    #
+    # estimates for a (reps x G) matrix of cluster weights
+    def weighted_params(self, weights):
+        xx, xy = self._weighted_totals(weights)
+        return self._solve(xx, xy)
+
+    #
+    # estimates and cluster robust standard errors (CV1, as
+    # statsmodels cov_type='cluster') for a matrix of weights;
+    # a cluster drawn c_g times counts as c_g clusters
+    def weighted_fit(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        xx, xy = self._weighted_totals(weights)
+        params = self._solve(xx, xy)
+        scores = self.xy[None] - np.einsum('gkl,bl->bgk', self.xx, params)
+        meat = np.einsum('bg,bgk,bgl->bkl', weights, scores, scores)
+        G = weights.sum(axis=1)
+        n = weights @ self.sizes
+        k = self.nparams
+        scale = G / (G - 1) * (n - 1) / (n - k)
+        with np.errstate(invalid='ignore'):
+            bread = np.linalg.inv(np.where(np.isnan(params)[..., None],
+                                           np.eye(k), xx))
+        cov = scale[:, None, None] * bread @ meat @ bread
+        bse = np.sqrt(np.einsum('bkk->bk', cov))
+        bse[np.isnan(params)] = np.nan
+        return params, bse
+
+    #
+    # delete-one-cluster estimates, each one a downdate of the
+    # full X'X and X'y by a single cluster block (G x K)
+    def jackknife_params(self):
+        xx = self.xx.sum(axis=0)[None] - self.xx
+        xy = self.xy.sum(axis=0)[None] - self.xy
+        return self._solve(xx, xy)
+
+    def _weighted_totals(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        g, k = self.nclusters, self.nparams
+        xx = (weights @ self.xx.reshape(g, k * k)).reshape(-1, k, k)
+        xy = weights @ self.xy
+        return xx, xy
+
+    def _solve(self, xx, xy):
+        k = self.nparams
+        try:
+            return np.linalg.solve(xx, xy[..., None])[..., 0]
+        except np.linalg.LinAlgError:
+            #
+            # a replicate without enough distinct clusters is
+            # singular, report it as missing
+            out = np.full((len(xx), k), np.nan)
+            for r in range(len(xx)):
+                try:
+                    out[r] = np.linalg.solve(xx[r], xy[r])
+                except np.linalg.LinAlgError:
+                    pass
+            return out
+
+
+#
+# draw cluster counts for a batch of replicates
+#   with a RandomState this uses exactly the same draws as
+#   farmers.sample(frac=1, replace=True, random_state=rs)
+#   called once per replicate
+def draw_counts(rs, nclusters, reps):
+    idx = rs.choice(nclusters, size=(reps, nclusters), replace=True)
+    flat = idx + nclusters * np.arange(reps)[:, None]
+    counts = np.bincount(flat.ravel(), minlength=reps * nclusters)
+    return counts.reshape(reps, nclusters).astype(np.float64)
+
+
+#
+# pairs cluster bootstrap
+#   returns a DataFrame with one row per replicate and one
+#   column per regressor
+def cluster_bootstrap(formula, data, cluster, reps=999, random_state=None,
+                      chunk=2000):
+    cm = ClusterMoments.from_formula(formula, data, cluster)
+    if isinstance(random_state, np.random.RandomState):
+        rs = random_state
+    else:
+        rs = np.random.RandomState(random_state)
+    out = np.empty((reps, cm.nparams))
+    for start in range(0, reps, chunk):
+        n = min(chunk, reps - start)
+        counts = draw_counts(rs, cm.nclusters, n)
+        out[start:start + n] = cm.weighted_params(counts)
+    boot = pd.DataFrame(out, columns=cm.names)
+    boot.index.name = 'rep'
+    return boot
+
+
+#
+# bootstrap confidence intervals for every coefficient
+#   percentile : quantiles of b*
+#   bca        : bias corrected and accelerated, with the
+#                acceleration from the delete-one-cluster jackknife
+#   studentized: percentile-t, t* = (b* - b) / se*, with cluster
+#                robust (CV1) standard errors in every replicate
+#   returns a DataFrame with one row per coefficient
+def cluster_bootstrap_ci(formula, data, cluster, reps=999, alpha=0.05,
+                         random_state=None, chunk=2000):
+    cm = ClusterMoments.from_formula(formula, data, cluster)
+    if isinstance(random_state, np.random.RandomState):
+        rs = random_state
+    else:
+        rs = np.random.RandomState(random_state)
+    b, se = cm.weighted_fit(np.ones((1, cm.nclusters)))
+    b, se = b[0], se[0]
+    boot = np.empty((reps, cm.nparams))
+    tstat = np.empty((reps, cm.nparams))
+    for start in range(0, reps, chunk):
+        n = min(chunk, reps - start)
+        bb, bse = cm.weighted_fit(draw_counts(rs, cm.nclusters, n))
+        boot[start:start + n] = bb
+        tstat[start:start + n] = (bb - b) / bse
+    lo, hi = alpha / 2, 1 - alpha / 2
+
+    #
+    # bias correction and acceleration
+    z0 = stats.norm.ppf(np.nanmean(boot < b, axis=0))
+    jack = cm.jackknife_params()
+    d = np.nanmean(jack, axis=0) - jack
+    acc = np.nansum(d ** 3, axis=0) / (6 * np.nansum(d ** 2, axis=0) ** 1.5)
+    za = stats.norm.ppf([lo, hi])[:, None]
+    adj = stats.norm.cdf(z0 + (z0 + za) / (1 - acc * (z0 + za)))
+    bca = np.array([np.nanquantile(boot[:, j], adj[:, j])
+                    for j in range(cm.nparams)])
+
+    tq = np.nanquantile(tstat, [hi, lo], axis=0)
+    out = pd.DataFrame({'estimate': b,
+                        'std_error': se,
+                        'boot_se': np.nanstd(boot, axis=0, ddof=1),
+                        'pct_lower': np.nanquantile(boot, lo, axis=0),
+                        'pct_upper': np.nanquantile(boot, hi, axis=0),
+                        'bca_lower': bca[:, 0],
+                        'bca_upper': bca[:, 1],
+                        't_lower': b - tq[0] * se,
+                        't_upper': b - tq[1] * se,
+                        'z0': z0,
+                        'acceleration': acc},
+                       index=cm.names)
+    return out
@@ -0,0 +1,126 @@
+# ---------------------------------------------------------
+#    cluster_cov.py
+#
+#    Cluster robust covariance for least squares
+#
+#    Scores x_it e_it are summed by cluster with one np.bincount
+#    per regressor, so the work is O(n K) and the memory O(G K)
+#    for the cluster scores plus O(K^2) for the meat. There are
+#    no per-group Python loops.
+#
+#    Variants
+#       CV0  (X'X)^-1 (sum_g s_g s_g') (X'X)^-1
+#       CV1  CV0 * G/(G-1) * (n-1)/(n-K)  (statsmodels, Stata)
+#       CV3  (G-1)/G sum_g (b_(g) - b)(b_(g) - b)', the delete
+#            one cluster jackknife, with
+#            b_(g) - b = -(X'X - X_g'X_g)^-1 s_g
+#            from the per-cluster blocks (O(G K^2) memory)
+#    Two-way clustering (Cameron, Gelbach and Miller, 2011)
+#       V = V_1 + V_2 - V_12
+#    where V_12 clusters on the intersection of the two.
+#
+
+#
+import numpy as np
+import pandas as pd
+
+from instrument import timed
+
+
+#
+# integer codes 0..G-1 for a cluster variable; small non-negative
+# integers are relabelled with a bincount instead of hashing
+def cluster_codes(groups):
+    groups = np.asarray(groups).reshape(-1)
+    if groups.dtype.kind in 'iu' and len(groups) and groups.min() >= 0 \
+            and groups.max() < 2 * len(groups):
+        present = np.bincount(groups) > 0
+        if present.all():
+            return groups, len(present)
+        return (np.cumsum(present) - 1)[groups], int(present.sum())
+    codes, uniq = pd.factorize(groups)
+    return codes, len(uniq)
+
+
+#
+# sums of the columns of values by cluster (G x K)
+def cluster_scores(values, codes, nclusters=None):
+    values = np.asarray(values, dtype=np.float64)
+    if nclusters is None:
+        nclusters = codes.max() + 1
+    if values.ndim == 1:
+        return np.bincount(codes, values, minlength=nclusters)
+    return np.column_stack([np.bincount(codes, values[:, j],
+                                        minlength=nclusters)
+                            for j in range(values.shape[1])])
+
+
+#
+# X_g'X_g for every cluster (G x K x K)
+def cluster_blocks(X, codes, nclusters=None):
+    X = np.asarray(X, dtype=np.float64)
+    if nclusters is None:
+        nclusters = codes.max() + 1
+    k = X.shape[1]
+    H = np.empty((nclusters, k, k))
+    for i in range(k):
+        for j in range(i, k):
+            H[:, i, j] = np.bincount(codes, X[:, i] * X[:, j],
+                                     minlength=nclusters)
+            H[:, j, i] = H[:, i, j]
+    return H
+
+
+def _one_way(X, e, codes, G, kind, xpxi, XtX):
+    n, k = X.shape
+    if hasattr(X, 'cluster_scores'):
+        s = X.cluster_scores(e, codes, G)
+    else:
+        s = cluster_scores(X * e[:, None], codes, G)
+    if kind == 'CV0':
+        return xpxi @ (s.T @ s) @ xpxi
+    elif kind == 'CV1':
+        return G / (G - 1) * (n - 1) / (n - k) * xpxi @ (s.T @ s) @ xpxi
+    elif kind == 'CV3':
+        H = X.cluster_blocks(codes, G) if hasattr(X, 'cluster_blocks') \
+            else cluster_blocks(X, codes, G)
+        d = np.linalg.solve(XtX[None] - H, s[..., None])[..., 0]
+        return (G - 1) / G * d.T @ d
+    raise ValueError('unknown covariance: {}'.format(kind))
+
+
+#
+# cluster robust covariance of the least squares estimates
+#   X        : (n x K) regressors, or a FactorDesign (categorical.py)
+#   e        : (n,) residuals
+#   clusters : (n,), (n x 2) for two-way clustering, or a
+#              PanelIndex of the rows
+#   kind     : 'CV0', 'CV1' or 'CV3'
+#   psd      : clip negative eigenvalues of a two-way estimate
+@timed('cluster_cov')
+def cluster_cov(X, e, clusters, kind='CV1', psd=False):
+    if hasattr(X, 'crossprod'):
+        XtX = X.crossprod()
+    else:
+        X = np.asarray(X, dtype=np.float64)
+        XtX = X.T @ X
+    e = np.asarray(e, dtype=np.float64).reshape(-1)
+    xpxi = np.linalg.inv(XtX)
+    if hasattr(clusters, 'codes'):
+        return _one_way(X, e, clusters.codes, clusters.nentity, kind, xpxi, XtX)
+    clusters = np.asarray(clusters)
+    if clusters.ndim == 1 or clusters.shape[1] == 1:
+        codes, G = cluster_codes(clusters)
+        return _one_way(X, e, codes, G, kind, xpxi, XtX)
+    if clusters.shape[1] != 2:
+        raise ValueError('only one- and two-way clustering is supported')
+    c1, g1 = cluster_codes(clusters[:, 0])
+    c2, g2 = cluster_codes(clusters[:, 1])
+    c12, g12 = cluster_codes(c1.astype(np.int64) * g2 + c2)
+    V = (_one_way(X, e, c1, g1, kind, xpxi, XtX)
+         + _one_way(X, e, c2, g2, kind, xpxi, XtX)
+         - _one_way(X, e, c12, g12, kind, xpxi, XtX))
+    if psd:
+        val, vec = np.linalg.eigh(V)
+        V = (vec * np.maximum(val, 0.0)) @ vec.T
+    return V
@@ -0,0 +1,124 @@
+# ---------------------------------------------------------
+#    crosstab.py
+#
+#    One- and two-way frequency tables from integer codes
+#
+#        tabs = Crosstab(mroz)
+#        tabs.table('inlf')                                # counts
+#        tabs.table('educ', 'inlf', normalize='all', margins=True)
+#
+#    Each column is factorized once. A count table is a single
+#    np.bincount of the combined codes row * ncols + col, and the
+#    normalized and margin versions are computed from the counts
+#    without going back to the data. A one-way table is taken
+#    from the margin of a two-way table already counted when the
+#    other variable has no missing values. The tables have the
+#    same layout and values as pd.crosstab (missing values
+#    dropped, margins named 'All').
+#
+
+#
+import numpy as np
+import pandas as pd
+
+
+class Crosstab:
+
+    def __init__(self, data):
+        self.data = data
+        self._codes = {}
+        self._counts = {}
+
+    #
+    # sorted levels and codes of a column, -1 for missing
+    def factor(self, name):
+        if name not in self._codes:
+            codes, levels = pd.factorize(self.data[name], sort=True)
+            self._codes[name] = (codes, levels)
+        return self._codes[name]
+
+    def _complete(self, name):
+        return not np.any(self.factor(name)[0] < 0)
+
+    #
+    # count table (R x C) with its row and column levels; the
+    # one-way table has the single column 'count'
+    def counts(self, row, col=None):
+        key = (row, col)
+        if key in self._counts:
+            return self._counts[key]
+        r, rl = self.factor(row)
+        if col is None:
+            t = self._margin(row)
+            if t is None:
+                t = np.bincount(r[r >= 0], minlength=len(rl))[:, None]
+            cl = pd.Index(['count'])
+        else:
+            c, cl = self.factor(col)
+            ok = (r >= 0) & (c >= 0)
+            t = np.bincount(r[ok].astype(np.int64) * len(cl) + c[ok],
+                            minlength=len(rl) * len(cl)).reshape(len(rl), len(cl))
+        #
+        # levels only seen together with a missing value are dropped
+        rows, cols = t.sum(axis=1) > 0, t.sum(axis=0) > 0
+        out = (t[np.ix_(rows, cols)], rl[rows], cl[cols])
+        self._counts[key] = out
+        return out
+
+    #
+    # one-way counts from a two-way table already counted
+    def _margin(self, name):
+        for (a, b), (t, al, bl) in self._counts.items():
+            if b is None:
+                continue
+            if a == name and self._complete(b) and len(al) == len(self.factor(a)[1]):
+                return t.sum(axis=1)[:, None]
+            if b == name and self._complete(a) and len(bl) == len(self.factor(b)[1]):
+                return t.sum(axis=0)[:, None]
+        return None
+
+    #
+    # table as pd.crosstab(data[row], data[col] or columns='count',
+    #                      normalize=..., margins=...)
+    def table(self, row, col=None, normalize=False, margins=False,
+              margins_name='All'):
+        t, rl, cl = self.counts(row, col)
+        if normalize is True:
+            normalize = 'all'
+        elif normalize is not False and normalize in (0, 1):
+            normalize = ('index', 'columns')[normalize]
+        rsum, csum, total = t.sum(axis=1), t.sum(axis=0), t.sum()
+        add_row = add_col = margins
+        if normalize == 'all':
+            t, rsum, csum, total = t / total, rsum / total, csum / total, 1.0
+        elif normalize == 'index':
+            t = t / rsum[:, None]
+            csum, add_col = csum / total, False
+        elif normalize == 'columns':
+            t = t / csum[None, :]
+            rsum, add_row = rsum / total, False
+        elif normalize is not False:
+            raise ValueError('unknown normalize: {}'.format(normalize))
+        if add_col:
+            t = np.column_stack([t, rsum])
+            cl = pd.Index(list(cl) + [margins_name], dtype=object)
+        if add_row:
+            t = np.vstack([t, np.r_[csum, total] if add_col else csum])
+            rl = pd.Index(list(rl) + [margins_name], dtype=object)
+        return pd.DataFrame(t, index=pd.Index(rl, name=row),
+                            columns=pd.Index(cl, name='col_0' if col is None else col))
+
+
+#
+# many tables at once; every column is factorized once and
+# two-way tables are counted first so one-way tables can be
+# taken from their margins
+#   specs : list of dicts with keys row, col, normalize, margins
+#           or tuples (row, col)
+def crosstabs(data, specs):
+    specs = [dict(zip(('row', 'col'), s)) if isinstance(s, tuple) else dict(s)
+             for s in specs]
+    tabs = Crosstab(data)
+    for s in sorted(specs, key=lambda s: s.get('col') is None):
+        tabs.counts(s['row'], s.get('col'))
+    return [tabs.table(**s) for s in specs]
@@ -0,0 +1,374 @@
+# ---------------------------------------------------------
+#    derive.py
+#
+#    Declarative derived variables: logs, entity means, lags and
+#    dummies from one spec, built in a few fused passes
+#
+#        spec = Derive('''
+#            lnQ   = log(prod)
+#            lnD   = log(area)
+#            lnD_b = entity_mean(lnD)
+#            lrhat = lag(rhat)
+#            yd    = dummies(year)          # yd_1991, yd_1992, ...
+#            ratio = prod / area
+#        ''', entity='farmid', time='year')
+#        rice = spec.apply(rice)                          # every column
+#        rice = spec.apply(rice, 'lnQ ~ lnD + lnD_b')     # only these
+#        spec.report()                 # rows where a log got x <= 0
+#
+#    The right hand sides are parsed with ast (nothing is eval'ed):
+#       elementwise   + - * / ** with log, exp, sqrt, abs, square
+#       grouped       entity_mean, within, lag, lead, diff  (x, k=1)
+#       dummies       named <name>_<level> as pd.get_dummies(x,
+#                     prefix=name, drop_first=True), bool
+#    A grouped op of an expression, e.g. entity_mean(log(area)),
+#    gets a hidden temporary column.
+#
+#    apply() builds only what the targets need: the derived names
+#    that appear in formula (or columns), and what they depend on;
+#    the others are never computed. The work is done in rounds,
+#    each evaluates every rule whose inputs exist:
+#       f(x) of a column       into one output block for each f
+#                              (every log of the spec together)
+#       other expressions      numpy on the column arrays
+#       entity_mean, within    one PanelIndex reduction of the block
+#       lag, lead, diff        one gather of the block for each k
+#    The panel index is built once (with periods only if a lag is
+#    needed) unless one is passed. Results are columns of
+#    column-major blocks, and the frame returned shares them and
+#    the columns of data (pd.concat, no copies).
+#
+#    Rows where log gets x <= 0 or sqrt x < 0 (-inf or NaN) are
+#    kept in problems, {column: index of the rows}; rows that are
+#    missing already are not counted. A problem inside a hidden
+#    temporary is kept under the column of the spec it is part
+#    of, and report() gives that column's expression as written.
+#
+
+#
+import ast
+
+import numpy as np
+import pandas as pd
+
+from panel_transform import PanelIndex, panel_key
+from categorical import Factor
+
+
+ELEMENTWISE = {'log': np.log, 'exp': np.exp, 'sqrt': np.sqrt,
+               'abs': np.abs, 'square': np.square}
+GROUPED = ('entity_mean', 'within', 'lag', 'lead', 'diff')
+BINOPS = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply,
+          ast.Div: np.true_divide, ast.Pow: np.power}
+#
+# arguments that give -inf or NaN
+DOMAIN = {'log': lambda x: x <= 0, 'sqrt': lambda x: x < 0}
+
+
+#
+# one definition
+#   kind  'unary'    func of the column arg
+#         'expr'     elementwise expression tree
+#         'grouped'  func of the column arg by entity, k periods
+#         'dummies'  indicators of the column arg
+class _Rule:
+
+    def __init__(self, kind, func=None, arg=None, tree=None, k=1):
+        self.kind = kind
+        self.func = func
+        self.arg = arg
+        self.tree = tree
+        self.k = k
+        if tree is None:
+            self.deps = {arg}
+        else:
+            self.deps = _names(tree)
+
+
+def _call(node, names):
+    return isinstance(node, ast.Call) and isinstance(node.func, ast.Name) \
+        and node.func.id in names
+
+
+#
+# variables of an expression, function names left out
+def _names(tree):
+    funcs = {id(n.func) for n in ast.walk(tree) if isinstance(n, ast.Call)}
+    return {n.id for n in ast.walk(tree)
+            if isinstance(n, ast.Name) and id(n) not in funcs}
+
+
+#
+# variables of a formula, term by term since patsy syntax
+# (a:b, C(x, Treatment), I(x**2)) is not all python
+def _formula_names(formula):
+    out = set()
+    for part in formula.replace('~', '+').replace(':', '+').split('+'):
+        try:
+            out |= _names(ast.parse(part.strip(), mode='eval'))
+        except SyntaxError:
+            continue
+    return out
+
+
+class Derive:
+
+    #
+    # spec: 'name = expression' lines (# comments), a dict or
+    # (name, expression) pairs
+    # entity, time: columns or index levels of the data
+    def __init__(self, spec, entity=0, time=1):
+        self.entity = entity
+        self.time = time
+        self.rules = {}
+        self.exprs = {}
+        self.problems = {}
+        self._ntemp = 0
+        self._owner = {}
+        if isinstance(spec, str):
+            lines = [ln.split('#')[0].strip() for ln in spec.splitlines()]
+            spec = [ln.split('=', 1) for ln in lines if ln]
+        elif isinstance(spec, dict):
+            spec = spec.items()
+        for name, expr in spec:
+            name, expr = name.strip(), expr.strip()
+            self.exprs[name] = expr
+            self._target = name
+            self._add(name, ast.parse(expr, mode='eval').body)
+
+    def _add(self, name, node):
+        if _call(node, GROUPED + ('dummies',)):
+            func = node.func.id
+            k = node.args[1].value if len(node.args) > 1 else 1
+            k = {kw.arg: kw.value.value for kw in node.keywords}.get('k', k)
+            kind = 'dummies' if func == 'dummies' else 'grouped'
+            rule = _Rule(kind, func, self._operand(node.args[0]), k=k)
+        elif _call(node, ELEMENTWISE) and len(node.args) == 1 \
+                and isinstance(node.args[0], ast.Name):
+            rule = _Rule('unary', node.func.id, node.args[0].id)
+        else:
+            rule = _Rule('expr', tree=self._expr(node))
+        self.rules[name] = rule
+
+    #
+    # column for an argument, a temporary if it is an expression
+    def _operand(self, node):
+        if isinstance(node, ast.Name):
+            return node.id
+        self._ntemp += 1
+        name = '_t{}'.format(self._ntemp)
+        self._owner[name] = self._target
+        self._add(name, node)
+        return name
+
+    def _expr(self, node):
+        if _call(node, GROUPED):
+            return ast.Name(id=self._operand(node), ctx=ast.Load())
+        if _call(node, ELEMENTWISE):
+            node.args = [self._expr(a) for a in node.args]
+        elif isinstance(node, ast.BinOp) and type(node.op) in BINOPS:
+            node.left, node.right = self._expr(node.left), self._expr(node.right)
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            node.operand = self._expr(node.operand)
+        elif not isinstance(node, (ast.Name, ast.Constant)):
+            raise ValueError('not allowed in a derivation: {}'.format(ast.unparse(node)))
+        return node
+
+    #
+    # derived names asked for, and the dummy columns among them
+    # (None for all of them)
+    def targets(self, formula=None, columns=None):
+        if formula is None and columns is None:
+            return [n for n in self.rules if not n.startswith('_t')], None
+        names = set(columns or [])
+        if formula is not None:
+            names |= _formula_names(formula)
+        out = []
+        for name, rule in self.rules.items():
+            if name in names or rule.kind == 'dummies' and \
+                    any(n.startswith(name + '_') for n in names):
+                out.append(name)
+        return out, names
+
+    #
+    # rules to evaluate for the targets, dependencies first
+    def _needed(self, targets, data):
+        order = []
+
+        def visit(name, path):
+            if name in order:
+                return
+            if name not in self.rules:
+                if name in data.columns or name in data.index.names:
+                    return
+                raise KeyError('{} is neither a column nor derived'.format(name))
+            if name in path:
+                raise ValueError('circular definition of {}'.format(name))
+            for d in sorted(self.rules[name].deps):
+                visit(d, path | {name})
+            order.append(name)
+        for t in targets:
+            visit(t, frozenset())
+        return order
+
+    def _column(self, name, data, new):
+        if name in new:
+            return new[name]
+        return np.asarray(panel_key(data, name), dtype=np.float64)
+
+    def _domain(self, name, func, x, data):
+        if func in DOMAIN:
+            bad = DOMAIN[func](x)
+            if bad.any():
+                name = self._owner.get(name, name)
+                rows = data.index[np.flatnonzero(bad)]
+                if name in self.problems:
+                    rows = self.problems[name].union(rows)
+                self.problems[name] = rows
+
+    def _eval(self, name, node, data, new):
+        if isinstance(node, ast.Name):
+            return self._column(node.id, data, new)
+        if isinstance(node, ast.Constant):
+            return node.value
+        if isinstance(node, ast.UnaryOp):
+            return -self._eval(name, node.operand, data, new)
+        if isinstance(node, ast.BinOp):
+            return BINOPS[type(node.op)](self._eval(name, node.left, data, new),
+                                         self._eval(name, node.right, data, new))
+        x = self._eval(name, node.args[0], data, new)
+        self._domain(name, node.func.id, np.asarray(x), data)
+        return ELEMENTWISE[node.func.id](x)
+
+    #
+    # columns as one column-major (rows x m) block
+    def _block(self, names, data, new):
+        block = np.empty((len(data), len(names)), order='F')
+        for j, n in enumerate(names):
+            block[:, j] = self._column(n, data, new)
+        return block
+
+    #
+    # unary rules in one block per function, then expressions in
+    # dependency order, until no elementwise rule is ready
+    def _elementwise(self, pending, data, new, ready):
+        while True:
+            unary = [n for n in pending if ready(n) and self.rules[n].kind == 'unary']
+            for func in dict.fromkeys(self.rules[n].func for n in unary):
+                names = [n for n in unary if self.rules[n].func == func]
+                out = np.empty((len(data), len(names)), order='F')
+                for j, n in enumerate(names):
+                    x = self._column(self.rules[n].arg, data, new)
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        ELEMENTWISE[func](x, out=out[:, j])
+                    self._domain(n, func, x, data)
+                    new[n] = out[:, j]
+            exprs = 0
+            for n in pending:
+                if ready(n) and self.rules[n].kind == 'expr':
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        out = self._eval(n, self.rules[n].tree, data, new)
+                    new[n] = np.broadcast_to(np.asarray(out, dtype=np.float64),
+                                             (len(data),)).copy()
+                    exprs += 1
+            if not unary and not exprs:
+                return
+
+    #
+    # entity means and within deviations from one reduction of the
+    # block of their arguments, lags, leads and differences from
+    # one gather of the block for each k (kept column-major)
+    def _grouped(self, names, data, new, index):
+        args = list(dict.fromkeys(self.rules[n].arg for n in names))
+        block = self._block(args, data, new)
+        col = {a: j for j, a in enumerate(args)}
+        means, lags = None, {}
+        for n in names:
+            rule = self.rules[n]
+            x = block[:, col[rule.arg]]
+            if rule.func in ('entity_mean', 'within'):
+                if means is None:
+                    missing = np.isnan(block)
+                    sums = index.sums(np.where(missing, 0.0, block))
+                    counts = index.sums((~missing).astype(np.float64))
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        means = (sums / counts).T[:, index.codes].T
+                m = means[:, col[rule.arg]]
+                new[n] = m if rule.func == 'entity_mean' else x - m
+            else:
+                k = -rule.k if rule.func == 'lead' else rule.k
+                if k not in lags:
+                    pos = index.shift(k)
+                    lags[k] = block.T[:, pos].T
+                    lags[k][pos < 0] = np.nan
+                lagged = lags[k][:, col[rule.arg]]
+                new[n] = x - lagged if rule.func == 'diff' else lagged
+
+    #
+    # the frame with the derived columns added
+    #   formula / columns  build only the derived names used there
+    #   index              PanelIndex of the rows of data (entity
+    #                      and periods if lags are needed)
+    #   inplace            add the columns to data itself
+    def apply(self, data, formula=None, columns=None, index=None, inplace=False):
+        targets, names = self.targets(formula, columns)
+        pending = self._needed(targets, data)
+        self.problems = {}
+        new, dummies = {}, {}
+
+        def ready(n):
+            return n not in new and all(d in new or d not in self.rules
+                                        for d in self.rules[n].deps)
+        while pending:
+            self._elementwise(pending, data, new, ready)
+            grouped = [n for n in pending if ready(n) and self.rules[n].kind == 'grouped']
+            if grouped:
+                if index is None:
+                    shifts = any(self.rules[n].kind == 'grouped' and self.rules[n].func
+                                 not in ('entity_mean', 'within') for n in pending)
+                    index = PanelIndex.from_data(data, self.entity,
+                                                 self.time if shifts else None)
+                self._grouped(grouped, data, new, index)
+            for n in pending:
+                if ready(n) and self.rules[n].kind == 'dummies':
+                    arg = self.rules[n].arg
+                    values = new[arg] if arg in new else panel_key(data, arg)
+                    dummies[n] = Factor.from_values(values, prefix=n)
+                    new[n] = None
+            left = [n for n in pending if n not in new]
+            if len(left) == len(pending):
+                raise ValueError('cannot derive {}'.format(', '.join(left)))
+            pending = left
+        cols = {}
+        for n in targets:
+            if n not in dummies:
+                cols[n] = new[n]
+                continue
+            f = dummies[n]
+            for j, c in enumerate(f.names):
+                if names is None or n in names or c in names:
+                    cols[c] = f.cols == j
+        return self._assign(data, cols, inplace)
+
+    #
+    # new columns are views of the computed blocks, columns that
+    # data has already are replaced where they are
+    def _assign(self, data, cols, inplace):
+        if inplace:
+            for c, values in cols.items():
+                data[c] = values
+            return data
+        fresh = {c: v for c, v in cols.items() if c not in data.columns}
+        out = pd.concat([data, pd.DataFrame(fresh, index=data.index, copy=False)],
+                        axis=1)
+        for c in cols:
+            if c not in fresh:
+                out[c] = cols[c]
+        return out
+
+    #
+    # rows with -inf or NaN from a log or sqrt, one line per column
+    def report(self):
+        return pd.DataFrame([(n, self.exprs.get(n), len(rows), list(rows[:5]))
+                             for n, rows in self.problems.items()],
+                            columns=['column', 'expression', 'rows', 'first'])
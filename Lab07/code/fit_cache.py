@@ -0,0 +1,511 @@
+# ---------------------------------------------------------
+#    fit_cache.py
+#
+#    Fitted models kept on disk, keyed by what they depend on
+#
+#        fits = FitCache()                       # ./.fitcache
+#        pom = fits(plm.PooledOLS).from_formula('lfare ~ 1 + concen + C(t)',
+#                                               airf)
+#        por = pom.fit(cov_type='clustered', cluster_entity=True)
+#        por = fits.fit(plm.PooledOLS, 'lfare ~ 1 + concen + C(t)', airf,
+#                       cov_type='clustered', cluster_entity=True)
+#        fer = fits.call(fixed_effects, 'lnQ ~ lnD + lnL', rice)
+#        por.wald_test(formula=['concen=0'])     # as for a fresh fit
+#        plm.panel.compare({'POLS': por, 'RE': rer})
+#
+#    The key is the SHA-1 of the estimator (class or function, and
+#    for one outside linearmodels the contents of its module file),
+#    the formula, the model and fit options (arrays and Series,
+#    e.g. clusters= or weights=, by their contents), the
+#    linearmodels version and the contents of the data the
+#    formula uses: the columns it names (C(t) uses t) and the
+#    index. A changed value, option or spec is a new key; a new
+#    column that the formula does not use is not.
+#
+#    A result is taken apart into its arrays and its scalars:
+#    params, covariance, residuals, fitted values, effects and
+#    indexes go into an .npz file (no pickles; an array that
+#    occurs more than once, e.g. resids and wresids, is stored
+#    once), test statistics, R-squares, counts and names into
+#    JSON inside the same file. Loading builds an object of the
+#    same class with the same fields, so summary, wald_test,
+#    f_statistic and compare() give what the fit gave. Its model
+#    is built from the formula and the data only when something
+#    needs the data (e.g. wild_wald_test); a summary does not.
+#    from_formula() builds the model right away, as linearmodels
+#    does, unless the cache holds a fit of it (with any fit
+#    options): the file name is <model key>-<fit key>.npz.
+#
+#    After every store the least recently used files are removed
+#    until the cache is below max_mb and max_entries (the file
+#    time is set on every hit). PANEL_FIT_CACHE=0 turns the cache
+#    off, every call then fits.
+#
+
+#
+import os
+import sys
+import json
+import hashlib
+import datetime
+import warnings
+import threading
+import importlib
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from derive import _formula_names
+
+
+CACHE = '.fitcache'
+VERSION = 2
+
+
+#
+# model of a cached result: the name of the dependent variable
+# is known, anything else builds the model from the formula
+class _LazyModel:
+
+    def __init__(self, build, kind, dependent):
+        self._build = build
+        self._model = None
+        self.kind = kind
+        self.dependent = _LazyDependent(self, dependent)
+
+    @property
+    def real(self):
+        if self._model is None:
+            if self._build is None:
+                raise ValueError('the model of a cached result is not available')
+            self._model = self._build()
+        return self._model
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.real, name)
+
+    #
+    # pickled (e.g. for a process pool) as the model itself, or as
+    # the same stub when there is nothing to build it from
+    # (results of FitCache.call)
+    def __reduce__(self):
+        if self._model is None and self._build is None:
+            return _LazyModel, (None, self.kind, self.dependent.vars)
+        return _same, (self.real,)
+
+
+def _same(obj):
+    return obj
+
+
+class _LazyDependent:
+
+    def __init__(self, model, names):
+        self._model = model
+        self.vars = list(names)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._model.real.dependent, name)
+
+
+#
+# the model behind a result, built if the result is cached
+def model_of(res):
+    model = res.model
+    return model.real if isinstance(model, _LazyModel) else model
+
+
+#
+# estimator.from_formula(formula, data, **kw) whose fit() looks
+# in the cache first; the model is built here unless the cache
+# has a fit of it, then on first use
+class _Spec:
+
+    def __init__(self, cache, estimator, formula, data, kw):
+        self._cache = cache
+        self._estimator = estimator
+        self._formula = formula
+        self._data = data
+        self._kw = kw
+        self._model = None
+        self._key = None
+        if cache.enabled:
+            self._key = cache.key(estimator, formula, data, {'model': kw})
+        if self._key is None or not cache.has_model(self._key):
+            self._model = estimator.from_formula(formula, data, **kw)
+
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = self._estimator.from_formula(self._formula, self._data,
+                                                       **self._kw)
+        return self._model
+
+    def fit(self, **fit_kw):
+        key = self._key and self._cache.fit_key(self._key, fit_kw)
+        return self._cache._cached(key, lambda: self.model.fit(**fit_kw),
+                                   lambda: self.model)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+
+class _Estimator:
+
+    def __init__(self, cache, estimator):
+        self._cache = cache
+        self._estimator = estimator
+
+    def from_formula(self, formula, data, **kw):
+        return _Spec(self._cache, self._estimator, formula, data, kw)
+
+
+def _class_name(cls):
+    return '{}:{}'.format(cls.__module__, cls.__qualname__)
+
+
+def _class(name):
+    module, qualname = name.split(':')
+    obj = importlib.import_module(module)
+    for part in qualname.split('.'):
+        obj = getattr(obj, part)
+    return obj
+
+
+#
+# a result as JSON and a dict of arrays, arrays with the same
+# contents are stored once
+class _Encoder:
+
+    def __init__(self):
+        self.arrays = {}
+        self._seen = {}
+
+    def array(self, values):
+        values = np.asarray(values)
+        if values.dtype.kind == 'O':
+            values = values.astype(str)
+        h = hashlib.sha1(values.tobytes())
+        h.update('{}{}'.format(values.dtype, values.shape).encode())
+        key = h.hexdigest()
+        if key not in self._seen:
+            name = 'a{}'.format(len(self.arrays))
+            self.arrays[name] = values
+            self._seen[key] = name
+        return self._seen[key]
+
+    def index(self, idx):
+        if isinstance(idx, pd.MultiIndex):
+            return {'t': 'multi', 'names': list(idx.names),
+                    'levels': [self.index(lev) for lev in idx.levels],
+                    'codes': [self.array(c) for c in idx.codes]}
+        return {'t': 'index', 'name': idx.name, 'dtype': str(idx.dtype),
+                'v': self.array(idx.to_numpy())}
+
+    def encode(self, value):
+        if value is None or isinstance(value, (bool, str)):
+            return value
+        if isinstance(value, (int, float, np.integer, np.floating, np.bool_)):
+            return {'t': 'num', 'v': value.item() if hasattr(value, 'item') else value}
+        if isinstance(value, np.ndarray):
+            return {'t': 'array', 'v': self.array(value)}
+        if isinstance(value, pd.DataFrame):
+            return {'t': 'frame', 'v': self.array(value.to_numpy()),
+                    'index': self.index(value.index),
+                    'columns': self.index(value.columns)}
+        if isinstance(value, pd.Series):
+            return {'t': 'series', 'v': self.array(value.to_numpy()), 'name': value.name,
+                    'index': self.index(value.index)}
+        if isinstance(value, pd.Index):
+            return self.index(value)
+        if isinstance(value, datetime.datetime):
+            return {'t': 'datetime', 'v': value.isoformat()}
+        if isinstance(value, list):
+            return {'t': 'list', 'v': [self.encode(v) for v in value]}
+        if isinstance(value, tuple) and hasattr(value, '_fields'):
+            return {'t': 'namedtuple', 'cls': _class_name(type(value)),
+                    'v': [self.encode(v) for v in value]}
+        if isinstance(value, tuple):
+            return {'t': 'tuple', 'v': [self.encode(v) for v in value]}
+        #
+        # test statistics from their constructor arguments
+        if type(value).__name__ == 'WaldTestStatistic':
+            args = [value.stat, value.null, value.df, value.df_denom, value._name]
+        elif type(value).__name__ == 'InvalidTestStatistic':
+            args = [value._reason, value._name]
+        else:
+            raise TypeError('cannot store a {}'.format(type(value).__name__))
+        return {'t': 'object', 'cls': _class_name(type(value)),
+                'v': [self.encode(v) for v in args]}
+
+
+class _Decoder:
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+
+    def index(self, e):
+        if e['t'] == 'multi':
+            return pd.MultiIndex(levels=[self.index(lev) for lev in e['levels']],
+                                 codes=[self.arrays[c] for c in e['codes']],
+                                 names=e['names'])
+        values = self.arrays[e['v']]
+        if e['dtype'] == 'object':
+            values = values.astype(object)
+        return pd.Index(values, name=e['name'], dtype=e['dtype'])
+
+    def decode(self, e):
+        if not isinstance(e, dict):
+            return e
+        t = e['t']
+        if t == 'num':
+            return e['v']
+        if t == 'array':
+            return self.arrays[e['v']]
+        if t == 'frame':
+            return pd.DataFrame(self.arrays[e['v']], index=self.index(e['index']),
+                                columns=self.index(e['columns']))
+        if t == 'series':
+            return pd.Series(self.arrays[e['v']], index=self.index(e['index']),
+                             name=e['name'])
+        if t in ('index', 'multi'):
+            return self.index(e)
+        if t == 'datetime':
+            return datetime.datetime.fromisoformat(e['v'])
+        if t == 'list':
+            return [self.decode(v) for v in e['v']]
+        if t == 'tuple':
+            return tuple(self.decode(v) for v in e['v'])
+        values = [self.decode(v) for v in e['v']]
+        return _class(e['cls'])(*values)
+
+
+#
+# contents of the columns a formula uses (and any others given),
+# and of the index
+def data_digest(data, formula, columns=()):
+    h = hashlib.sha1()
+    names = sorted((_formula_names(formula) | set(columns)) & set(data.columns))
+    cols = [(n, data[n]) for n in names]
+    cols += [('index:{}'.format(j), data.index.get_level_values(j))
+             for j in range(data.index.nlevels)]
+    for name, col in cols:
+        h.update('{}|{}|'.format(name, col.dtype).encode())
+        if getattr(col.dtype, 'kind', 'O') in 'biufcmM':
+            values = col.to_numpy()
+        else:
+            values = pd.util.hash_pandas_object(pd.Series(col), index=False).to_numpy()
+        h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+
+#
+# an option for the key: arrays, Series and frames (clusters=,
+# weights=, other_effects=) by their contents and index, since
+# their repr is cut short; lists, tuples and dicts item by item
+def option_digest(value):
+    if isinstance(value, (pd.Series, pd.DataFrame, pd.Index, np.ndarray)):
+        h = hashlib.sha1(type(value).__name__.encode())
+        h.update(repr(getattr(value, 'shape', None)).encode())
+        if isinstance(value, np.ndarray) and value.dtype.kind in 'biufcmM':
+            h.update(str(value.dtype).encode())
+            h.update(np.ascontiguousarray(value).tobytes())
+        else:
+            if isinstance(value, np.ndarray):
+                value = pd.DataFrame(value.reshape(len(value), -1))
+            h.update(repr(getattr(value, 'columns', getattr(value, 'name', None))).encode())
+            h.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        return 'sha1:' + h.hexdigest()
+    if isinstance(value, (list, tuple)):
+        return [type(value).__name__] + [option_digest(v) for v in value]
+    if isinstance(value, dict):
+        return sorted((repr(k), option_digest(v)) for k, v in value.items())
+    return repr(value)
+
+
+#
+# contents of the file that defines a function or estimator
+# outside linearmodels (e.g. fixed_effects in panel_transform.py),
+# so that a change to it, or to a helper next to it, is a new key;
+# linearmodels is covered by its version
+_code_digests = {}
+
+
+def _code_digest(obj):
+    module = sys.modules.get(getattr(obj, '__module__', None))
+    path = getattr(module, '__file__', None)
+    if path is None or module.__name__.split('.')[0] == 'linearmodels':
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    stamp = (path, st.st_size, st.st_mtime_ns)
+    if stamp not in _code_digests:
+        with open(path, 'rb') as f:
+            _code_digests[stamp] = hashlib.sha1(f.read()).hexdigest()
+    return _code_digests[stamp]
+
+
+def _versions():
+    try:
+        import linearmodels
+        return linearmodels.__version__
+    except ImportError:
+        return None
+
+
+class FitCache:
+
+    #
+    # folder  : default .fitcache in the working directory
+    # max_mb, max_entries : limits kept by removing the least
+    #           recently used results
+    def __init__(self, folder=None, max_mb=256, max_entries=500, enabled=None):
+        self.folder = CACHE if folder is None else folder
+        self.max_bytes = max_mb * 2**20
+        self.max_entries = max_entries
+        if enabled is None:
+            enabled = os.environ.get('PANEL_FIT_CACHE', '1') not in ('', '0')
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    #
+    # key of the model, and of a fit of it
+    def key(self, estimator, formula, data, options):
+        spec = [VERSION, _versions(), _class_name(estimator), _code_digest(estimator),
+                formula,
+                sorted((k, option_digest(v)) for k, v in options.items()),
+                data_digest(data, formula)]
+        return hashlib.sha1(json.dumps(spec).encode()).hexdigest()
+
+    def fit_key(self, key, fit_kw):
+        spec = sorted((k, option_digest(v)) for k, v in fit_kw.items())
+        return '{}-{}'.format(key, hashlib.sha1(json.dumps(spec).encode()).hexdigest())
+
+    def _path(self, key):
+        return os.path.join(self.folder, key + '.npz')
+
+    #
+    # some fit of the model is stored
+    def has_model(self, key):
+        if not os.path.isdir(self.folder):
+            return False
+        return any(name.startswith(key + '-') and '.tmp' not in name
+                   for name in os.listdir(self.folder))
+
+    #
+    # fits(plm.PooledOLS).from_formula(formula, data).fit(**fit_kw)
+    # as the plain linearmodels calls
+    def __call__(self, estimator):
+        return _Estimator(self, estimator)
+
+    #
+    # the same in one call
+    def fit(self, estimator, formula, data, model_kw=None, **fit_kw):
+        return self(estimator).from_formula(formula, data, **(model_kw or {})).fit(**fit_kw)
+
+    #
+    # a function func(formula, data, *args, **kw) that returns a
+    # fitted model, e.g. fixed_effects in panel_transform.py
+    def call(self, func, formula, data, *args, **kw):
+        key = None
+        if self.enabled:
+            key = self.fit_key(self.key(func, formula, data, {'args': args, 'kw': kw}), {})
+        return self._cached(key, lambda: func(formula, data, *args, **kw), None)
+
+    def _cached(self, key, run, build):
+        if key is None:
+            return run()
+        path = self._path(key)
+        if os.path.exists(path):
+            #
+            # a file that cannot be read is fitted again
+            try:
+                res = self.load(path, build)
+                os.utime(path)
+                self.hits += 1
+                return res
+            except Exception:
+                pass
+        self.misses += 1
+        res = run()
+        try:
+            self.store(res, path)
+        except TypeError as e:
+            warnings.warn('{} result not cached: {}'.format(
+                type(res).__name__, e), RuntimeWarning, stacklevel=3)
+            return res
+        self.evict()
+        return res
+
+    def store(self, res, path):
+        enc = _Encoder()
+        fields = {}
+        if '_deferred_cov' in vars(res):
+            cov = res.cov.to_numpy()
+        for name, value in list(vars(res).items()):
+            if name == 'model':
+                fields[name] = {'t': 'model', 'kind': type(value).__name__,
+                                'dependent': list(value.dependent.vars)}
+            elif name == '_deferred_cov':
+                fields[name] = {'t': 'cov', 'v': enc.array(cov)}
+            else:
+                fields[name] = enc.encode(value)
+        meta = {'cls': _class_name(type(res)), 'fields': fields}
+        os.makedirs(self.folder, exist_ok=True)
+        tmp = path + '.tmp{}-{}.npz'.format(os.getpid(), threading.get_ident())
+        np.savez(tmp, meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+                 **enc.arrays)
+        os.replace(tmp, path)
+
+    def load(self, path, build=None):
+        with np.load(path, allow_pickle=False) as f:
+            arrays = {k: f[k] for k in f.files}
+        meta = json.loads(arrays.pop('meta').tobytes().decode())
+        dec = _Decoder(arrays)
+        cls = _class(meta['cls'])
+        res = cls.__new__(cls)
+        for name, e in meta['fields'].items():
+            if isinstance(e, dict) and e['t'] == 'model':
+                value = _LazyModel(build, e['kind'], e['dependent'])
+            elif isinstance(e, dict) and e['t'] == 'cov':
+                value = partial(_same, arrays[e['v']])
+            else:
+                value = dec.decode(e)
+            setattr(res, name, value)
+        return res
+
+    #
+    # least recently used results removed until within the limits
+    def evict(self):
+        files = []
+        for name in os.listdir(self.folder):
+            if name.endswith('.npz') and '.tmp' not in name:
+                try:
+                    st = os.stat(os.path.join(self.folder, name))
+                except FileNotFoundError:
+                    continue
+                files.append((st.st_mtime, st.st_size, name))
+        files.sort()
+        total = sum(f[1] for f in files)
+        while files and (total > self.max_bytes or len(files) > self.max_entries):
+            _, size, name = files.pop(0)
+            try:
+                os.remove(os.path.join(self.folder, name))
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        for name in os.listdir(self.folder) if os.path.isdir(self.folder) else []:
+            if name.endswith('.npz'):
+                os.remove(os.path.join(self.folder, name))
@@ -0,0 +1,220 @@
+# ---------------------------------------------------------
+#    hdfe.py
+#
+#    Linear models with any number of absorbed fixed effects
+#
+#        hdfe('lfare ~ concen | id + year', airf)
+#        hdfe('lwage ~ union + married + exper | nr + year + occ', wage)
+#
+#    Regressors and the dependent variable are projected off all
+#    fixed effects by alternating projections: one sweep subtracts
+#    the group means of each effect in turn (np.bincount, no
+#    dummy columns), and the sweeps are accelerated with the
+#    Irons-Tuck (1969) extrapolation used by fixest. Memory is a
+#    few copies of the (n x K) data plus one array per effect with
+#    its group counts.
+#
+#    Degrees of freedom absorbed by the effects
+#       first effect       : number of levels
+#       second effect      : levels - connected components of the
+#                            bipartite graph of the first two (exact)
+#       further effects    : levels - 1 (conservative)
+#    Effects nested within the cluster variable are not counted in
+#    the clustered small sample correction. Regressors that are
+#    absorbed by the effects (e.g. exper with nr + year) are
+#    dropped and listed in the result. If the projections do not
+#    converge within maxiter sweeps a RuntimeWarning is issued
+#    and the result has converged=False.
+#
+
+#
+import warnings
+
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from panel_transform import PanelFit
+from cluster_cov import cluster_codes, cluster_scores
+
+
+#
+# one fixed effect, integer coded
+class FixedEffect:
+
+    def __init__(self, name, values):
+        self.name = name
+        self.codes, self.levels = pd.factorize(np.asarray(values), sort=True)
+        self.counts = np.bincount(self.codes).astype(np.float64)
+
+    @property
+    def nlevels(self):
+        return len(self.counts)
+
+    #
+    # group means of every column, repeated for each row
+    def means(self, X):
+        out = np.empty_like(X)
+        for j in range(X.shape[1]):
+            out[:, j] = (np.bincount(self.codes, X[:, j], minlength=self.nlevels)
+                         / self.counts)[self.codes]
+        return out
+
+
+def _sweep(X, effects):
+    X = X.copy()
+    for fe in effects:
+        X -= fe.means(X)
+    return X
+
+
+#
+# residuals of all columns of X on the fixed effects, the number
+# of sweeps and whether the change fell below tol
+def demean_hdfe(X, effects, tol=1e-10, maxiter=10000, accelerate=True):
+    X = np.asarray(X, dtype=np.float64)
+    if len(effects) == 1:
+        return X - effects[0].means(X), 1, True
+    scale = np.maximum(np.abs(X).max(axis=0), 1.0)
+    it = 0
+    while it < maxiter:
+        it += 1
+        GX = _sweep(X, effects)
+        if accelerate:
+            GGX = _sweep(GX, effects)
+            d1 = GGX - GX
+            d2 = d1 - (GX - X)
+            den = (d2 * d2).sum(axis=0)
+            coef = np.divide((d1 * d2).sum(axis=0), den,
+                             out=np.zeros_like(den), where=den > 0)
+            new = GGX - coef * d1
+        else:
+            new = GX
+        change = (np.abs(new - X).max(axis=0) / scale).max()
+        X = new
+        if change < tol:
+            return X, it, True
+    warnings.warn('fixed effects not absorbed after {} sweeps (relative change '
+                  '{:.2e} > tol {:.0e}); the estimates are not reliable'.format(
+                      it, change, tol), RuntimeWarning, stacklevel=2)
+    return X, it, False
+
+
+#
+# degrees of freedom taken by each fixed effect
+def absorbed_df(effects):
+    df = [effects[0].nlevels]
+    if len(effects) > 1:
+        a, b = effects[0], effects[1]
+        n = len(a.codes)
+        graph = sparse.coo_matrix((np.ones(n), (a.codes, a.nlevels + b.codes)),
+                                  shape=(a.nlevels + b.nlevels,) * 2)
+        ncomp = connected_components(graph, directed=False)[0]
+        df.append(b.nlevels - ncomp)
+        df.extend(fe.nlevels - 1 for fe in effects[2:])
+    return df
+
+
+def _nested(fe, clusters):
+    pairs = np.unique(fe.codes.astype(np.int64) * (clusters.max() + 1) + clusters)
+    return len(pairs) == fe.nlevels
+
+
+class HDFEFit(PanelFit):
+
+    def __init__(self, params, cov, resids, nobs, cov_type, effects,
+                 df_absorbed, df_resid, iterations, dropped=(), converged=True):
+        super().__init__('HDFE', params, cov, resids, nobs)
+        self.cov_type = cov_type
+        self.effects = [fe.name for fe in effects]
+        self.nlevels = {fe.name: fe.nlevels for fe in effects}
+        self.df_absorbed = df_absorbed
+        self.df_resid = df_resid
+        self.iterations = iterations
+        self.converged = converged
+        self.dropped = list(dropped)
+
+    def __str__(self):
+        return ('Absorbed effects: {} (levels {})\n'
+                'Absorbed df: {}, residual df: {}, iterations: {}{}\n'
+                'Dropped (absorbed): {}\n'
+                'Covariance: {}\n{}'.format(
+                    ' + '.join(self.effects), self.nlevels, self.df_absorbed,
+                    self.df_resid, self.iterations,
+                    '' if self.converged else ' (NOT CONVERGED)',
+                    self.dropped or 'none',
+                    self.cov_type,
+                    pd.DataFrame({'params': self.params,
+                                  'std_errors': self.std_errors,
+                                  'tstats': self.tstats})))
+
+
+#
+# data as a flat frame: index levels become columns unless a
+# column of the same name exists
+def _flat(data):
+    names = [n for n in data.index.names if n is not None]
+    keep = [n for n in names if n not in data.columns]
+    if not names:
+        return data.reset_index(drop=True)
+    drop = [n for n in names if n in data.columns]
+    flat = data.reset_index(level=keep) if keep else data
+    if drop:
+        flat = flat.reset_index(level=drop, drop=True)
+    return flat.reset_index(drop=True)
+
+
+#
+# estimate 'y ~ x1 + x2 | fe1 + fe2 + ...'
+#   cov_type : 'unadjusted', 'robust' or 'clustered'
+#   cluster  : column used for clustering, default first effect
+def hdfe(formula, data, cov_type='clustered', cluster=None, tol=1e-10,
+         maxiter=10000):
+    model, absorb = formula.split('|')
+    fe_names = [t.strip() for t in absorb.split('+') if t.strip()]
+    frame = _flat(data)
+    y, X = patsy.dmatrices(model, frame, return_type='dataframe')
+    X = X.drop(columns='Intercept', errors='ignore')
+    rows = y.index.to_numpy()
+    effects = [FixedEffect(n, frame[n].to_numpy()[rows]) for n in fe_names]
+
+    Z, iterations, converged = demean_hdfe(np.column_stack([y.to_numpy(), X.to_numpy()]),
+                                effects, tol=tol, maxiter=maxiter)
+    yd, Xd = Z[:, 0], Z[:, 1:]
+    Xc = X.to_numpy() - X.to_numpy().mean(axis=0)
+    kept = (Xd ** 2).sum(axis=0) > 1e-9 * np.maximum((Xc ** 2).sum(axis=0), 1e-300)
+    dropped = [c for c, k in zip(X.columns, kept) if not k]
+    Xd = Xd[:, kept]
+    names = [c for c, k in zip(X.columns, kept) if k]
+    n, k = Xd.shape
+    params = np.linalg.lstsq(Xd, yd, rcond=None)[0]
+    e = yd - Xd @ params
+    xpxi = np.linalg.inv(Xd.T @ Xd)
+    df_fe = absorbed_df(effects)
+    df_a = sum(df_fe)
+    df_resid = n - k - df_a
+
+    if cov_type == 'unadjusted':
+        cov = xpxi * (e @ e) / df_resid
+    elif cov_type == 'robust':
+        xe = Xd * e[:, None]
+        cov = n / df_resid * xpxi @ (xe.T @ xe) @ xpxi
+    elif cov_type == 'clustered':
+        cname = fe_names[0] if cluster is None else cluster
+        clusters, G = cluster_codes(frame[cname].to_numpy()[rows])
+        s = cluster_scores(Xd * e[:, None], clusters, G)
+        #
+        # effects nested in the clusters do not reduce the df
+        df_nn = sum(df for fe, df in zip(effects, df_fe)
+                    if not _nested(fe, clusters))
+        scale = G / (G - 1) * (n - 1) / (n - k - df_nn)
+        cov = scale * xpxi @ (s.T @ s) @ xpxi
+    else:
+        raise ValueError('unknown cov_type: {}'.format(cov_type))
+
+    return HDFEFit(pd.Series(params, index=names),
+                   pd.DataFrame(cov, index=names, columns=names),
+                   e, n, cov_type, effects, df_a, df_resid, iterations,
+                   dropped, converged)
@@ -0,0 +1,220 @@
+# ---------------------------------------------------------
+#    instrument.py
+#
+#    Stage timings for the panel scripts and modules
+#
+#        from instrument import stage, timed
+#
+#        with stage('load') as s:
+#            rice = pd.read_csv('./rice3.csv')
+#            s.set(rows=len(rice), cols=rice.shape[1])
+#
+#        @timed('design')
+#        def panel_design(formula, data): ...
+#
+#    Nothing is recorded until a recorder is enabled, either in
+#    code
+#        enable('run.jsonl', chrome='run.trace.json', memory=True)
+#    or from the environment for an unchanged script
+#        PANEL_TRACE=run.jsonl PANEL_TRACE_CHROME=run.trace.json \
+#            python panel_clab.py
+#    (PANEL_TRACE_MEMORY=1 adds allocations). While disabled a
+#    stage is a shared no-op object and a timed function makes one
+#    extra check before calling through.
+#
+#    Each stage gives one event with its wall and CPU time, the
+#    nesting depth and parent stage, the thread, rows and columns
+#    (set by hand, or the shape of what a timed function returns)
+#    and with memory on, the net and peak tracemalloc allocation
+#    in MB. Events go to a JSON lines file as they end, and to a
+#    Chrome trace file (chrome://tracing, ui.perfetto.dev) when
+#    the recorder is closed.
+#
+
+#
+import os
+import json
+import time
+import atexit
+import threading
+import functools
+import tracemalloc
+
+
+class _NoStage:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def set(self, **fields):
+        pass
+
+
+_NOSTAGE = _NoStage()
+_recorder = None
+
+
+class _Stage:
+
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __enter__(self):
+        rec = self.recorder
+        stack = rec._stack()
+        self.parent = stack[-1].name if stack else None
+        self.depth = len(stack)
+        if rec.memory:
+            cur, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            tracemalloc.reset_peak()
+            self.mem, self.peak = cur, cur
+        stack.append(self)
+        self.cpu = time.process_time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self.start
+        cpu = time.process_time() - self.cpu
+        rec = self.recorder
+        stack = rec._stack()
+        stack.pop()
+        event = {'name': self.name, 'ts': self.start - rec.t0, 'wall': wall,
+                 'cpu': cpu, 'depth': self.depth, 'parent': self.parent,
+                 'thread': threading.get_ident()}
+        if rec.memory:
+            cur, peak = tracemalloc.get_traced_memory()
+            peak = max(self.peak, peak)
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            event['alloc_mb'] = (cur - self.mem) / 2**20
+            event['peak_mb'] = (peak - self.mem) / 2**20
+        if exc[0] is not None:
+            event['error'] = exc[0].__name__
+        event.update(self.fields)
+        rec.emit(event)
+        return False
+
+
+class Recorder:
+
+    def __init__(self, path=None, chrome=None, memory=False):
+        self.path = path
+        self.chrome = chrome
+        self.memory = memory
+        self.events = []
+        self.t0 = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._file = open(path, 'w') if path else None
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def stage(self, name, **fields):
+        return _Stage(self, name, fields)
+
+    def emit(self, event):
+        with self._lock:
+            self.events.append(event)
+            if self._file:
+                self._file.write(json.dumps(event, default=str) + '\n')
+                self._file.flush()
+
+    #
+    # complete ('X') events of the Chrome trace event format,
+    # times in microseconds
+    def chrome_trace(self):
+        pid = os.getpid()
+        keys = ('name', 'ts', 'wall', 'thread')
+        return {'traceEvents': [
+            {'name': e['name'], 'ph': 'X', 'pid': pid, 'tid': e['thread'],
+             'ts': 1e6 * e['ts'], 'dur': 1e6 * e['wall'],
+             'args': {k: v for k, v in e.items() if k not in keys}}
+            for e in self.events], 'displayTimeUnit': 'ms'}
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.chrome:
+            with open(self.chrome, 'w') as f:
+                json.dump(self.chrome_trace(), f, default=str)
+        if self.memory:
+            tracemalloc.stop()
+
+
+def enable(path=None, chrome=None, memory=False):
+    global _recorder
+    disable()
+    _recorder = Recorder(path, chrome, memory)
+    return _recorder
+
+
+def disable():
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+    _recorder = None
+
+
+def enabled():
+    return _recorder is not None
+
+
+def stage(name, **fields):
+    if _recorder is None:
+        return _NOSTAGE
+    return _recorder.stage(name, **fields)
+
+
+#
+# rows and columns of a result with a shape (arrays, frames),
+# or of the first matrix in a tuple of results
+def _shape(out):
+    if isinstance(out, tuple):
+        mats = [o for o in out if len(getattr(o, 'shape', ())) == 2]
+        out = mats[0] if mats else None
+    shape = getattr(out, 'shape', None)
+    if not isinstance(shape, tuple) or not shape:
+        return {}
+    return {'rows': shape[0], 'cols': shape[1] if len(shape) > 1 else 1}
+
+
+def timed(name=None):
+    def wrap(func):
+        label = name or func.__qualname__
+
+        @functools.wraps(func)
+        def inner(*args, **kw):
+            if _recorder is None:
+                return func(*args, **kw)
+            with _recorder.stage(label) as s:
+                out = func(*args, **kw)
+                s.set(**_shape(out))
+            return out
+        return inner
+    return wrap
+
+
+#
+# switched on from the environment
+if os.environ.get('PANEL_TRACE') or os.environ.get('PANEL_TRACE_CHROME'):
+    enable(os.environ.get('PANEL_TRACE') or None,
+           os.environ.get('PANEL_TRACE_CHROME') or None,
+           os.environ.get('PANEL_TRACE_MEMORY', '') not in ('', '0'))
+    atexit.register(disable)
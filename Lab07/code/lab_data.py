@@ -0,0 +1,244 @@
+# ---------------------------------------------------------
+#    lab_data.py
+#
+#    One loader for the Lab07 data files with a columnar cache
+#
+#        rice = load_data('./rice3.csv')
+#        rice = load_data('./rice.txt')           # same names as rice3.csv
+#        wage = load_data('./wagepan.dta')
+#        airf = load_data('woo:airfare')          # wooldridge data set
+#
+#    The first load parses the source (csv, whitespace separated
+#    txt, dta, xls or a wooldridge data set) and writes every
+#    column to its own .npy file in .datacache/<name>-<hash>/,
+#    where hash is the SHA-1 of the source bytes and the reader
+#    options. Text columns are stored as int32 codes with their
+#    levels, categoricals keep their categories. Later loads
+#    memory-map the .npy files, so a load costs a few file opens
+#    and the columns of the DataFrame are views of the cache
+#    (read-only; pass mmap=False for a writable copy, or assign
+#    new columns as the lab scripts do). The hash of a file is
+#    remembered with its size and modification time, so an
+#    unchanged file is not read again to find its cache.
+#
+#    rice.txt uses the original upper-case names and numbers the
+#    years 1..8; these are mapped to the names of rice2.csv and
+#    rice3.csv (FMERCODE -> farmid, YEARDUM -> year as 1990..1997,
+#    PROD -> prod, AREA -> area, LABOR -> labor, NPK -> fert,
+#    EDYRS -> educ, other names in lower case).
+#
+#    With compact=True the columns are stored in the narrowest
+#    type that gives the same results (compact_dtypes):
+#       0/1 indicators      int8
+#       entity ids          categorical (int16/int32 codes)
+#       other integers      int32 when they fit (also the year)
+#       floats              float32 only if float32=True (or a
+#                           list of columns), this rounds the data
+#    Other integers are not narrowed below int32, since numpy
+#    ufuncs on int8/int16 give float16/float32 (np.log(educ)
+#    would lose precision) and integer arithmetic wraps around
+#    (year*year in int16); from int32 they give float64. The
+#    indicators are meant for formulas and sums (pandas sums in
+#    int64); scaling one by hand, e.g. union*1000, needs an
+#    astype first. The
+#    estimators cast to float64 where they compute (patsy, the
+#    entity sums of PanelIndex, PanelMoments), so the estimates
+#    are unchanged. wagepan.csv takes about a fifth of the memory.
+#
+
+#
+import os
+import json
+import time
+import shutil
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+
+CACHE = '.datacache'
+IDS = ['farmid', 'nr', 'id']
+
+#
+# changes when compact_dtypes stores a column differently, so
+# older compact caches are not used
+COMPACT_VERSION = 2
+
+RICE_NAMES = {'FMERCODE': 'farmid', 'YEARDUM': 'year', 'PROD': 'prod',
+              'AREA': 'area', 'LABOR': 'labor', 'NPK': 'fert', 'EDYRS': 'educ'}
+RICE_FIRST_YEAR = 1990
+
+
+def _woo_path(name):
+    import wooldridge
+    return os.path.join(os.path.dirname(wooldridge.__file__), 'datasets',
+                        name + '.csv.bz2')
+
+
+#
+# file behind a source and the function that parses it
+def _reader(source, read_kw):
+    if source.startswith('woo:'):
+        name = source[4:]
+
+        def read():
+            import wooldridge as woo
+            return woo.dataWoo(name)
+        return _woo_path(name), read
+    ext = os.path.splitext(source)[1].lower()
+    if ext == '.txt':
+        kw = dict({'sep': r'\s+'}, **read_kw)
+        return source, lambda: pd.read_csv(source, **kw)
+    if ext == '.dta':
+        return source, lambda: pd.read_stata(source, **read_kw)
+    if ext in ('.xls', '.xlsx'):
+        return source, lambda: pd.read_excel(source, **read_kw)
+    return source, lambda: pd.read_csv(source, **read_kw)
+
+
+#
+# rice.txt names and years as in rice2.csv / rice3.csv
+def normalize(data):
+    if 'FMERCODE' not in data.columns:
+        return data
+    data = data.rename(columns=lambda c: RICE_NAMES.get(c, c.lower()))
+    data['year'] = data['year'] + (RICE_FIRST_YEAR - 1)
+    return data
+
+
+#
+# narrowest safe dtypes, see above
+def compact_dtypes(data, ids=None, float32=False):
+    ids = [c for c in IDS if c in data.columns] if ids is None else list(ids)
+    if float32 is True:
+        float32 = [c for c in data.columns if data[c].dtype == np.float64]
+    out = {}
+    for name, col in data.items():
+        kind = col.dtype.kind
+        if name in ids:
+            col = col.astype('category')
+        elif kind in 'iub' and len(col):
+            lo, hi = col.min(), col.max()
+            if kind == 'b':
+                pass
+            elif lo >= 0 and hi <= 1:
+                col = col.astype(np.int8)
+            elif np.iinfo(np.int32).min <= lo and hi <= np.iinfo(np.int32).max:
+                col = col.astype(np.int32)
+        elif name in (float32 or []) and kind == 'f':
+            col = col.astype(np.float32)
+        out[name] = col
+    return pd.DataFrame(out, index=data.index)
+
+
+def _file_hash(path, cache):
+    st = os.stat(path)
+    stamp = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    known = os.path.join(cache, 'hashes.json')
+    hashes = {}
+    if os.path.exists(known):
+        with open(known) as f:
+            hashes = json.load(f)
+    key = '|'.join(map(str, stamp))
+    if key not in hashes:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 22), b''):
+                h.update(block)
+        hashes[key] = h.hexdigest()
+        os.makedirs(cache, exist_ok=True)
+        tmp = known + '.{}'.format(os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(hashes, f)
+        os.replace(tmp, known)
+    return hashes[key]
+
+
+def _key(source, read_kw, options, cache):
+    path, _ = _reader(source, read_kw)
+    h = hashlib.sha1(_file_hash(path, cache).encode())
+    h.update(json.dumps([sorted(read_kw.items()), options], default=str).encode())
+    stem = os.path.basename(source[4:] if source.startswith('woo:') else source)
+    return '{}-{}'.format(stem.replace('.', '_'), h.hexdigest()[:16])
+
+
+#
+# columns of a frame as .npy files plus meta.json
+def write_cache(data, folder, source=None):
+    tmp = folder + '.tmp{}'.format(os.getpid())
+    os.makedirs(tmp, exist_ok=True)
+    cols = []
+    for j, (name, col) in enumerate(data.items()):
+        entry = {'name': name, 'file': 'c{}.npy'.format(j)}
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            entry.update(kind='category', ordered=bool(col.cat.ordered),
+                         levels=col.cat.categories.tolist())
+            values = col.cat.codes.to_numpy(np.int32)
+        elif col.dtype.kind in 'biufcmM':
+            entry.update(kind='array', dtype=str(col.dtype))
+            values = col.to_numpy()
+        else:
+            codes, levels = pd.factorize(col, sort=True)
+            entry.update(kind='text', dtype=str(col.dtype), levels=levels.tolist())
+            values = codes.astype(np.int32)
+        np.save(os.path.join(tmp, entry['file']), values)
+        cols.append(entry)
+    meta = {'source': source, 'rows': len(data), 'columns': cols,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S')}
+    with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1, default=str)
+    if os.path.exists(folder):
+        shutil.rmtree(tmp)
+    else:
+        os.replace(tmp, folder)
+    return folder
+
+
+#
+# frame from a cache folder; columns are views of the .npy files
+# with mmap=True
+def read_cache(folder, columns=None, mmap=True):
+    with open(os.path.join(folder, 'meta.json')) as f:
+        meta = json.load(f)
+    entries = meta['columns']
+    if columns is not None:
+        entries = [e for e in entries if e['name'] in columns]
+    out = {}
+    for e in entries:
+        values = np.load(os.path.join(folder, e['file']),
+                         mmap_mode='r' if mmap else None).view(np.ndarray)
+        if e['kind'] == 'category':
+            values = pd.Categorical.from_codes(values, e['levels'],
+                                               ordered=e['ordered'])
+        elif e['kind'] == 'text':
+            levels = np.array(e['levels'] + [None], dtype=object)
+            values = pd.array(levels[values], dtype=e['dtype'])
+        out[e['name']] = values
+    return pd.DataFrame(out, copy=False)
+
+
+def cache_folder(source, cache=None, normalize_names=True, compact=False,
+                 float32=False, **read_kw):
+    if cache is None:
+        base = '.' if source.startswith('woo:') else os.path.dirname(source)
+        cache = os.path.join(base or '.', CACHE)
+    options = normalize_names if not (compact or float32) else \
+        [normalize_names, compact, float32, COMPACT_VERSION]
+    return os.path.join(cache, _key(source, read_kw, options, cache))
+
+
+#
+# the data set of a source, parsed once and then memory-mapped
+def load_data(source, columns=None, mmap=True, cache=None, normalize_names=True,
+              compact=False, float32=False, **read_kw):
+    folder = cache_folder(source, cache, normalize_names, compact, float32,
+                          **read_kw)
+    if not os.path.exists(os.path.join(folder, 'meta.json')):
+        data = _reader(source, read_kw)[1]()
+        if normalize_names:
+            data = normalize(data)
+        if compact or float32:
+            data = compact_dtypes(data, float32=float32)
+        write_cache(data, folder, source)
+    return read_cache(folder, columns, mmap)
@@ -0,0 +1,198 @@
+# ---------------------------------------------------------
+#    model_graph.py
+#
+#    Models, derived data and tests as a graph of nodes, with
+#    the independent ones run at the same time
+#
+#        g = ModelGraph()
+#        g.add('rice', load_rice)
+#        g.add('POLS', fit_pols, 'rice')          # fit_pols(rice)
+#        g.add('rlag', add_lrhat, 'rice', 'POLS') # add_lrhat(rice, pols)
+#        g.add('FE', fit_fe, 'rlag')
+#        g.add('RE', fit_re, 'rlag')
+#        res = g.run(workers=4)                   # {name: result}
+#        g.report()                               # times, critical path
+#
+#    A node is a function of the results of the nodes it depends
+#    on, in the order given. run() starts every node whose inputs
+#    are done, on a thread pool by default, so all nodes share the
+#    data in memory (a node must not change its inputs: return a
+#    new frame, e.g. from Derive.apply or data.assign, which share
+#    the unchanged columns). pool='process', or any
+#    concurrent.futures executor, also works when the functions,
+#    inputs and results can be pickled; each process then gets its
+#    own copy of the inputs. Only the nodes the targets need are
+#    run. The first error stops the run and is raised with the
+#    name of its node.
+#
+#    Each node is a stage (instrument.py) named node with field
+#    node=<name>, so a Chrome trace shows what ran in parallel.
+#    After a run, times has the wall time of every node and
+#    critical_path() the longest chain of dependent nodes: the
+#    shortest wall time any schedule can reach with these times.
+#
+
+#
+import time
+import concurrent.futures as cf
+
+from instrument import stage
+
+
+class ModelGraph:
+
+    def __init__(self):
+        self.nodes = {}
+        self.times = {}
+        self.wall = None
+
+    def add(self, name, func, *deps):
+        if name in self.nodes:
+            raise ValueError('node {} is defined twice'.format(name))
+        self.nodes[name] = (func, list(deps))
+        return name
+
+    #
+    # the same as a decorator
+    #   @g.node('FE', 'rlag')
+    #   def fe(rlag): ...
+    def node(self, name, *deps):
+        def wrap(func):
+            self.add(name, func, *deps)
+            return func
+        return wrap
+
+    #
+    # nodes needed for the targets, dependencies first
+    def order(self, targets=None):
+        out, state = [], {}
+
+        def visit(name, path):
+            if name not in self.nodes:
+                raise KeyError('{} depends on {}, which is not a node'.format(
+                    path[-1], name) if path else 'no node {}'.format(name))
+            if state.get(name) == 'done':
+                return
+            if state.get(name) == 'visiting':
+                raise ValueError('cycle: {}'.format(' -> '.join(path + [name])))
+            state[name] = 'visiting'
+            for d in self.nodes[name][1]:
+                visit(d, path + [name])
+            state[name] = 'done'
+            out.append(name)
+        for t in self.nodes if targets is None else targets:
+            visit(t, [])
+        return out
+
+    #
+    # results of the targets (all nodes by default) and what they
+    # need; done holds results known already, these nodes are not
+    # run again
+    #   workers : pool size (None: as concurrent.futures chooses,
+    #             1 runs in order in this thread)
+    #   pool    : 'thread', 'process' or an executor
+    def run(self, targets=None, workers=None, pool='thread', done=None):
+        results = dict(done or {})
+        todo = [n for n in self.order(targets) if n not in results]
+        self.times = {}
+        t0 = time.perf_counter()
+        if workers == 1 and pool == 'thread':
+            for name in todo:
+                results[name] = self._call(name, results)
+        else:
+            self._schedule(todo, results, workers, pool)
+        self.wall = time.perf_counter() - t0
+        return results
+
+    def _call(self, name, results):
+        func, deps = self.nodes[name]
+        start = time.perf_counter()
+        try:
+            with stage('node', node=name):
+                out = func(*[results[d] for d in deps])
+        except Exception as e:
+            e.add_note('in node {}'.format(name))
+            raise
+        self.times[name] = time.perf_counter() - start
+        return out
+
+    def _schedule(self, todo, results, workers, pool):
+        if pool == 'thread':
+            executor = cf.ThreadPoolExecutor(workers)
+        elif pool == 'process':
+            executor = cf.ProcessPoolExecutor(workers)
+        else:
+            executor = pool
+        waiting = list(todo)
+        running = {}
+        try:
+            while waiting or running:
+                for name in [n for n in waiting
+                             if all(d in results for d in self.nodes[n][1])]:
+                    waiting.remove(name)
+                    running[self._submit(executor, pool, name, results)] = name
+                finished, _ = cf.wait(running, return_when=cf.FIRST_COMPLETED)
+                for fut in finished:
+                    name = running.pop(fut)
+                    out = fut.result()
+                    if pool == 'thread':
+                        results[name] = out
+                    else:
+                        results[name], self.times[name] = out
+        except BaseException:
+            for fut in running:
+                fut.cancel()
+            raise
+        finally:
+            if isinstance(pool, str):
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    #
+    # threads record their own times, other pools send them back
+    # with the result
+    def _submit(self, executor, pool, name, results):
+        if pool == 'thread':
+            return executor.submit(self._call, name, results)
+        func, deps = self.nodes[name]
+        return executor.submit(_timed_call, name, func, [results[d] for d in deps])
+
+    #
+    # longest chain of dependent nodes by the last run times,
+    # returns its length and the nodes on it
+    def critical_path(self):
+        finish, prev = {}, {}
+        for name in self.order([n for n in self.nodes if n in self.times]):
+            deps = [d for d in self.nodes[name][1] if d in finish]
+            first = max(deps, key=finish.get, default=None)
+            prev[name] = first
+            finish[name] = self.times.get(name, 0.0) + (0.0 if first is None else finish[first])
+        if not finish:
+            return 0.0, []
+        name = max(finish, key=finish.get)
+        length, path = finish[name], []
+        while name is not None:
+            path.append(name)
+            name = prev[name]
+        return length, path[::-1]
+
+    def report(self):
+        length, path = self.critical_path()
+        lines = ['{:16s} {:8.3f} s'.format(n, t) for n, t in self.times.items()]
+        lines.append('sum of nodes     {:8.3f} s'.format(sum(self.times.values())))
+        lines.append('critical path    {:8.3f} s  {}'.format(length, ' -> '.join(path)))
+        if self.wall is not None:
+            lines.append('wall time        {:8.3f} s'.format(self.wall))
+        return '\n'.join(lines)
+
+
+#
+# a node in another process, its time goes back with the result
+def _timed_call(name, func, args):
+    start = time.perf_counter()
+    try:
+        with stage('node', node=name):
+            out = func(*args)
+    except Exception as e:
+        e.add_note('in node {}'.format(name))
+        raise
+    return out, time.perf_counter() - start
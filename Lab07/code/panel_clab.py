@@ -10,45 +10,56 @@
 
 #
 import pandas as pd
-import numpy as np
 import statsmodels.formula.api as smf
 import linearmodels as plm
 #       import sys
 
+from wild_boot import wild_wald_test
+from panel_transform import PanelIndex, lag
+from derive import Derive
+from instrument import stage
+from lab_data import load_data
+from fit_cache import FitCache
 
 #
-# load data
-rice = pd.read_csv('./rice3.csv')
-print(rice.info())
-
+# fitted models are kept in .fitcache, a rerun loads the
+# unchanged ones (PANEL_FIT_CACHE=0 to fit them all)
 #
-# create new variables
-rice['lnQ'] = np.log(rice['prod'])
-rice['lnD'] = np.log(rice['area'])
-rice['lnL'] = np.log(rice['labor'])
-rice['lnF'] = np.log(rice['fert'])
-rice['lnE'] = np.log(rice['educ'])
+# each model is timed in stages (PANEL_TRACE=run.jsonl, see
+# instrument.py): design (formula and design matrices, by
+# linearmodels), fit, covariance (computed on first use, so it
+# is asked for here) and print
+fits = FitCache()
 
 
 #
-# this is how to calculate summary statistics
-# for each member of a group
-#
+# load data
+with stage('load') as s:
+    rice = load_data('./rice3.csv')
+    s.set(rows=rice.shape[0], cols=rice.shape[1])
+print(rice.info())
 
 #
-# create a variable of means for each farmer, and merge
-rice = rice.set_index('farmid')
-rice['lnD_b'] = rice.groupby(['farmid'])[['lnD']].mean()
-rice['lnL_b'] = rice.groupby(['farmid'])[['lnL']].mean()
-rice['lnF_b'] = rice.groupby(['farmid'])[['lnF']].mean()
-rice = rice.reset_index()
-#
-
+# create new variables
+#   the logs, the means for each farmer (one grouped pass, no
+#   re-indexing) and the year dummies, see derive.py
+RICE = Derive('''
+    lnQ   = log(prod)
+    lnD   = log(area)
+    lnL   = log(labor)
+    lnF   = log(fert)
+    lnE   = log(educ)
+    lnD_b = entity_mean(lnD)
+    lnL_b = entity_mean(lnL)
+    lnF_b = entity_mean(lnF)
+    yd    = dummies(year)
+''', entity='farmid', time='year')
+with stage('derive') as s:
+    rice = RICE.apply(rice)
+    s.set(rows=rice.shape[0], cols=rice.shape[1])
+if RICE.problems:
+    print(RICE.report())
 
-#
-# create dummy variables
-ydummies = pd.get_dummies(rice['year'],prefix='yd',drop_first=True)
-rice = pd.concat([rice,ydummies], axis=1)
 
 #
 # also want a
@@ -56,10 +67,12 @@ year = pd.Categorical(rice.year)
 
 #
 # count individual and periods
-N = rice['farmid'].nunique()
-T = rice['year'].nunique()
+pidx = PanelIndex.from_data(rice, 'farmid', 'year')
+N = pidx.nentity
+T = pidx.nperiod
 print('Cross-sectional units : {}'.format(N))
 print('Number of time periods: {}'.format(T))
+print('Balanced panel        : {}'.format(pidx.balanced))
 
 rice = rice.set_index(['farmid','year'])
 rice['year'] = year
@@ -69,37 +82,55 @@ print(rice.info())
 #
 # pooled OLS I
 #
-pom = plm.PooledOLS.from_formula(
-           formula='lnQ ~ 1 + lnD + lnL + lnF + yd_1991 + yd_1992 + yd_1993 + yd_1994 + yd_1995 + yd_1996 + yd_1997',
-           data=rice)
-por = pom.fit(cov_type='clustered', cluster_entity=True)
-print(por)
+with stage('design', model='POLS'):
+    pom = fits(plm.PooledOLS).from_formula(
+               formula='lnQ ~ 1 + lnD + lnL + lnF + yd_1991 + yd_1992 + yd_1993 + yd_1994 + yd_1995 + yd_1996 + yd_1997',
+               data=rice)
+with stage('fit', model='POLS') as s:
+    por = pom.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=por.nobs, cols=len(por.params))
+with stage('covariance', model='POLS') as s:
+    s.set(rows=por.cov.shape[0], cols=por.cov.shape[1])
+with stage('print', model='POLS'):
+    print(por)
 #
 # test for period effects
 yhyp = ['yd_1991=0', 'yd_1992=0', 'yd_1993=0', 'yd_1994=0', 'yd_1995=0', 'yd_1996=0', 'yd_1997=0']
-wtest = por.wald_test(formula=yhyp)
+with stage('wald_test', model='POLS'):
+    wtest = por.wald_test(formula=yhyp)
 #print(wtest)
 print('Testing year effect in POLS')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(por, yhyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 print()
 
 #
 # pooled OLS II
 #
-pom = plm.PooledOLS.from_formula(
-           formula='lnQ ~ 1 + lnD + lnL + lnF + year',
-           data=rice)
-por = pom.fit(cov_type='clustered', cluster_entity=True)
-print(por)
+with stage('design', model='POLS'):
+    pom = fits(plm.PooledOLS).from_formula(
+               formula='lnQ ~ 1 + lnD + lnL + lnF + year',
+               data=rice)
+with stage('fit', model='POLS') as s:
+    por = pom.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=por.nobs, cols=len(por.params))
+with stage('covariance', model='POLS') as s:
+    s.set(rows=por.cov.shape[0], cols=por.cov.shape[1])
+with stage('print', model='POLS'):
+    print(por)
 #
 # test for period effects
 yhyp = ['year[T.1991]=0', 'year[T.1992]=0', 'year[T.1993]=0', 'year[T.1994]=0', 'year[T.1995]=0', 'year[T.1996]=0', 'year[T.1997]=0']
-wtest = por.wald_test(formula=yhyp)
+with stage('wald_test', model='POLS'):
+    wtest = por.wald_test(formula=yhyp)
 #print(wtest)
 print('Testing year effect in POLS')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(por, yhyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 print()
 
 
@@ -107,73 +138,111 @@ print()
 # preliminary test for unobserved effects
 #
 rice['rhat'] = por.resids
-rice['lrhat'] = rice.rhat.shift()
-pmd = plm.PooledOLS.from_formula(
-            formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat',
-            data=rice)
-pmr = pmd.fit(cov_type='clustered', cluster_entity=True)
+rice['lrhat'] = lag(rice, 'rhat', index=pidx)
+#
+# the lag is missing in the first year of every farm, so that
+# year is dropped from the sample and from the year categories
+rlag = rice[rice['lrhat'].notna()].copy()
+rlag['year'] = rlag['year'].cat.remove_unused_categories()
+with stage('design', model='POLS lrhat'):
+    pmd = fits(plm.PooledOLS).from_formula(
+                formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat',
+                data=rlag)
+with stage('fit', model='POLS lrhat') as s:
+    pmr = pmd.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=pmr.nobs, cols=len(pmr.params))
+with stage('covariance', model='POLS lrhat') as s:
+    s.set(rows=pmr.cov.shape[0], cols=pmr.cov.shape[1])
 
 uhyp = ['lrhat=0']
-wtest = pmr.wald_test(formula=uhyp)
+with stage('wald_test', model='POLS lrhat'):
+    wtest = pmr.wald_test(formula=uhyp)
 #print(wtest)
 print('Testing unobserved effects')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(pmr, uhyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 
 
 #
 # fixed effects estimator
 #
-fem = plm.PanelOLS.from_formula(
-            formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat + EntityEffects',
-            data=rice)
-fer = fem.fit(cov_type='clustered', cluster_entity=True)
-print(fer)
+with stage('design', model='FE'):
+    fem = fits(plm.PanelOLS).from_formula(
+                formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat + EntityEffects',
+                data=rlag)
+with stage('fit', model='FE') as s:
+    fer = fem.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=fer.nobs, cols=len(fer.params))
+with stage('covariance', model='FE') as s:
+    s.set(rows=fer.cov.shape[0], cols=fer.cov.shape[1])
+with stage('print', model='FE'):
+    print(fer)
 
 
 #
 # random effects estimator
 #
-rem = plm.RandomEffects.from_formula(
-    formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat + EntityEffects',
-    data=rice)
-rer = rem.fit(cov_type='clustered', cluster_entity=True)
-print(rer)
+with stage('design', model='RE'):
+    rem = fits(plm.RandomEffects).from_formula(
+        formula='lnQ ~ 1 + lnD + lnL + lnF + year + lrhat + EntityEffects',
+        data=rlag)
+with stage('fit', model='RE') as s:
+    rer = rem.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=rer.nobs, cols=len(rer.params))
+with stage('covariance', model='RE') as s:
+    s.set(rows=rer.cov.shape[0], cols=rer.cov.shape[1])
+with stage('print', model='RE'):
+    print(rer)
 
 
 #
 # correlated random effects estimator
 #
-crm = plm.RandomEffects.from_formula(
-    formula='lnQ ~ 1 + lnD + lnL + lnF + lnD_b + lnL_b + lnF_b + year + lrhat + EntityEffects',
-    data=rice)
-crr = crm.fit(cov_type='clustered', cluster_entity=True)
-print(crr)
+with stage('design', model='CRE'):
+    crm = fits(plm.RandomEffects).from_formula(
+        formula='lnQ ~ 1 + lnD + lnL + lnF + lnD_b + lnL_b + lnF_b + year + lrhat + EntityEffects',
+        data=rlag)
+with stage('fit', model='CRE') as s:
+    crr = crm.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=crr.nobs, cols=len(crr.params))
+with stage('covariance', model='CRE') as s:
+    s.set(rows=crr.cov.shape[0], cols=crr.cov.shape[1])
+with stage('print', model='CRE'):
+    print(crr)
 
 #
 # testing RE vs FE
 #
 uhyp = ['lnD_b=0', 'lnL_b=0', 'lnF_b=0']
-wtest = crr.wald_test(formula=uhyp)
+with stage('wald_test', model='CRE'):
+    wtest = crr.wald_test(formula=uhyp)
 print('Testing FE vs RE')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(crr, uhyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 
 #
 # testing constant returns to scale
 #
 uhyp = ['lnD + lnL + lnF = 1']
-wtest = crr.wald_test(formula=uhyp)
+with stage('wald_test', model='CRE'):
+    wtest = crr.wald_test(formula=uhyp)
 print('Testing CRS in CD')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(crr, uhyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 
 
 #
 # comparing results
-print(plm.panel.compare({'POLS': por,
-                         'FE'  : fer,
-                         'RE'  : rer,
-                         'CRE' : crr},
-precision='std_errors'))
+with stage('print', model='compare'):
+    print(plm.panel.compare({'POLS': por,
+                             'FE'  : fer,
+                             'RE'  : rer,
+                             'CRE' : crr},
+    precision='std_errors'))
 
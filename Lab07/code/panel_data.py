@@ -15,12 +15,20 @@ import statsmodels.api as sm
 import statsmodels.formula.api as smf
 import linearmodels as plm
 
-import wooldridge as woo
+
+from panel_transform import PanelIndex, add_mundlak, lag
+from lab_data import load_data
+from fit_cache import FitCache
+
+#
+# fitted models are kept in .fitcache, a rerun loads the
+# unchanged ones (PANEL_FIT_CACHE=0 to fit them all)
+fits = FitCache()
 
 #
 # use the airfare dataset from Wooldridge
 #
-airf = woo.dataWoo('airfare')
+airf = load_data('woo:airfare')
 airf.info()
 
 
@@ -37,10 +45,12 @@ print(airf['year'].value_counts())
 
 #
 # count individual routes and periods
-N = airf['id'].nunique()
-T = airf['year'].nunique()
+pidx = PanelIndex.from_data(airf, 'id', 'year')
+N = pidx.nentity
+T = pidx.nperiod
 print('Cross-sectional units : {}'.format(N))
 print('Number of time periods: {}'.format(T))
+print('Balanced panel        : {}'.format(pidx.balanced))
 
 
 # In[4]:
@@ -89,7 +99,7 @@ print('p-value: {}'.format(ftest.pvalue))
 #
 # cluster robust standard errors
 #
-pom = plm.PooledOLS.from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + y98 + y99 + y00',
+pom = fits(plm.PooledOLS).from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + y98 + y99 + y00',
                                 data=airf)
 por = pom.fit(cov_type='robust')
 print(por)
@@ -111,9 +121,9 @@ print('p-value: {}'.format(wtest.pval))
 # preliminary test for unobserved effects
 #
 airf['rhat'] = por.resids
-airf['lrhat'] = airf.rhat.shift()
-pmd = plm.PooledOLS.from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + y99 + y00 + lrhat',
-                                 data=airf[airf['t']>1997])
+airf['lrhat'] = lag(airf, 'rhat', index=pidx)
+pmd = fits(plm.PooledOLS).from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + y99 + y00 + lrhat',
+                                       data=airf[airf['t']>1997])
 pmc = pmd.fit(cov_type='clustered', cluster_entity=True)
 print(pmc)
 
@@ -131,13 +141,13 @@ print('p-value: {}'.format(wtest.pval))
 #
 # first difference estimator
 #
-fdm = plm.FirstDifferenceOLS.from_formula(formula='lfare ~ concen',
+fdm = fits(plm.FirstDifferenceOLS).from_formula(formula='lfare ~ concen',
                                 data=airf)
 fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
 print(fdr)
 
-fdm = plm.FirstDifferenceOLS.from_formula(formula='lfare ~ concen + y98 + y99 + y00',
-                                          data=airf)
+fdm = fits(plm.FirstDifferenceOLS).from_formula(formula='lfare ~ concen + y98 + y99 + y00',
+                                                data=airf)
 fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
 print(fdr)
 
@@ -148,7 +158,7 @@ print(fdr)
 #
 # fixed effects estimator
 #
-fem = plm.PanelOLS.from_formula(
+fem = fits(plm.PanelOLS).from_formula(
             formula='lfare ~ 1 + concen + EntityEffects + C(t)',
             data=airf)
 fer = fem.fit(cov_type='clustered', cluster_entity=True)
@@ -161,7 +171,7 @@ print(fer)
 #
 # random effects estimator
 #
-rem = plm.RandomEffects.from_formula(
+rem = fits(plm.RandomEffects).from_formula(
             formula='lfare ~ 1 + concen + ldist + ldistsq + C(t) + EntityEffects',
             data=airf)
 rer = rem.fit(cov_type='clustered', cluster_entity=True)
@@ -183,17 +193,12 @@ print(rer)
 #print(airf.groupby(['year'])[['concen']].mean())
 
 #
-# create a variable of means for each airport, and merge
-airf = airf.reset_index().set_index(['id'])
-airf['concen_b'] = airf.groupby(['id'])[['concen']].mean()
-airf = airf.reset_index()
+# create a variable of means for each airport
+#   one grouped pass over the id level, the panel index is kept
+airf = add_mundlak(airf, ['concen'], entity='id')
 #
 # check result
-print(airf[['id','year','concen','concen_b']])
-
-#
-# set a proper index
-airf = airf.set_index(['id','year'])
+print(airf[['concen','concen_b']])
 
 
 # In[14]:
@@ -202,7 +207,7 @@ airf = airf.set_index(['id','year'])
 #
 # correlated random effects estimator
 #
-crm = plm.RandomEffects.from_formula(
+crm = fits(plm.RandomEffects).from_formula(
             formula='lfare ~ 1 + concen + concen_b + ldist + ldistsq + C(t) + EntityEffects',
             data=airf)
 crr = crm.fit(cov_type='clustered', cluster_entity=True)
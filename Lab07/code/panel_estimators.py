@@ -13,32 +13,41 @@ import numpy as np
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
 import linearmodels as plm
-import wooldridge as woo
+
+from wild_boot import wild_wald_test
+from panel_transform import PanelIndex, add_mundlak
+from lab_data import load_data
+from fit_cache import FitCache
+
+#
+# fitted models are kept in .fitcache, a rerun loads the
+# unchanged ones (PANEL_FIT_CACHE=0 to fit them all)
+fits = FitCache()
 
 
 #
 # use the airfare dataset from Wooldridge
 #
-airf = woo.dataWoo('airfare')
+airf = load_data('woo:airfare')
 airf.info()
 
 #
 # count individual and periods
-N = airf['id'].nunique()
-T = airf['year'].nunique()
+pidx = PanelIndex.from_data(airf, 'id', 'year')
+N = pidx.nentity
+T = pidx.nperiod
 print('Cross-sectional units : {}'.format(N))
 print('Number of time periods: {}'.format(T))
+print('Balanced panel        : {}'.format(pidx.balanced))
 
 #
 # I need an extra variable referencing the year
 airf['t'] = airf.year
 
 #
-# create a variable of means for each airport, and merge
-#  this is accomplished by having a proper index on entity
-airf = airf.set_index(['id'])
-airf['concen_b'] = airf.groupby(['id'])[['concen']].mean()
-airf = airf.reset_index()
+# create a variable of means for each airport
+#  one grouped pass over the entity, no re-indexing
+airf = add_mundlak(airf, ['concen'], index=pidx)
 
 
 #
@@ -57,7 +66,7 @@ airf = airf.set_index(['id','year'])
 #
 # pooled OLS
 #
-pom = plm.PooledOLS.from_formula(
+pom = fits(plm.PooledOLS).from_formula(
     formula='lfare ~ 1 + concen + ldist + ldistsq +  C(t)',
     data=airf)
 por = pom.fit(cov_type='clustered', cluster_entity=True)
@@ -66,14 +75,14 @@ por = pom.fit(cov_type='clustered', cluster_entity=True)
 #
 # first difference estimator
 #
-pmd = plm.FirstDifferenceOLS.from_formula(formula='lfare ~ concen',
-                                          data=airf)
+pmd = fits(plm.FirstDifferenceOLS).from_formula(formula='lfare ~ concen',
+                                                data=airf)
 pmc = pmd.fit(cov_type='clustered', cluster_entity=True)
 
 #
 # first difference estimator
 #
-fdm = plm.FirstDifferenceOLS.from_formula(
+fdm = fits(plm.FirstDifferenceOLS).from_formula(
     formula='lfare ~ concen + y98 + y99 + y00',
     data=airf)
 fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
@@ -82,7 +91,7 @@ fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
 #
 # fixed effects estimator
 #
-fem = plm.PanelOLS.from_formula(
+fem = fits(plm.PanelOLS).from_formula(
     formula='lfare ~ 1 + concen + EntityEffects + C(t)',
     data=airf)
 fer = fem.fit(cov_type='clustered', cluster_entity=True)
@@ -91,7 +100,7 @@ fer = fem.fit(cov_type='clustered', cluster_entity=True)
 #
 # random effects estimator
 #
-rem = plm.RandomEffects.from_formula(
+rem = fits(plm.RandomEffects).from_formula(
     formula='lfare ~ 1 + concen + ldist + ldistsq + C(t) + EntityEffects',
     data=airf)
 rer = rem.fit(cov_type='clustered', cluster_entity=True)
@@ -100,7 +109,7 @@ rer = rem.fit(cov_type='clustered', cluster_entity=True)
 #
 # correlated random effects estimator
 #
-crm = plm.RandomEffects.from_formula(
+crm = fits(plm.RandomEffects).from_formula(
     formula='lfare ~ 1 + concen + concen_b + ldist + ldistsq + C(t) + EntityEffects',
     data=airf)
 crr = crm.fit(cov_type='clustered', cluster_entity=True)
@@ -111,6 +120,8 @@ print(wtest)
 print('Testing for correlated effects')
 print('Chi2   : {}'.format(wtest.stat))
 print('p-value: {}'.format(wtest.pval))
+btest = wild_wald_test(crr, rehyp, reps=9999, seed=301)
+print('Wild bootstrap p-value: {}'.format(btest.boot_pval))
 
 #
 # comparing results
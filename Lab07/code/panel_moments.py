@@ -0,0 +1,293 @@
+# ---------------------------------------------------------
+#    panel_moments.py
+#
+#    POLS, between, FE, RE and CRE from one pass over the data
+#
+#    With z = [x, y] the data are reduced once to per-entity
+#       Q_i = sum_t z_it z_it'       (G x P x P)
+#       s_i = sum_t z_it             (G x P)
+#       T_i                          (G,)
+#    Every estimator is least squares on transformed data whose
+#    per-entity cross products are
+#       M_i = Q_i - lam_i s_i s_i'/T_i + c T_i zbar zbar'
+#    with
+#       POLS   lam_i = 0
+#       FE     lam_i = 1, c = 1 (grand mean added back)
+#       RE     lam_i = 1 - (1 - theta_i)^2   (Swamy-Arora theta)
+#    and the between regression uses sum_i s_i s_i'/T_i^2.
+#    The cluster scores are g_i = M_i[x, :] [-b, 1]', so the
+#    clustered covariances need no residuals either.
+#
+#    CRE adds entity means of some regressors. Their per-entity
+#    blocks follow from Q_i and s_i, since sum_t z_it zbar_i' and
+#    sum_t zbar_i zbar_i' are both s_i s_i'/T_i.
+#
+#    Conventions follow linearmodels: clustered covariance scaled
+#    n/(n-K), Swamy-Arora variance components without the small
+#    sample option.
+#
+
+#
+import numpy as np
+import pandas as pd
+
+from panel_transform import PanelFit, panel_design
+from categorical import panel_factor_design
+from instrument import stage, timed
+
+
+#
+# drop columns of a cross product that are linear combinations
+# of the kept columns before them
+def independent(M, keep, tol=1e-10):
+    keep = keep.copy()
+    sel = []
+    for j in np.flatnonzero(keep):
+        d = M[j, j]
+        if sel:
+            a = M[sel, j]
+            d -= a @ np.linalg.solve(M[np.ix_(sel, sel)], a)
+        if d > tol * max(M[j, j], 1e-300):
+            sel.append(j)
+        else:
+            keep[j] = False
+    return keep
+
+
+class PanelMoments:
+
+    def __init__(self, Q, s, T, names, dep):
+        self.Q = Q
+        self.s = s
+        self.T = np.asarray(T, dtype=np.float64)
+        self.names = list(names)
+        self.dep = dep
+
+    @property
+    def nentity(self):
+        return len(self.T)
+
+    @property
+    def nobs(self):
+        return int(self.T.sum())
+
+    @property
+    def nvar(self):
+        return len(self.names)
+
+    #
+    # one reduction of [X, y] over the sorted entity index
+    @classmethod
+    def from_arrays(cls, X, y, index, names, dep='y'):
+        Z = np.column_stack([np.asarray(X, dtype=np.float64),
+                             np.asarray(y, dtype=np.float64)])
+        p = Z.shape[1]
+        Q = np.empty((index.nentity, p, p))
+        for j in range(p):
+            Q[:, j, :] = index.sums(Z * Z[:, j:j+1])
+        s = index.sums(Z)
+        return cls(Q, s, index.counts, names, dep)
+
+    #
+    # period and other categorical effects are kept as codes
+    # (categorical.py); sparse=False builds the dense dummies
+    @classmethod
+    @timed('moments')
+    def from_formula(cls, formula, data, sparse=True):
+        dep = formula.split('~')[0].strip()
+        if not sparse:
+            y, X, index = panel_design(formula, data)
+            return cls.from_arrays(X.to_numpy(), y, index, X.columns, dep)
+        y, D, index = panel_factor_design(formula, data)
+        Q, s = D.group_moments(index.codes, index.nentity, y)
+        return cls(Q, s, index.counts, D.names, dep)
+
+    #
+    # the same moments with the regressors in the given order;
+    # with collinear regressors the order decides which are dropped
+    def reorder(self, names):
+        pos = [self.names.index(n) for n in names] + [self.nvar]
+        return PanelMoments(self.Q[:, pos][:, :, pos], self.s[:, pos], self.T,
+                            names, self.dep)
+
+    #
+    # moments with the entity means of some regressors appended
+    # as extra regressors (named var_b)
+    def with_means(self, means, suffix='_b'):
+        k, p = self.nvar, self.nvar + 1
+        pos = [self.names.index(m) for m in means]
+        m = len(pos)
+        A = np.zeros((p + m, p))
+        A[np.arange(k), np.arange(k)] = 1.0
+        A[p + m - 1, k] = 1.0
+        C = np.zeros((p + m, p))
+        C[k + np.arange(m), pos] = 1.0
+        #
+        # batched matmul over the entities (a 3-operand einsum is
+        # evaluated without BLAS and dominates the CRE fit)
+        P = self.s[:, :, None] * self.s[:, None, :] / self.T[:, None, None]
+        Q = A @ self.Q @ A.T + A @ P @ C.T + C @ P @ A.T + C @ P @ C.T
+        s = self.s @ (A + C).T
+        names = self.names + ['{}{}'.format(self.names[i], suffix) for i in pos]
+        return PanelMoments(Q, s, self.T, names, self.dep)
+
+    #
+    # aggregate cross product for per-entity lam_i
+    def _cross(self, lam, grand=False):
+        M = self.Q.sum(axis=0)
+        if np.any(lam != 0):
+            M = M - np.einsum('g,gi,gj->ij', lam / self.T, self.s, self.s)
+        if grand:
+            zbar = self.s.sum(axis=0) / self.nobs
+            M = M + self.nobs * np.outer(zbar, zbar)
+        return M
+
+    #
+    # zbar is the grand mean, taken from these moments unless given
+    def _scores(self, lam, w, grand=False, zbar=None):
+        k = self.nvar
+        g = self.Q[:, :k, :] @ w
+        g -= (lam * (self.s @ w) / self.T)[:, None] * self.s[:, :k]
+        if grand:
+            if zbar is None:
+                zbar = self.s.sum(axis=0) / self.nobs
+            g += np.outer(self.T * (zbar @ w), zbar[:k])
+        return g
+
+    def _has_constant(self):
+        zbar = self.s.sum(axis=0) / self.nobs
+        Qd = np.diagonal(self.Q.sum(axis=0)) / self.nobs
+        return bool(np.any(np.isclose(zbar[:-1], 1.0) &
+                           np.isclose(Qd[:-1], 1.0)))
+
+    #
+    # least squares from a cross product, columns with no
+    # variation (e.g. time invariant ones in FE) are dropped, as
+    # are columns collinear with earlier ones (e.g. exper with
+    # year dummies in FE)
+    def _solve(self, M, keep=None):
+        k = self.nvar
+        keep = independent(M[:k, :k], np.ones(k, bool) if keep is None else keep)
+        b = np.full(k, np.nan)
+        b[keep] = np.linalg.lstsq(M[:k, :k][np.ix_(keep, keep)],
+                                  M[:k, k][keep], rcond=None)[0]
+        w = np.r_[-np.where(keep, b, 0.0), 1.0]
+        return b, w, keep
+
+    def _fit(self, name, lam, grand=False, keep=None, theta=None):
+        k = self.nvar
+        with stage(name, rows=self.nentity, cols=k):
+            M = self._cross(lam, grand)
+            b, w, keep = self._solve(M, keep)
+        with stage('covariance', rows=self.nentity, cols=k):
+            g = self._scores(lam, w, grand)[:, keep]
+            xpxi = np.linalg.inv(M[:k, :k][np.ix_(keep, keep)])
+            n, kk = self.nobs, keep.sum()
+            cov = np.full((k, k), np.nan)
+            cov[np.ix_(keep, keep)] = n / (n - kk) * xpxi @ (g.T @ g) @ xpxi
+        fit = PanelFit(name, pd.Series(b, index=self.names),
+                       pd.DataFrame(cov, index=self.names, columns=self.names),
+                       None, n, theta)
+        fit.resid_ss = float(w @ M @ w)
+        return fit
+
+    def pooled(self):
+        return self._fit('POLS', np.zeros(self.nentity))
+
+    def fixed_effects(self):
+        grand = self._has_constant()
+        W = self._cross(np.ones(self.nentity))
+        Qd = np.diagonal(self.Q.sum(axis=0))[:-1]
+        keep = np.diagonal(W)[:-1] > 1e-10 * np.maximum(Qd, 1e-300)
+        if grand:
+            zbar = self.s.sum(axis=0)[:-1] / self.nobs
+            keep |= np.isclose(zbar, 1.0) & np.isclose(Qd / self.nobs, 1.0)
+        return self._fit('FE', np.ones(self.nentity), grand, keep)
+
+    #
+    # between regression on the entity means, each entity is
+    # its own cluster; regressors with the same mean for every
+    # entity (e.g. year dummies in a balanced panel) are dropped
+    def between(self):
+        k, G = self.nvar, self.nentity
+        zb = self.s / self.T[:, None]
+        M = zb.T @ zb
+        var = zb[:, :k].var(axis=0)
+        const = np.isclose(zb[:, :k], 1.0).all(axis=0)
+        keep = (var > 1e-12 * np.maximum(np.abs(zb[:, :k]).max(axis=0) ** 2,
+                                         1e-300)) | const
+        b, w, keep = self._solve(M, keep)
+        g = zb[:, :k][:, keep] * (zb @ w)[:, None]
+        xpxi = np.linalg.inv(M[:k, :k][np.ix_(keep, keep)])
+        cov = np.full((k, k), np.nan)
+        cov[np.ix_(keep, keep)] = G / (G - keep.sum()) * xpxi @ (g.T @ g) @ xpxi
+        fit = PanelFit('BE', pd.Series(b, index=self.names),
+                       pd.DataFrame(cov, index=self.names, columns=self.names),
+                       None, G)
+        fit.resid_ss = float(w @ M @ w)
+        return fit
+
+    #
+    # Swamy-Arora variance components from the moments
+    def variance_components(self):
+        k, G, n = self.nvar, self.nentity, self.nobs
+        M = self._cross(np.ones(G), self._has_constant())
+        b = np.linalg.lstsq(M[:k, :k], M[:k, k], rcond=None)[0]
+        ssr_w = M[k, k] - M[:k, k] @ b
+        sigma2_e = ssr_w / (n - k - G + 1)
+        zb = self.s / self.T[:, None]
+        Mb = zb.T @ zb
+        bb = np.linalg.lstsq(Mb[:k, :k], Mb[:k, k], rcond=None)[0]
+        ssr_b = Mb[k, k] - Mb[:k, k] @ bb
+        t_bar = G / (1.0 / self.T).sum()
+        sigma2_u = max(0.0, ssr_b / (G - k) - sigma2_e / t_bar)
+        theta = 1.0 - np.sqrt(sigma2_e / (self.T * sigma2_u + sigma2_e))
+        return sigma2_e, sigma2_u, theta
+
+    def random_effects(self, name='RE'):
+        sigma2_e, sigma2_u, theta = self.variance_components()
+        fit = self._fit(name, 1.0 - (1.0 - theta) ** 2, theta=theta)
+        fit.sigma2_eps = sigma2_e
+        fit.sigma2_effects = sigma2_u
+        return fit
+
+    def correlated_random_effects(self, means):
+        return self.with_means(means).random_effects(name='CRE')
+
+    #
+    # all estimators from the same moments
+    def fit_all(self, means=None):
+        fits = {'POLS': self.pooled(),
+                'BE': self.between(),
+                'FE': self.fixed_effects(),
+                'RE': self.random_effects()}
+        if means:
+            fits['CRE'] = self.correlated_random_effects(means)
+        return fits
+
+
+#
+# table of estimates with standard errors in parentheses
+def compare(fits, digits=4):
+    names = []
+    for f in fits.values():
+        names += [n for n in f.params.index if n not in names]
+    rows = []
+    for n in names:
+        est, se = [], []
+        for f in fits.values():
+            b = f.params.get(n, np.nan)
+            s = f.std_errors.get(n, np.nan)
+            est.append('' if np.isnan(b) else '{:.{d}f}'.format(b, d=digits))
+            se.append('' if np.isnan(s) else '({:.{d}f})'.format(s, d=digits))
+        rows += [[n] + est, [''] + se]
+    table = pd.DataFrame(rows, columns=['Parameter'] + list(fits))
+    return table.set_index('Parameter')
+
+
+#
+# one call for the whole comparison, e.g.
+#   fit_panel('lnQ ~ 1 + lnD + lnL + lnF + year', rice,
+#             means=['lnD', 'lnL', 'lnF'])
+def fit_panel(formula, data, means=None, sparse=True):
+    return PanelMoments.from_formula(formula, data, sparse).fit_all(means)
@@ -13,12 +13,27 @@ import statsmodels.api as sm
 import statsmodels.formula.api as smf
 import linearmodels as plm
 
-import wooldridge as woo
+
+from panel_transform import PanelIndex, add_mundlak, lag
+from lab_data import load_data
+from fit_cache import FitCache
+from instrument import stage
+
+#
+# fitted models are kept in .fitcache, a rerun loads the
+# unchanged ones (PANEL_FIT_CACHE=0 to fit them all)
+#
+# the steps are timed in stages (PANEL_TRACE=run.jsonl, see
+# instrument.py): load, dummies, design, fit, covariance (asked
+# for before printing), print and the tests
+fits = FitCache()
 
 #
 # use the airfare dataset from Wooldridge
 #
-airf = woo.dataWoo('airfare')
+with stage('load') as s:
+    airf = load_data('woo:airfare')
+    s.set(rows=airf.shape[0], cols=airf.shape[1])
 print(airf.info())
 
 #
@@ -27,10 +42,12 @@ print(airf['year'].value_counts())
 
 #
 # count individual routes and periods
-N = airf['id'].nunique()
-T = airf['year'].nunique()
+pidx = PanelIndex.from_data(airf, 'id', 'year')
+N = pidx.nentity
+T = pidx.nperiod
 print('Cross-sectional units : {}'.format(N))
 print('Number of time periods: {}'.format(T))
+print('Balanced panel        : {}'.format(pidx.balanced))
 
 #
 # define a proper index based on id and year
@@ -53,8 +70,10 @@ print(airf[['year','lfare','concen']].head())
 
 #
 # create dummy variables
-ydummies = pd.get_dummies(airf['year'],prefix='yd',drop_first=True)
-airf = pd.concat([airf,ydummies], axis=1)
+with stage('get_dummies') as s:
+    ydummies = pd.get_dummies(airf['year'],prefix='yd',drop_first=True)
+    airf = pd.concat([airf,ydummies], axis=1)
+    s.set(rows=airf.shape[0], cols=ydummies.shape[1])
 print(airf.info())
 
 #%%
@@ -66,9 +85,15 @@ Example to show that we need to use clustered standard errors for pooled OLS est
 
 #
 # pooled model, OLS estimation w/ dummy variables
-pom = smf.ols(formula='lfare ~ concen + ldist + ldistsq + yd_1998 + yd_1999 + yd_2000',
-              data=airf)
-por = pom.fit(cov_type='HC3')
+with stage('design', model='OLS') as s:
+    pom = smf.ols(formula='lfare ~ concen + ldist + ldistsq + yd_1998 + yd_1999 + yd_2000',
+                  data=airf)
+    s.set(rows=pom.exog.shape[0], cols=pom.exog.shape[1])
+with stage('fit', model='OLS') as s:
+    por = pom.fit(cov_type='HC3')
+    s.set(rows=int(por.nobs), cols=len(por.params))
+with stage('covariance', model='OLS') as s:
+    s.set(rows=por.cov_params().shape[0], cols=por.cov_params().shape[1])
 pot = pd.DataFrame({'b'   : round(por.params,5),
                     'se'  : round(por.bse, 5),
                     't'   : round(por.tvalues, 2),
@@ -78,7 +103,8 @@ print(pot)
 #
 # test for period effects
 yhyp = ['yd_1998=0','yd_1999=0','yd_2000=0']
-ftest = por.f_test(yhyp)
+with stage('f_test', model='OLS'):
+    ftest = por.f_test(yhyp)
 print('Testing year effect in POLS')
 print('F-stat : {}'.format(ftest.statistic[0][0]))
 print('p-value: {}'.format(ftest.pvalue))
@@ -88,21 +114,29 @@ print('p-value: {}'.format(ftest.pvalue))
 #
 # pooled model, OLS estimation w/ implicit coding of dummy variables
 #
-pom = smf.ols(formula='lfare ~ concen + ldist + ldistsq + C(year)',
-              data=airf)
-por = pom.fit(cov_type='HC3')
+with stage('design', model='OLS') as s:
+    pom = smf.ols(formula='lfare ~ concen + ldist + ldistsq + C(year)',
+                  data=airf)
+    s.set(rows=pom.exog.shape[0], cols=pom.exog.shape[1])
+with stage('fit', model='OLS') as s:
+    por = pom.fit(cov_type='HC3')
+    s.set(rows=int(por.nobs), cols=len(por.params))
+with stage('covariance', model='OLS') as s:
+    s.set(rows=por.cov_params().shape[0], cols=por.cov_params().shape[1])
 pot = pd.DataFrame({'b'   : round(por.params,5),
                     'se'  : round(por.bse, 5),
                     't'   : round(por.tvalues, 2),
                     'p'   : round(por.pvalues, 3)})
-print(por.summary())
+with stage('print', model='OLS'):
+    print(por.summary())
 
 #
 # test for period effects - need details about parameters
 #   - find the names from the model results
 #
 yhyp = ['C(year)[T.1998]=0','C(year)[T.1999]=0','C(year)[T.2000]=0']
-ftest = por.f_test(yhyp)
+with stage('f_test', model='OLS'):
+    ftest = por.f_test(yhyp)
 print('Testing year effect in POLS')
 print('F-stat : {}'.format(ftest.statistic[0][0]))
 print('p-value: {}'.format(ftest.pvalue))
@@ -123,15 +157,27 @@ Olvar uses pooled OLS to test for time varying, and individual effects - this is
 
 # POLS w/cluster robust standard errors
 #
-pom = plm.PooledOLS.from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + C(year)',
-                                data=airf)
-por = pom.fit(cov_type='robust')
-print(por)
-por = pom.fit(cov_type='clustered', cluster_entity=True)
-print(por)
+with stage('design', model='POLS'):
+    pom = fits(plm.PooledOLS).from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + C(year)',
+                                    data=airf)
+with stage('fit', model='POLS') as s:
+    por = pom.fit(cov_type='robust')
+    s.set(rows=por.nobs, cols=len(por.params))
+with stage('covariance', model='POLS') as s:
+    s.set(rows=por.cov.shape[0], cols=por.cov.shape[1])
+with stage('print', model='POLS'):
+    print(por)
+with stage('fit', model='POLS') as s:
+    por = pom.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=por.nobs, cols=len(por.params))
+with stage('covariance', model='POLS') as s:
+    s.set(rows=por.cov.shape[0], cols=por.cov.shape[1])
+with stage('print', model='POLS'):
+    print(por)
 
 yhyp = ['C(year)[T.1998]=0','C(year)[T.1999]=0','C(year)[T.2000]=0']
-wtest = por.wald_test(formula=yhyp)
+with stage('wald_test', model='POLS'):
+    wtest = por.wald_test(formula=yhyp)
 print(wtest)
 print('Testing year effect in POLS')
 print('Chi2   : {}'.format(wtest.stat))
@@ -152,14 +198,22 @@ lrhat = individual effects ...or rather all effects not accounted for by variabl
 # preliminary test for unobserved effects
 #
 airf['rhat'] = por.resids
-airf['lrhat'] = airf.rhat.shift()
-pmd = plm.PooledOLS.from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + C(year) + lrhat',
-                                 data=airf[airf['year']>1997])
-pmc = pmd.fit(cov_type='clustered', cluster_entity=True)
-print(pmc)
+with stage('lag'):
+    airf['lrhat'] = lag(airf, 'rhat', index=pidx)
+with stage('design', model='POLS lrhat'):
+    pmd = fits(plm.PooledOLS).from_formula(formula='lfare ~ 1 + concen + ldist + ldistsq + C(year) + lrhat',
+                                           data=airf[airf['year']>1997])
+with stage('fit', model='POLS lrhat') as s:
+    pmc = pmd.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=pmc.nobs, cols=len(pmc.params))
+with stage('covariance', model='POLS lrhat') as s:
+    s.set(rows=pmc.cov.shape[0], cols=pmc.cov.shape[1])
+with stage('print', model='POLS lrhat'):
+    print(pmc)
 
 uhyp = ['lrhat=0']
-wtest = pmc.wald_test(formula=uhyp)
+with stage('wald_test', model='POLS lrhat'):
+    wtest = pmc.wald_test(formula=uhyp)
 print(wtest)
 print('Testing unobserved effects')
 print('Chi2   : {}'.format(wtest.stat))
@@ -180,10 +234,16 @@ Ben lambert has a video on it here: https://www.youtube.com/watch?v=G7WqK2o474Y
 #
 # first difference estimator
 #
-fdm = plm.FirstDifferenceOLS.from_formula(formula='lfare ~ concen',
-                                data=airf)
-fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
-print(fdr)
+with stage('design', model='FD'):
+    fdm = fits(plm.FirstDifferenceOLS).from_formula(formula='lfare ~ concen',
+                                    data=airf)
+with stage('fit', model='FD') as s:
+    fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=fdr.nobs, cols=len(fdr.params))
+with stage('covariance', model='FD') as s:
+    s.set(rows=fdr.cov.shape[0], cols=fdr.cov.shape[1])
+with stage('print', model='FD'):
+    print(fdr)
 
 """
 Yields biased results
@@ -193,10 +253,16 @@ Yields biased results
 
 #
 # add year dummy variables
-fdm = plm.FirstDifferenceOLS.from_formula(formula='lfare ~ concen + yd_1999 + yd_2000',
-                                          data=airf)
-fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
-print(fdr)
+with stage('design', model='FD'):
+    fdm = fits(plm.FirstDifferenceOLS).from_formula(formula='lfare ~ concen + yd_1999 + yd_2000',
+                                                    data=airf)
+with stage('fit', model='FD') as s:
+    fdr = fdm.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=fdr.nobs, cols=len(fdr.params))
+with stage('covariance', model='FD') as s:
+    s.set(rows=fdr.cov.shape[0], cols=fdr.cov.shape[1])
+with stage('print', model='FD'):
+    print(fdr)
 
 
 #%%
@@ -210,11 +276,17 @@ the whole truth about it, ask Olvar. Short story: include it for technical reaso
 #
 # fixed effects estimator
 #
-fem = plm.PanelOLS.from_formula(
-            formula='lfare ~ 1 + concen + C(year) + EntityEffects',
-            data=airf)
-fer = fem.fit(cov_type='clustered', cluster_entity=True)
-print(fer)
+with stage('design', model='FE'):
+    fem = fits(plm.PanelOLS).from_formula(
+                formula='lfare ~ 1 + concen + C(year) + EntityEffects',
+                data=airf)
+with stage('fit', model='FE') as s:
+    fer = fem.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=fer.nobs, cols=len(fer.params))
+with stage('covariance', model='FE') as s:
+    s.set(rows=fer.cov.shape[0], cols=fer.cov.shape[1])
+with stage('print', model='FE'):
+    print(fer)
 
 
 
@@ -223,11 +295,17 @@ print(fer)
 #
 # random effects estimator
 #
-rem = plm.RandomEffects.from_formula(
-            formula='lfare ~ 1 + concen + ldist + ldistsq + C(year) + EntityEffects',
-            data=airf)
-rer = rem.fit(cov_type='clustered', cluster_entity=True)
-print(rer)
+with stage('design', model='RE'):
+    rem = fits(plm.RandomEffects).from_formula(
+                formula='lfare ~ 1 + concen + ldist + ldistsq + C(year) + EntityEffects',
+                data=airf)
+with stage('fit', model='RE') as s:
+    rer = rem.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=rer.nobs, cols=len(rer.params))
+with stage('covariance', model='RE') as s:
+    s.set(rows=rer.cov.shape[0], cols=rer.cov.shape[1])
+with stage('print', model='RE'):
+    print(rer)
 
 #%%
 
@@ -243,17 +321,14 @@ print(rer)
 #print(airf.groupby(['year'])[['concen']].mean())
 
 #
-# create a variable of means for each airport, and merge
-airf = airf.reset_index().set_index(['id'])
-airf['concen_b'] = airf.groupby(['id'])[['concen']].mean()
-airf = airf.reset_index()
+# create a variable of means for each airport
+#   one grouped pass over the id level, the panel index is kept
+with stage('mundlak') as s:
+    airf = add_mundlak(airf, ['concen'], entity='id')
+    s.set(rows=airf.shape[0], cols=airf.shape[1])
 #
 # check result
-print(airf[['id','year','concen','concen_b']])
-
-#
-# set a proper index
-airf = airf.set_index(['id','period'])
+print(airf[['concen','concen_b']])
 
 #%%
 
@@ -265,22 +340,29 @@ Note: a CRE estimator is basically the same as an RE estimator, but with average
 #
 # correlated random effects estimator
 #
-crm = plm.RandomEffects.from_formula(
-            formula='lfare ~ 1 + concen + concen_b + ldist + ldistsq + C(year) + EntityEffects',
-            data=airf)
-crr = crm.fit(cov_type='clustered', cluster_entity=True)
-print(crr)
+with stage('design', model='CRE'):
+    crm = fits(plm.RandomEffects).from_formula(
+                formula='lfare ~ 1 + concen + concen_b + ldist + ldistsq + C(year) + EntityEffects',
+                data=airf)
+with stage('fit', model='CRE') as s:
+    crr = crm.fit(cov_type='clustered', cluster_entity=True)
+    s.set(rows=crr.nobs, cols=len(crr.params))
+with stage('covariance', model='CRE') as s:
+    s.set(rows=crr.cov.shape[0], cols=crr.cov.shape[1])
+with stage('print', model='CRE'):
+    print(crr)
 
 #%%
 
 #
 # comparing results
-print(plm.panel.compare({'POLS': por,
-                         'FD'  : fdr,
-                         'FE'  : fer,
-                         'RE'  : rer,
-                         'CRE' : crr},
-                        precision='std_errors'))
+with stage('print', model='compare'):
+    print(plm.panel.compare({'POLS': por,
+                             'FD'  : fdr,
+                             'FE'  : fer,
+                             'RE'  : rer,
+                             'CRE' : crr},
+                            precision='std_errors'))
 
 """
 Conclusion:
@@ -0,0 +1,172 @@
+# ---------------------------------------------------------
+#    panel_sim.py
+#
+#    Synthetic panels with known parameters, for checking the
+#    speed and accuracy of the estimators on any size of data
+#
+#        truth = simulate_panel('sim_wage', shape='wagepan',
+#                               N=100000, T=8, rho=0.5, seed=301)
+#        data, truth = load_panel('sim_wage')
+#
+#    Model, for entity i and period t
+#       x_it  = mu_i + v_it        (mu_i for time invariant x)
+#       c_i   = sigma_u (rho sqrt(K) mean(mu_i) + sqrt(1-rho^2) z_i)
+#       y_it  = alpha + x_it'beta + delta_t + c_i + s_i sigma_e e_it
+#    with mu, v, z, e standard normal. rho is the correlation
+#    between the effect c_i and the entity means of x (rho = 0
+#    makes RE consistent, rho > 0 is the CRE/Hausman case), the
+#    loading of c_i on each mu_ik is gamma = sigma_u rho / sqrt(K).
+#    s_i = exp(hetero z_s - hetero^2/2) makes the error variance
+#    differ between clusters.
+#
+#    Unbalanced panels have a spell of T_i in [min_T, T] periods
+#    starting at a random period, and interior periods missing
+#    with probability holes.
+#
+#    The rows are made in chunks of entities and written straight
+#    to one .npy file per column (open_memmap), so memory is one
+#    chunk whatever the number of rows. truth.json has the true
+#    parameters and the seed; the same seed and chunk_rows give
+#    the same panel.
+#
+
+#
+import os
+import json
+import numpy as np
+import pandas as pd
+
+
+#
+# column names of the Lab07 data sets; invariant regressors
+# do not change within an entity
+SHAPES = {
+    'rice': dict(entity='farmid', time='year', start=1990, dep='lnQ',
+                 exog=['lnD', 'lnL', 'lnF'], invariant=[]),
+    'airfare': dict(entity='id', time='year', start=1997, dep='lfare',
+                    exog=['concen', 'ldist'], invariant=['ldist']),
+    'wagepan': dict(entity='nr', time='year', start=1980, dep='lwage',
+                    exog=['educ', 'exper', 'married', 'union'],
+                    invariant=['educ']),
+}
+
+
+#
+# periods observed by each entity of a chunk (n x T)
+def _observed(rng, n, T, balanced, min_T, holes):
+    if balanced:
+        return np.ones((n, T), dtype=bool)
+    Ti = rng.integers(min_T, T + 1, size=n)
+    first = rng.integers(0, T - Ti + 1)
+    t = np.arange(T)
+    mask = (t >= first[:, None]) & (t < (first + Ti)[:, None])
+    if holes > 0:
+        interior = (t > first[:, None]) & (t < (first + Ti - 1)[:, None])
+        mask &= ~(interior & (rng.random((n, T)) < holes))
+    return mask
+
+
+def simulate_panel(path, shape='wagepan', N=1000, T=8, K=None, beta=None,
+                   alpha=1.0, balanced=True, min_T=2, holes=0.0, rho=0.5,
+                   sigma_u=1.0, sigma_e=1.0, hetero=0.0, time_effects=True,
+                   chunk_rows=1000000, seed=None):
+    spec = SHAPES[shape]
+    exog = spec['exog']
+    if K is not None and K != len(exog):
+        exog = ['x{}'.format(j + 1) for j in range(K)]
+    K = len(exog)
+    invariant = np.isin(exog, spec['invariant'])
+    root = np.random.SeedSequence(seed)
+    setup, chunks = root.spawn(2)
+    rng = np.random.default_rng(setup)
+    beta = np.round(rng.uniform(-1, 1, K), 3) if beta is None \
+        else np.asarray(beta, dtype=np.float64)
+    delta = np.r_[0.0, np.round(rng.normal(0, 0.1, T - 1), 3)] if time_effects \
+        else np.zeros(T)
+    gamma = sigma_u * rho / np.sqrt(K)
+
+    #
+    # entity chunks; the first pass only counts the rows
+    step = max(1, chunk_rows // T)
+    bounds = [(a, min(a + step, N)) for a in range(0, N, step)]
+    seeds = chunks.spawn(len(bounds))
+    sizes = [int(_observed(np.random.default_rng(s), b - a, T, balanced,
+                           min_T, holes).sum())
+             for s, (a, b) in zip(seeds, bounds)]
+    nobs = sum(sizes)
+
+    os.makedirs(path, exist_ok=True)
+    cols = {spec['entity']: np.int32 if N < 2**31 else np.int64,
+            spec['time']: np.int32, spec['dep']: np.float64}
+    cols.update({x: np.float64 for x in exog})
+    out = {c: np.lib.format.open_memmap(os.path.join(path, c + '.npy'), mode='w+',
+                                        dtype=dt, shape=(nobs,))
+           for c, dt in cols.items()}
+
+    row = 0
+    for s, (a, b), size in zip(seeds, bounds, sizes):
+        rng = np.random.default_rng(s)
+        n = b - a
+        mask = _observed(rng, n, T, balanced, min_T, holes)
+        ent, t = np.nonzero(mask)
+        mu = rng.standard_normal((n, K))
+        z = rng.standard_normal(n)
+        scale = np.exp(hetero * rng.standard_normal(n) - hetero ** 2 / 2)
+        c = sigma_u * (rho * mu.sum(axis=1) / np.sqrt(K) + np.sqrt(1 - rho ** 2) * z)
+        x = mu[ent] + rng.standard_normal((size, K)) * ~invariant
+        e = sigma_e * scale[ent] * rng.standard_normal(size)
+        y = alpha + x @ beta + delta[t] + c[ent] + e
+        sl = slice(row, row + size)
+        out[spec['entity']][sl] = a + ent + 1
+        out[spec['time']][sl] = spec['start'] + t
+        out[spec['dep']][sl] = y
+        for j, name in enumerate(exog):
+            out[name][sl] = x[:, j]
+        row += size
+    for m in out.values():
+        m.flush()
+
+    truth = {'shape': shape, 'N': N, 'T': T, 'K': K, 'nobs': nobs,
+             'entity': spec['entity'], 'time': spec['time'],
+             'dep': spec['dep'], 'exog': exog,
+             'invariant': [x for x, i in zip(exog, invariant) if i],
+             'alpha': alpha, 'beta': dict(zip(exog, beta.tolist())),
+             'gamma': dict(zip(exog, [gamma] * K)),
+             'delta': dict(zip([spec['start'] + t for t in range(T)],
+                               delta.tolist())),
+             'rho': rho, 'sigma_u': sigma_u, 'sigma_e': sigma_e,
+             'hetero': hetero, 'balanced': balanced, 'min_T': min_T,
+             'holes': holes, 'time_effects': time_effects,
+             'seed': root.entropy, 'chunk_rows': chunk_rows,
+             'columns': {c: np.dtype(dt).name for c, dt in cols.items()}}
+    with open(os.path.join(path, 'truth.json'), 'w') as f:
+        json.dump(truth, f, indent=1)
+    return truth
+
+
+#
+# columns as a DataFrame (or memory mapped arrays with
+# frame=False) and the true parameters
+def load_panel(path, columns=None, frame=True):
+    with open(os.path.join(path, 'truth.json')) as f:
+        truth = json.load(f)
+    columns = list(truth['columns']) if columns is None else columns
+    data = {c: np.load(os.path.join(path, c + '.npy'), mmap_mode='r')
+            for c in columns}
+    if frame:
+        data = pd.DataFrame({c: np.asarray(v) for c, v in data.items()})
+    return data, truth
+
+
+if __name__ == '__main__':
+    from panel_moments import fit_panel, compare
+    truth = simulate_panel('sim_wagepan', N=2000, T=8, balanced=False,
+                           holes=0.1, rho=0.5, hetero=0.5, seed=301)
+    data, truth = load_panel('sim_wagepan')
+    data = data.set_index([truth['entity'], truth['time']], drop=False)
+    data.index.names = ['i', 't']
+    exog = [x for x in truth['exog'] if x not in truth['invariant']]
+    formula = '{} ~ 1 + {} + C({})'.format(truth['dep'], ' + '.join(truth['exog']),
+                                          truth['time'])
+    print('true beta: {}'.format(truth['beta']))
+    print(compare(fit_panel(formula, data, means=exog)).loc[truth['exog']])
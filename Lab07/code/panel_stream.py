@@ -0,0 +1,311 @@
+# ---------------------------------------------------------
+#    panel_stream.py
+#
+#    POLS, between, FE, RE and CRE for CSV files larger than memory
+#
+#        fits = stream_panel('wagepan.csv',
+#                            'lwage ~ 1 + educ + exper + union + C(year)',
+#                            entity='nr', means=['exper', 'union'])
+#
+#    The file is read in chunks and must be sorted by entity (the
+#    rows of an entity may be split across chunks). Two passes:
+#
+#    1. Per-entity moments Q_i, s_i, T_i (see panel_moments.py) are
+#       formed chunk by chunk and summed by entity size T:
+#          sum_i Q_i,  sum_i s_i s_i'/T_i,  sum_i s_i
+#       Every estimate only needs these sums, since lam_i (and the
+#       RE theta_i) depends on the entity through T_i alone.
+#    2. With the estimates fixed, the file is read again and the
+#       cluster scores g_i of each entity are added to g g'.
+#
+#    Memory is one chunk plus O(S P^2) for S distinct entity sizes
+#    and P columns of [X, y]; nothing grows with the number of rows
+#    or entities. Categorical levels (e.g. C(year)) are learned by
+#    patsy in an extra pass when the formula has any. The results
+#    are those of fit_panel on the same data in memory, except that
+#    theta is reported by entity size rather than by entity.
+#
+
+#
+import numpy as np
+import pandas as pd
+import patsy
+
+from panel_transform import PanelIndex, PanelFit, strip_effects
+from panel_moments import PanelMoments
+
+
+#
+# moments summed by entity size
+class SizeMoments:
+
+    def __init__(self, names, dep):
+        self.names = list(names)
+        self.dep = dep
+        p = len(self.names) + 1
+        self.T = np.zeros(0)
+        self.count = np.zeros(0)
+        self.Q = np.zeros((0, p, p))
+        self.P = np.zeros((0, p, p))
+        self.s = np.zeros((0, p))
+        self.zmin = np.zeros((0, p))
+        self.zmax = np.zeros((0, p))
+
+    @property
+    def nentity(self):
+        return int(self.count.sum())
+
+    @property
+    def nobs(self):
+        return int(self.count @ self.T)
+
+    @property
+    def nvar(self):
+        return len(self.names)
+
+    def _group(self, t):
+        pos = np.flatnonzero(self.T == t)
+        if len(pos):
+            return pos[0]
+        p = self.nvar + 1
+        self.T = np.r_[self.T, t]
+        self.count = np.r_[self.count, 0.0]
+        self.Q = np.concatenate([self.Q, np.zeros((1, p, p))])
+        self.P = np.concatenate([self.P, np.zeros((1, p, p))])
+        self.s = np.concatenate([self.s, np.zeros((1, p))])
+        self.zmin = np.concatenate([self.zmin, np.full((1, p), np.inf)])
+        self.zmax = np.concatenate([self.zmax, np.full((1, p), -np.inf)])
+        return len(self.T) - 1
+
+    #
+    # add the moments of complete entities
+    def add(self, m):
+        zb = m.s / m.T[:, None]
+        P = np.einsum('gi,gj->gij', m.s, zb)
+        for t in np.unique(m.T):
+            sel = m.T == t
+            g = self._group(t)
+            self.count[g] += sel.sum()
+            self.Q[g] += m.Q[sel].sum(axis=0)
+            self.P[g] += P[sel].sum(axis=0)
+            self.s[g] += m.s[sel].sum(axis=0)
+            self.zmin[g] = np.minimum(self.zmin[g], zb[sel].min(axis=0))
+            self.zmax[g] = np.maximum(self.zmax[g], zb[sel].max(axis=0))
+        return self
+
+    #
+    # the same sums with entity means appended (PanelMoments.with_means)
+    def with_means(self, means, suffix='_b'):
+        k, p = self.nvar, self.nvar + 1
+        pos = [self.names.index(m) for m in means]
+        m = len(pos)
+        A = np.zeros((p + m, p))
+        A[np.arange(k), np.arange(k)] = 1.0
+        A[p + m - 1, k] = 1.0
+        C = np.zeros((p + m, p))
+        C[k + np.arange(m), pos] = 1.0
+        S = A + C
+        out = SizeMoments(self.names + ['{}{}'.format(self.names[i], suffix)
+                                        for i in pos], self.dep)
+        out.T, out.count = self.T.copy(), self.count.copy()
+        out.Q = (A @ self.Q @ A.T + A @ self.P @ C.T + C @ self.P @ A.T
+                 + C @ self.P @ C.T)
+        out.P = S @ self.P @ S.T
+        out.s = self.s @ S.T
+        out.zmin = self.zmin @ S.T
+        out.zmax = self.zmax @ S.T
+        return out
+
+    def zbar(self):
+        return self.s.sum(axis=0) / self.nobs
+
+    def _cross(self, lam, grand=False):
+        M = self.Q.sum(axis=0) - np.einsum('g,gij->ij', lam, self.P)
+        if grand:
+            zbar = self.zbar()
+            M = M + self.nobs * np.outer(zbar, zbar)
+        return M
+
+    def _has_constant(self):
+        Qd = np.diagonal(self.Q.sum(axis=0)) / self.nobs
+        return bool(np.any(np.isclose(self.zbar()[:-1], 1.0) &
+                           np.isclose(Qd[:-1], 1.0)))
+
+    _solve = PanelMoments._solve
+
+    def _pending(self, name, lam, grand=False, keep=None, theta=None):
+        M = self._cross(lam(self.T), grand)
+        b, w, keep = self._solve(M, keep)
+        return _Pending(self, name, M, b, w, keep, lam,
+                        self.zbar() if grand else None, theta)
+
+    def pooled(self):
+        return self._pending('POLS', np.zeros_like)
+
+    def fixed_effects(self):
+        grand = self._has_constant()
+        W = self._cross(np.ones(len(self.T)))
+        Qd = np.diagonal(self.Q.sum(axis=0))[:-1]
+        keep = np.diagonal(W)[:-1] > 1e-10 * np.maximum(Qd, 1e-300)
+        if grand:
+            keep |= (np.isclose(self.zbar()[:-1], 1.0)
+                     & np.isclose(Qd / self.nobs, 1.0))
+        return self._pending('FE', np.ones_like, grand, keep)
+
+    def _between_moments(self):
+        return np.einsum('g,gij->ij', 1.0 / self.T, self.P)
+
+    def between(self):
+        k, G = self.nvar, self.nentity
+        M = self._between_moments()
+        mean = (self.s / self.T[:, None]).sum(axis=0)[:k] / G
+        var = np.diagonal(M)[:k] / G - mean ** 2
+        big = np.maximum(np.abs(self.zmin), np.abs(self.zmax)).max(axis=0)[:k]
+        const = (np.isclose(self.zmin, 1.0) & np.isclose(self.zmax, 1.0)).all(axis=0)[:k]
+        keep = (var > 1e-12 * np.maximum(big ** 2, 1e-300)) | const
+        b, w, keep = self._solve(M, keep)
+        return _Pending(self, 'BE', M, b, w, keep, None, None, None)
+
+    def variance_components(self):
+        k, G, n = self.nvar, self.nentity, self.nobs
+        M = self._cross(np.ones(len(self.T)), self._has_constant())
+        b = np.linalg.lstsq(M[:k, :k], M[:k, k], rcond=None)[0]
+        sigma2_e = (M[k, k] - M[:k, k] @ b) / (n - k - G + 1)
+        Mb = self._between_moments()
+        bb = np.linalg.lstsq(Mb[:k, :k], Mb[:k, k], rcond=None)[0]
+        ssr_b = Mb[k, k] - Mb[:k, k] @ bb
+        t_bar = G / (self.count / self.T).sum()
+        sigma2_u = max(0.0, ssr_b / (G - k) - sigma2_e / t_bar)
+        return sigma2_e, sigma2_u
+
+    def random_effects(self, name='RE'):
+        sigma2_e, sigma2_u = self.variance_components()
+
+        def lam(T):
+            return 1.0 - sigma2_e / (T * sigma2_u + sigma2_e)
+
+        theta = pd.Series(1.0 - np.sqrt(sigma2_e / (self.T * sigma2_u + sigma2_e)),
+                          index=pd.Index(self.T.astype(int), name='T'))
+        fit = self._pending(name, lam, theta=theta.sort_index())
+        fit.sigma2_eps = sigma2_e
+        fit.sigma2_effects = sigma2_u
+        return fit
+
+
+#
+# an estimate waiting for its clustered covariance
+class _Pending:
+
+    def __init__(self, moments, name, M, b, w, keep, lam, zbar, theta):
+        self.name = name
+        self.names = moments.names
+        self.nobs = moments.nobs
+        self.nentity = moments.nentity
+        self.M, self.b, self.w, self.keep = M, b, w, keep
+        self.lam, self.zbar, self.theta = lam, zbar, theta
+        self.meat = np.zeros((keep.sum(), keep.sum()))
+
+    #
+    # scores of complete entities
+    def update(self, m):
+        if self.name == 'BE':
+            zb = m.s / m.T[:, None]
+            g = zb[:, :m.nvar][:, self.keep] * (zb @ self.w)[:, None]
+        else:
+            g = m._scores(self.lam(m.T), self.w, self.zbar is not None,
+                          self.zbar)[:, self.keep]
+        self.meat += g.T @ g
+
+    def result(self):
+        k, keep, kk = len(self.names), self.keep, self.keep.sum()
+        xpxi = np.linalg.inv(self.M[:k, :k][np.ix_(keep, keep)])
+        n = self.nentity if self.name == 'BE' else self.nobs
+        cov = np.full((k, k), np.nan)
+        cov[np.ix_(keep, keep)] = n / (n - kk) * xpxi @ self.meat @ xpxi
+        fit = PanelFit(self.name, pd.Series(self.b, index=self.names),
+                       pd.DataFrame(cov, index=self.names, columns=self.names),
+                       None, n, self.theta)
+        fit.resid_ss = float(self.w @ self.M @ self.w)
+        for attr in ('sigma2_eps', 'sigma2_effects'):
+            if hasattr(self, attr):
+                setattr(fit, attr, getattr(self, attr))
+        return fit
+
+
+def _take(m, sel):
+    return PanelMoments(m.Q[sel], m.s[sel], m.T[sel], m.names, m.dep)
+
+
+#
+# per-entity moments of complete entities, one PanelMoments per chunk
+def entity_chunks(path, design, entity, chunksize=100000, **read_kw):
+    ydi, Xdi = design
+    dep = ydi.column_names[0]
+    carry, last = None, None
+    for chunk in pd.read_csv(path, chunksize=chunksize, **read_kw):
+        y, X = patsy.build_design_matrices([ydi, Xdi], chunk,
+                                           return_type='dataframe')
+        if len(X) == 0:
+            continue
+        index = PanelIndex(chunk.loc[X.index, entity].to_numpy())
+        if not index.is_sorted or (last is not None and index.labels[0] < last):
+            raise ValueError('{} is not sorted by {}'.format(path, entity))
+        m = PanelMoments.from_arrays(X.to_numpy(), y.iloc[:, 0].to_numpy(),
+                                     index, Xdi.column_names, dep)
+        if carry is not None:
+            if index.labels[0] == last:
+                m.Q[0] += carry.Q[0]
+                m.s[0] += carry.s[0]
+                m.T[0] += carry.T[0]
+            else:
+                yield carry
+        #
+        # the last entity may continue in the next chunk
+        carry = _take(m, slice(m.nentity - 1, None))
+        last = index.labels[-1]
+        if m.nentity > 1:
+            yield _take(m, slice(0, m.nentity - 1))
+    if carry is not None:
+        yield carry
+
+
+#
+# design of the formula for the whole file; categorical levels
+# are collected from all chunks
+def stream_design(path, formula, chunksize=100000, **read_kw):
+    def chunks():
+        return pd.read_csv(path, chunksize=chunksize, **read_kw)
+    return patsy.incr_dbuilders(strip_effects(formula), chunks)
+
+
+#
+# POLS, BE, FE, RE (and CRE with means) from a CSV sorted by entity
+def stream_panel(path, formula, entity, means=None, chunksize=100000,
+                 **read_kw):
+    design = stream_design(path, formula, chunksize, **read_kw)
+    ydi, Xdi = design
+    moments = SizeMoments(Xdi.column_names, ydi.column_names[0])
+    for m in entity_chunks(path, design, entity, chunksize, **read_kw):
+        moments.add(m)
+
+    pending = {'POLS': moments.pooled(),
+               'BE': moments.between(),
+               'FE': moments.fixed_effects(),
+               'RE': moments.random_effects()}
+    if means:
+        pending['CRE'] = moments.with_means(means).random_effects(name='CRE')
+
+    for m in entity_chunks(path, design, entity, chunksize, **read_kw):
+        for name, fit in pending.items():
+            fit.update(m.with_means(means) if name == 'CRE' else m)
+    return {name: fit.result() for name, fit in pending.items()}
+
+
+if __name__ == '__main__':
+    from panel_moments import compare
+    fits = stream_panel('wagepan.csv',
+                        'lwage ~ 1 + educ + black + hisp + exper + expersq'
+                        ' + married + union + C(year)',
+                        entity='nr', means=['married', 'union'],
+                        chunksize=1000)
+    print(compare(fits))
@@ -0,0 +1,433 @@
+# ---------------------------------------------------------
+#    panel_transform.py
+#
+#    Entity demeaning, lags and differences without dummy variables
+#
+#    PanelIndex codes the entity (and period) of every row once as
+#    int32 and orders the rows by entity (a stable sort), with
+#    offsets into the sorted rows for each entity (CSR layout).
+#    Entity sums of all columns are then a single np.add.reduceat
+#    over the sorted block, and
+#       within        x - xbar_i
+#       quasi-demean  x - theta_i xbar_i       (RE)
+#       entity means  xbar_i                   (CRE)
+#    are one gather of the (N x K) means, O(NT K) in total. Lags
+#    and leads are a gather of the rows found through an (entity x
+#    period) table. The same index serves the cluster covariance
+#    (cluster_cov.py) and the cluster bootstrap (boot_runner.py,
+#    cluster_boot.py).
+#
+#    The estimators below use these transforms for the FE, RE
+#    and CRE fits, with the same conventions as linearmodels
+#    (grand mean added back for the FE constant, Swamy-Arora
+#    variance components, clustered covariance scaled n/(n-K)).
+#
+
+#
+import re
+import numpy as np
+import pandas as pd
+import patsy
+
+from instrument import timed
+
+
+#
+# values of a column, or of an index level if there is no such column
+def panel_key(data, key):
+    if isinstance(key, str) and key in data.columns:
+        return data[key].to_numpy()
+    return data.index.get_level_values(key).to_numpy()
+
+
+def _compact(values, bound):
+    return np.asarray(values, dtype=np.int32 if bound < 2**31 else np.int64)
+
+
+#
+# panel structure, built once and shared by the transforms
+#   codes      entity code of every row (int32), labels in sorted
+#              order, or in order of appearance with sort=False
+#   order      rows sorted by entity (None if already sorted)
+#   offsets    entity g has the sorted rows offsets[g]:offsets[g+1]
+#              (CSR layout), counts = T_i
+#   pcodes     period code of every row (int32), periods labels
+#   balanced   every entity has every period once
+#   gaps       periods missing inside the span of each entity
+# Integer periods are used as they are, so a missing year is a
+# gap; other periods are numbered in sorted order.
+class PanelIndex:
+
+    def __init__(self, entity, period=None, sort=True):
+        codes, labels = pd.factorize(np.asarray(entity), sort=sort)
+        n = len(codes)
+        self.codes = _compact(codes, max(n, 1))
+        self.labels = labels
+        self.counts = _compact(np.bincount(codes), n)
+        self.offsets = _compact(np.r_[0, np.cumsum(self.counts)], n + 1)
+        self.is_sorted = bool(np.all(codes[1:] >= codes[:-1]))
+        self.order = None if self.is_sorted else \
+            _compact(np.argsort(codes, kind='stable'), n)
+        self._shifts = {}
+        self.pcodes = None
+        self.periods = None
+        self.balanced = None
+        self.gaps = None
+        if period is not None:
+            self._set_period(np.asarray(period))
+
+    def _set_period(self, period):
+        pcodes, self.periods = pd.factorize(period, sort=True)
+        self.pcodes = _compact(pcodes, len(pcodes))
+        if period.dtype.kind in 'iu':
+            self._ptime = period.astype(np.int64) - period.min()
+        else:
+            self._ptime = pcodes.astype(np.int64)
+        span = self.reduce(self._ptime, np.maximum) - \
+            self.reduce(self._ptime, np.minimum) + 1
+        self.gaps = _compact(span - self.counts, self.nobs)
+        self.balanced = bool(np.all(self.counts == self.nperiod) and
+                             not self.gaps.any())
+
+    #
+    # entity from a column or an index level (default level 0),
+    # period likewise if time is given
+    @classmethod
+    def from_data(cls, data, entity=0, time=None, sort=True):
+        period = None if time is None else panel_key(data, time)
+        return cls(panel_key(data, entity), period, sort)
+
+    @property
+    def nentity(self):
+        return len(self.counts)
+
+    @property
+    def nperiod(self):
+        return 0 if self.periods is None else len(self.periods)
+
+    @property
+    def nobs(self):
+        return len(self.codes)
+
+    @property
+    def starts(self):
+        return self.offsets[:-1]
+
+    @property
+    def has_gaps(self):
+        return bool(self.gaps is not None and self.gaps.any())
+
+    def _sorted(self, values):
+        if self.order is not None:
+            return values[self.order]
+        return values
+
+    def sums(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        return np.add.reduceat(self._sorted(values), self.starts, axis=0)
+
+    #
+    # any reduction by entity, e.g. np.maximum
+    def reduce(self, values, ufunc):
+        return ufunc.reduceat(self._sorted(values), self.starts, axis=0)
+
+    def means(self, values):
+        s = self.sums(values)
+        if s.ndim == 1:
+            return s / self.counts
+        return s / self.counts[:, None]
+
+    #
+    # entity values repeated for each row
+    def expand(self, values):
+        return np.asarray(values)[self.codes]
+
+    def demean(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        return values - self.expand(self.means(values))
+
+    #
+    # theta is a scalar or one value per entity
+    def quasi_demean(self, values, theta):
+        values = np.asarray(values, dtype=np.float64)
+        theta = np.broadcast_to(np.asarray(theta, dtype=np.float64),
+                                (self.nentity,))
+        means = self.means(values)
+        if means.ndim == 1:
+            return values - self.expand(theta * means)
+        return values - self.expand(theta[:, None] * means)
+
+    #
+    # sorted row positions of a set of entities (with repeats),
+    # one block after the other, e.g. for a cluster bootstrap
+    def rows(self, entities):
+        entities = np.asarray(entities)
+        rep = self.counts[entities].astype(np.int64)
+        first = np.repeat(np.cumsum(rep) - rep, rep)
+        pos = np.repeat(self.starts[entities], rep) + np.arange(rep.sum()) - first
+        return pos if self.order is None else self.order[pos]
+
+    #
+    # row position of the observation k periods earlier (k > 0)
+    # or later (k < 0) in the same entity, -1 where that period
+    # is not observed (start or end of the entity, or a gap).
+    # Rows are found in a dense (entity x period) table when it
+    # is not much larger than the data, otherwise by a binary
+    # search of the sorted keys. Cached for each k.
+    def shift(self, k=1):
+        if k in self._shifts:
+            return self._shifts[k]
+        if self.pcodes is None:
+            raise ValueError('the index has no periods')
+        p = self._ptime
+        span = int(p.max()) + 1
+        key = self.codes.astype(np.int64) * span + p
+        tkey = key - k
+        valid = (p >= k) & (p < span + k)
+        n, size = self.nobs, self.nentity * span
+        if size <= 4 * n:
+            #
+            # the last slot of the table is -1 for targets outside the panel
+            table = np.full(size + 1, -1, dtype=np.int64)
+            table[key] = np.arange(n)
+            if np.count_nonzero(table >= 0) < n:
+                raise ValueError('more than one row for an entity and period')
+            pos = table[np.where(valid, tkey, size)]
+        else:
+            order = np.argsort(key, kind='stable')
+            skey = key[order]
+            if np.any(skey[1:] == skey[:-1]):
+                raise ValueError('more than one row for an entity and period')
+            pos = np.minimum(np.searchsorted(skey, tkey), n - 1)
+            pos = np.where(valid & (skey[pos] == tkey), order[pos], -1)
+        self._shifts[k] = pos
+        return pos
+
+    #
+    # lag and difference of the rows of an array, NaN where the
+    # period is missing
+    def lag(self, values, k=1):
+        values = np.asarray(values, dtype=np.float64)
+        pos = self.shift(k)
+        out = values[pos]
+        out[pos < 0] = np.nan
+        return out
+
+    def lead(self, values, k=1):
+        return self.lag(values, -k)
+
+    def diff(self, values, k=1):
+        return np.asarray(values, dtype=np.float64) - self.lag(values, k)
+
+
+def _shifted(data, columns, k, entity, time, index):
+    single = isinstance(columns, str)
+    cols = [columns] if single else list(columns)
+    if index is None:
+        index = PanelIndex.from_data(data, entity, time)
+    values = data[cols].to_numpy(dtype=np.float64)
+    return values, index.lag(values, k), cols, single
+
+
+def _frame(data, values, cols, single):
+    if single:
+        return pd.Series(values[:, 0], index=data.index, name=cols[0])
+    return pd.DataFrame(values, index=data.index, columns=cols)
+
+
+#
+# panel lag, lead and difference of one column (a Series) or a
+# list of columns (a DataFrame), NaN where the period is missing;
+# entity and time are columns or index levels, or pass a
+# PanelIndex of data to reuse it
+#   rice['lrhat'] = lag(rice, 'rhat')
+def lag(data, columns, k=1, entity=0, time=1, index=None):
+    values, out, cols, single = _shifted(data, columns, k, entity, time, index)
+    return _frame(data, out, cols, single)
+
+
+def lead(data, columns, k=1, entity=0, time=1, index=None):
+    return lag(data, columns, -k, entity, time, index)
+
+
+def diff(data, columns, k=1, entity=0, time=1, index=None):
+    values, out, cols, single = _shifted(data, columns, k, entity, time, index)
+    return _frame(data, values - out, cols, single)
+
+
+#
+# fitted model
+class PanelFit:
+
+    def __init__(self, name, params, cov, resids, nobs, theta=None):
+        self.name = name
+        self.params = params
+        self.cov = cov
+        self.std_errors = pd.Series(np.sqrt(np.diag(cov)), index=params.index)
+        self.tstats = params / self.std_errors
+        self.resids = resids
+        self.nobs = nobs
+        self.theta = theta
+
+    def __str__(self):
+        return '{} estimates, clustered by entity\n{}'.format(
+            self.name, pd.DataFrame({'params': self.params,
+                                     'std_errors': self.std_errors,
+                                     'tstats': self.tstats}))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+#
+# formula without the linearmodels EntityEffects term
+def strip_effects(formula):
+    return re.sub(r'\+\s*EntityEffects\b|\bEntityEffects\s*\+', '', formula)
+
+
+#
+# y and X from a linearmodels style formula; the EntityEffects
+# term is dropped, entities are taken from index level 0
+@timed('design')
+def panel_design(formula, data):
+    formula = strip_effects(formula)
+    y, X = patsy.dmatrices(formula, data, return_type='dataframe')
+    index = PanelIndex(X.index.get_level_values(0).to_numpy())
+    return y.iloc[:, 0].to_numpy(), X, index
+
+
+#
+# least squares with covariance clustered by entity
+def _ols(name, y, X, names, index, theta=None, scale=True):
+    params = np.linalg.lstsq(X, y, rcond=None)[0]
+    e = y - X @ params
+    xpxi = np.linalg.inv(X.T @ X)
+    s = index.sums(X * e[:, None])
+    cov = xpxi @ (s.T @ s) @ xpxi
+    if scale:
+        cov *= len(y) / (len(y) - X.shape[1])
+    return PanelFit(name, pd.Series(params, index=names),
+                    pd.DataFrame(cov, index=names, columns=names),
+                    e, len(y), theta)
+
+
+def _has_constant(X):
+    return bool(np.any(np.all(X == 1.0, axis=0)))
+
+
+#
+# fixed effects (within) estimator
+def within_fit(y, X, names, index):
+    yd = index.demean(y)
+    Xd = index.demean(X)
+    if _has_constant(X):
+        yd = yd + y.mean()
+        Xd = Xd + X.mean(axis=0)
+    return _ols('FE', yd, Xd, names, index)
+
+
+#
+# Swamy-Arora variance components and theta for each entity
+def swamy_arora(y, X, index):
+    k = X.shape[1]
+    yd = index.demean(y)
+    Xd = index.demean(X)
+    if _has_constant(X):
+        yd = yd + y.mean()
+        Xd = Xd + X.mean(axis=0)
+    eps = yd - Xd @ np.linalg.lstsq(Xd, yd, rcond=None)[0]
+    sigma2_e = eps @ eps / (index.nobs - k - index.nentity + 1)
+    yb = index.means(y)
+    Xb = index.means(X)
+    u = yb - Xb @ np.linalg.lstsq(Xb, yb, rcond=None)[0]
+    t_bar = index.nentity / (1.0 / index.counts).sum()
+    sigma2_u = max(0.0, u @ u / (index.nentity - k) - sigma2_e / t_bar)
+    theta = 1.0 - np.sqrt(sigma2_e / (index.counts * sigma2_u + sigma2_e))
+    return sigma2_e, sigma2_u, theta
+
+
+#
+# random effects (quasi-demeaned) estimator
+def random_effects_fit(y, X, names, index, name='RE'):
+    sigma2_e, sigma2_u, theta = swamy_arora(y, X, index)
+    yq = index.quasi_demean(y, theta)
+    Xq = index.quasi_demean(X, theta)
+    return _ols(name, yq, Xq, names, index, theta=theta)
+
+
+#
+# formula front ends, e.g.
+#   fixed_effects('lnQ ~ 1 + lnD + lnL + lnF + year + EntityEffects', rice)
+def fixed_effects(formula, data):
+    y, X, index = panel_design(formula, data)
+    return within_fit(y, X.to_numpy(), list(X.columns), index)
+
+
+def random_effects(formula, data):
+    y, X, index = panel_design(formula, data)
+    return random_effects_fit(y, X.to_numpy(), list(X.columns), index)
+
+
+#
+# first difference estimator; the differences use the same
+# operator as diff(), so a gap drops the row instead of
+# differencing across it. The index is (entity, period).
+@timed('FD')
+def first_difference(formula, data):
+    y, X = patsy.dmatrices(strip_effects(formula), data, return_type='dataframe')
+    X = X.drop(columns='Intercept', errors='ignore')
+    Z = np.column_stack([y.to_numpy(), X.to_numpy()])
+    dZ = PanelIndex.from_data(y, 0, 1).diff(Z)
+    keep = ~np.isnan(dZ).any(axis=1)
+    dZ = dZ[keep]
+    index = PanelIndex(y.index.get_level_values(0).to_numpy()[keep])
+    return _ols('FD', dZ[:, 0], dZ[:, 1:], list(X.columns), index)
+
+
+#
+# correlated random effects: RE with the entity means of the
+# listed variables added as regressors (named var_b)
+def correlated_random_effects(formula, data, means):
+    y, X, index = panel_design(formula, data)
+    Xm = index.expand(index.means(X[means].to_numpy()))
+    names = list(X.columns) + ['{}_b'.format(m) for m in means]
+    return random_effects_fit(y, np.column_stack([X.to_numpy(), Xm]), names,
+                              index, name='CRE')
+
+
+#
+# Mundlak / CRE features for a list of variables
+#   all entity means (var_b) and optionally the within deviations
+#   (var_w) come from one grouped reduction over the block of
+#   columns; missing values are skipped as in groupby().mean()
+#   entity is a column or an index level (or pass a PanelIndex
+#   of data), the result has the index of data so it can be
+#   assigned without re-indexing
+@timed('mundlak')
+def mundlak(data, variables, entity=0, within=False, suffix='_b',
+            within_suffix='_w', index=None):
+    if index is None:
+        index = PanelIndex.from_data(data, entity)
+    values = data[list(variables)].to_numpy(dtype=np.float64)
+    missing = np.isnan(values)
+    sums = index.sums(np.where(missing, 0.0, values))
+    counts = index.sums((~missing).astype(np.float64))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = index.expand(sums / counts)
+    cols = ['{}{}'.format(v, suffix) for v in variables]
+    blocks = [means]
+    if within:
+        cols += ['{}{}'.format(v, within_suffix) for v in variables]
+        blocks.append(values - means)
+    return pd.DataFrame(np.hstack(blocks), index=data.index, columns=cols)
+
+
+#
+# add the Mundlak columns to data in place
+def add_mundlak(data, variables, entity=0, within=False, suffix='_b',
+                within_suffix='_w', index=None):
+    feats = mundlak(data, variables, entity, within, suffix, within_suffix,
+                    index)
+    for c in feats.columns:
+        data[c] = feats[c].to_numpy()
+    return data
@@ -0,0 +1,304 @@
+# ---------------------------------------------------------
+#    panel_update.py
+#
+#    FE, RE and CRE estimates that are updated as new rows arrive
+#
+#        state = PanelState('lnQ', ['lnD', 'lnL', 'lnF'], 'farmid', 'year',
+#                           means=['lnD', 'lnL', 'lnF'])
+#        state.update(rice[rice.year < 1997])
+#        state.update(rice[rice.year == 1997])       # a new wave
+#        fits = state.fit_all()
+#        state.check(rice)                           # against a refit
+#
+#    The state keeps
+#       per entity      Q_i, s_i, T_i of z = [y, 1, x, year dummies]
+#       per entity size T (all entities with T_i = T together)
+#                       sum Q_i, sum s_i s_i'/T, sum s_i and
+#                       sum A_i (x) B_i for A, B in {Q_i, s_i s_i'}
+#    with the CRE entity means appended as extra columns. The
+#    estimates depend on the entities only through these sums
+#    (see panel_stream.py), and the clustered covariance
+#       sum_i g_i g_i',  g_i = (Q_i - lam_T s_i s_i'/T) w
+#    is a quadratic form in w = [-b, 1] of the fourth order sums,
+#    so it follows without the data for any new b.
+#
+#    An update moves the entities it touches from their old size
+#    group to the new one: the work is proportional to the new rows
+#    (times P^4 for the fourth order sums of P columns), whatever
+#    the size of the panel. A new period adds a year dummy, which
+#    is zero for all earlier rows; the column arrays are allocated
+#    with spare room so this does not touch the stored entities.
+#
+
+#
+import numpy as np
+import pandas as pd
+
+from panel_transform import PanelIndex
+from panel_moments import PanelMoments
+from panel_stream import SizeMoments
+from lab_data import load_data
+
+
+class PanelState:
+
+    def __init__(self, dep, exog, entity, time, means=None, capacity=8):
+        self.dep = dep
+        self.exog = list(exog)
+        self.entity = entity
+        self.time = time
+        self.means = list(means or [])
+        self.levels = []
+        self.names = [dep, 'Intercept'] + self.exog
+        self.cap = len(self.names) + capacity
+        self.rows = {}
+        self.Q = np.zeros((0, self.cap, self.cap))
+        self.s = np.zeros((0, self.cap))
+        self.T = np.zeros(0)
+        a = self.cap + len(self.means)
+        self.gT = np.zeros(0)
+        self.count = np.zeros(0)
+        self.gQ = np.zeros((0, a, a))
+        self.gP = np.zeros((0, a, a))
+        self.gs = np.zeros((0, a))
+        self.QQ = np.zeros((0, a, a, a, a))
+        self.QS = np.zeros((0, a, a, a, a))
+        self.SS = np.zeros((0, a, a, a, a))
+
+    @property
+    def nentity(self):
+        return len(self.rows)
+
+    @property
+    def nobs(self):
+        return int(self.T.sum())
+
+    #
+    # more room for columns: zeros are inserted after the raw
+    # columns (before the CRE means) on every column axis
+    def _grow_columns(self):
+        old, new = self.cap, 2 * self.cap
+        pad = [old] * (new - old)
+        self.Q = np.insert(np.insert(self.Q, pad, 0.0, axis=1), pad, 0.0, axis=2)
+        self.s = np.insert(self.s, pad, 0.0, axis=1)
+        self.gQ = np.insert(np.insert(self.gQ, pad, 0.0, axis=1), pad, 0.0, axis=2)
+        self.gP = np.insert(np.insert(self.gP, pad, 0.0, axis=1), pad, 0.0, axis=2)
+        self.gs = np.insert(self.gs, pad, 0.0, axis=1)
+        for attr in ('QQ', 'QS', 'SS'):
+            K = getattr(self, attr)
+            for ax in range(1, 5):
+                K = np.insert(K, pad, 0.0, axis=ax)
+            setattr(self, attr, K)
+        self.cap = new
+
+    def _grow_rows(self, n):
+        if len(self.T) >= n:
+            return
+        extra = max(n, 2 * len(self.T)) - len(self.T)
+        self.Q = np.concatenate([self.Q, np.zeros((extra, self.cap, self.cap))])
+        self.s = np.concatenate([self.s, np.zeros((extra, self.cap))])
+        self.T = np.concatenate([self.T, np.zeros(extra)])
+
+    def _group(self, t):
+        pos = np.flatnonzero(self.gT == t)
+        if len(pos):
+            return pos[0]
+        a = self.cap + len(self.means)
+        self.gT = np.r_[self.gT, t]
+        self.count = np.r_[self.count, 0.0]
+        self.gQ = np.concatenate([self.gQ, np.zeros((1, a, a))])
+        self.gP = np.concatenate([self.gP, np.zeros((1, a, a))])
+        self.gs = np.concatenate([self.gs, np.zeros((1, a))])
+        for attr in ('QQ', 'QS', 'SS'):
+            setattr(self, attr, np.concatenate([getattr(self, attr),
+                                                np.zeros((1, a, a, a, a))]))
+        return len(self.gT) - 1
+
+    #
+    # add (sign 1) or remove (sign -1) entities from their size groups
+    def _move(self, rows, sign):
+        T = self.T[rows]
+        rows = rows[T > 0]
+        if not len(rows):
+            return
+        T = self.T[rows]
+        Q, s, cap = self.Q[rows], self.s[rows], self.cap
+        pos = [self.names.index(m) for m in self.means]
+        S = np.einsum('gi,gj->gij', s, s)
+        P = S / T[:, None, None]
+        Qa = np.concatenate([np.concatenate([Q, P[:, :, pos]], axis=2),
+                             np.concatenate([P[:, pos, :cap], P[:, pos][:, :, pos]],
+                                            axis=2)], axis=1)
+        sa = np.concatenate([s, s[:, pos]], axis=1)
+        Sa = np.einsum('gi,gj->gij', sa, sa)
+        for t in np.unique(T):
+            sel = T == t
+            g = self._group(t)
+            self.count[g] += sign * sel.sum()
+            self.gQ[g] += sign * Qa[sel].sum(axis=0)
+            self.gP[g] += sign * Sa[sel].sum(axis=0) / t
+            self.gs[g] += sign * sa[sel].sum(axis=0)
+            self.QQ[g] += sign * np.einsum('gac,gbd->acbd', Qa[sel], Qa[sel])
+            self.QS[g] += sign * np.einsum('gac,gbd->acbd', Qa[sel], Sa[sel])
+            self.SS[g] += sign * np.einsum('gac,gbd->acbd', Sa[sel], Sa[sel])
+
+    #
+    # rows of [y, 1, x, year dummies] for new data; the first
+    # period seen is the reference, later ones get a dummy
+    def _design(self, data):
+        for lev in sorted(set(data[self.time].unique()) - set(self.levels)):
+            if self.levels:
+                if len(self.names) == self.cap:
+                    self._grow_columns()
+                self.names.append('{}[T.{}]'.format(self.time, lev))
+            self.levels.append(lev)
+        Z = np.zeros((len(data), self.cap))
+        Z[:, 0] = data[self.dep].to_numpy(np.float64)
+        Z[:, 1] = 1.0
+        Z[:, 2:len(self.exog) + 2] = data[self.exog].to_numpy(np.float64)
+        col = {lev: self.names.index('{}[T.{}]'.format(self.time, lev))
+               for lev in self.levels[1:]}
+        t = data[self.time].to_numpy()
+        for lev, j in col.items():
+            Z[:, j] = t == lev
+        return Z
+
+    #
+    # absorb new rows: a new period, new entities or both
+    def update(self, data):
+        data = data.dropna(subset=[self.dep] + self.exog)
+        if not len(data):
+            return self
+        Z = self._design(data)
+        index = PanelIndex(data[self.entity].to_numpy())
+        Q = np.zeros((index.nentity, self.cap, self.cap))
+        for j in range(len(self.names)):
+            Q[:, j, :] = index.sums(Z * Z[:, j:j+1])
+        s = index.sums(Z)
+
+        rows = np.empty(index.nentity, dtype=np.int64)
+        for i, lab in enumerate(index.labels):
+            rows[i] = self.rows.setdefault(lab, len(self.rows))
+        self._grow_rows(len(self.rows))
+        self._move(rows, -1)
+        self.Q[rows] += Q
+        self.s[rows] += s
+        self.T[rows] += index.counts
+        self._move(rows, 1)
+        return self
+
+    #
+    # sums by entity size for the columns of one estimator,
+    # ordered [1, x, year dummies, (means), y] as in PanelMoments
+    def _columns(self, cre):
+        cols = list(range(1, len(self.names)))
+        names = self.names[1:]
+        if cre:
+            cols += [self.cap + i for i in range(len(self.means))]
+            names += ['{}_b'.format(m) for m in self.means]
+        return cols + [0], names
+
+    def _moments(self, cols, names):
+        sm = SizeMoments(names, self.dep)
+        used = self.count > 0
+        sm.T, sm.count = self.gT[used], self.count[used]
+        sm.Q = self.gQ[used][:, cols][:, :, cols]
+        sm.P = self.gP[used][:, cols][:, :, cols]
+        sm.s = self.gs[used][:, cols]
+        return sm, np.flatnonzero(used)
+
+    #
+    # sum_i g_i g_i' from the fourth order sums
+    def _meat(self, pending, cols, groups):
+        k, w, keep = len(cols) - 1, pending.w, pending.keep
+        ix = np.ix_(cols, cols, cols, cols)
+        meat = np.zeros((k + 1, k + 1))
+        for g in groups:
+            t, n = self.gT[g], self.count[g]
+            c = pending.lam(np.array([t]))[0] / t
+            QS = np.einsum('acbd,c,d->ab', self.QS[g][ix], w, w)
+            B = (np.einsum('acbd,c,d->ab', self.QQ[g][ix], w, w)
+                 - c * (QS + QS.T)
+                 + c * c * np.einsum('acbd,c,d->ab', self.SS[g][ix], w, w))
+            if pending.zbar is not None:
+                a = (pending.zbar @ w) * pending.zbar
+                sA = (self.gQ[g][np.ix_(cols, cols)]
+                      - c * t * self.gP[g][np.ix_(cols, cols)]) @ w
+                B += t * (np.outer(sA, a) + np.outer(a, sA)) + n * t * t * np.outer(a, a)
+            meat += B
+        return meat[:k, :k][np.ix_(keep, keep)]
+
+    def _estimate(self, name):
+        cols, names = self._columns(name == 'CRE')
+        sm, groups = self._moments(cols, names)
+        if name == 'POLS':
+            pending = sm.pooled()
+        elif name == 'FE':
+            pending = sm.fixed_effects()
+        else:
+            pending = sm.random_effects(name=name)
+        pending.meat = self._meat(pending, cols, groups)
+        return pending.result()
+
+    def pooled(self):
+        return self._estimate('POLS')
+
+    def fixed_effects(self):
+        return self._estimate('FE')
+
+    def random_effects(self):
+        return self._estimate('RE')
+
+    def correlated_random_effects(self):
+        return self._estimate('CRE')
+
+    def fit_all(self):
+        names = ['POLS', 'FE', 'RE'] + (['CRE'] if self.means else [])
+        return {name: self._estimate(name) for name in names}
+
+    #
+    # largest differences to a full refit on all rows seen so far;
+    # the refit uses the columns in the order of the state, so
+    # that collinear columns (exper with the year dummies and
+    # entity effects) are dropped the same way
+    def check(self, data, tol=1e-8):
+        frame = data.copy()
+        frame.index = pd.MultiIndex.from_arrays([data[self.entity].to_numpy(),
+                                                 data[self.time].to_numpy()])
+        frame[self.time] = pd.Categorical(data[self.time].to_numpy(),
+                                          categories=self.levels)
+        formula = '{} ~ 1 + {} + {}'.format(self.dep, ' + '.join(self.exog),
+                                            self.time)
+        full = PanelMoments.from_formula(formula, frame).reorder(self.names[1:])
+        full = full.fit_all(self.means or None)
+        rows = []
+        for name, fit in self.fit_all().items():
+            ref = full[name]
+            dp = (fit.params - ref.params[fit.params.index]).abs().max()
+            ds = (fit.std_errors - ref.std_errors[fit.params.index]).abs().max()
+            rows.append((name, dp, ds, max(dp, ds) < tol))
+        return pd.DataFrame(rows, columns=['model', 'params', 'std_errors',
+                                           'ok']).set_index('model')
+
+
+if __name__ == '__main__':
+    rice = load_data('rice3.csv')
+    for v, c in [('lnQ', 'prod'), ('lnD', 'area'), ('lnL', 'labor'), ('lnF', 'fert')]:
+        rice[v] = np.log(rice[c])
+    state = PanelState('lnQ', ['lnD', 'lnL', 'lnF'], 'farmid', 'year',
+                       means=['lnD', 'lnL', 'lnF'])
+    #
+    # start with 1990-1996, then one wave at a time
+    state.update(rice[rice.year < 1997])
+    state.update(rice[rice.year == 1997])
+    print(state.fit_all()['CRE'])
+    print(state.check(rice))
+    #
+    # wagepan: exper is collinear with the year dummies under FE
+    wage = load_data('wagepan.csv')
+    state = PanelState('lwage', ['educ', 'black', 'hisp', 'exper', 'expersq',
+                                 'married', 'union'], 'nr', 'year',
+                       means=['married', 'union'])
+    state.update(wage[wage.year < 1987])
+    state.update(wage[wage.year == 1987])
+    print(state.check(wage))
@@ -0,0 +1,108 @@
+# ---------------------------------------------------------
+#    wald_batch.py
+#
+#    Wald tests for many restriction sets and several models
+#
+#    Restriction strings such as
+#       ['year[T.1991]=0', 'year[T.1992]=0', ...]
+#       'lnD + lnL + lnF = 1'
+#    are compiled to (R, q) once per set of parameter names and
+#    kept in a cache, so repeated tests do not parse strings.
+#    The tests for one model are then evaluated together: all
+#    hypotheses with the same number of restrictions J are stacked
+#    into (H x J x K) and
+#       W = (R b - q)' (R V R')^-1 (R b - q)
+#    is one batched solve. The statistic is the chi2 form used by
+#    linearmodels' wald_test.
+#
+
+#
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+import patsy
+from scipy import stats
+
+from instrument import timed
+
+
+#
+# (R, q) for one restriction set, cached by parameter names
+@lru_cache(maxsize=65536)
+def _compile(names, hypothesis):
+    lc = patsy.DesignInfo(list(names)).linear_constraint(list(hypothesis))
+    return lc.coefs, lc.constants.reshape(-1)
+
+
+def compile_restrictions(names, hypothesis):
+    if isinstance(hypothesis, str):
+        hypothesis = [hypothesis]
+    return _compile(tuple(names), tuple(hypothesis))
+
+
+#
+# parameters and covariance of a fitted model: linearmodels,
+# statsmodels or the PanelFit results of this directory
+def model_moments(res):
+    params = res.params
+    if hasattr(res, 'cov_params'):
+        cov = res.cov_params()
+    else:
+        cov = res.cov
+    names = list(params.index)
+    b = np.asarray(params, dtype=np.float64)
+    V = np.asarray(pd.DataFrame(cov).loc[names, names], dtype=np.float64)
+    return names, b, V
+
+
+def _label(hypothesis):
+    if isinstance(hypothesis, str):
+        return hypothesis
+    return ', '.join(hypothesis)
+
+
+#
+# all tests for one model
+def _model_tests(names, b, V, hypotheses):
+    out = {}
+    groups = {}
+    for label, hyp in hypotheses.items():
+        try:
+            R, q = compile_restrictions(names, hyp)
+        except patsy.PatsyError:
+            #
+            # a parameter of the hypothesis is not in the model
+            continue
+        groups.setdefault(R.shape[0], []).append((label, R, q))
+    for J, items in groups.items():
+        R = np.stack([r for _, r, _ in items])
+        q = np.stack([c for _, _, c in items])
+        d = R @ b - q
+        RVR = np.einsum('hjk,kl,hil->hji', R, V, R)
+        stat = np.einsum('hj,hj->h', d, np.linalg.solve(RVR, d[..., None])[..., 0])
+        pval = stats.chi2.sf(stat, J)
+        for (label, _, _), s, p in zip(items, stat, pval):
+            out[label] = (s, J, p)
+    return out
+
+
+#
+# Wald tests of every hypothesis in every model
+#   models     : dict of name -> fitted model
+#   hypotheses : list of restriction sets, or a dict of
+#                label -> restriction set
+#   returns a long DataFrame with one row per (model, hypothesis),
+#   missing where a hypothesis does not apply to a model
+@timed('wald_batch')
+def wald_batch(models, hypotheses):
+    if not isinstance(hypotheses, dict):
+        hypotheses = {_label(h): h for h in hypotheses}
+    rows = []
+    for mname, res in models.items():
+        names, b, V = model_moments(res)
+        tests = _model_tests(names, b, V, hypotheses)
+        for label in hypotheses:
+            stat, df, pval = tests.get(label, (np.nan, np.nan, np.nan))
+            rows.append((mname, label, stat, df, pval))
+    return pd.DataFrame(rows, columns=['model', 'hypothesis', 'stat', 'df', 'pval'])
@@ -0,0 +1,199 @@
+# ---------------------------------------------------------
+#    wild_boot.py
+#
+#    Wild cluster restricted (WCR) bootstrap for Wald tests
+#    of linear restrictions R b = q, e.g.
+#       ['yd_1991=0', 'yd_1992=0', ...]
+#       ['lnD + lnL + lnF = 1']
+#       ['lnD_b=0', 'lnL_b=0', 'lnF_b=0']
+#
+#    The model is estimated under the null, and a bootstrap
+#    sample is y* = X b_r + w_g u_r with one weight w_g per
+#    cluster. Everything that depends on the data is computed
+#    once:
+#       A   = (X'X)^-1
+#       S_g = X_g'u_r,g      restricted scores
+#       H_g = X_g'X_g        cluster blocks
+#    For a replicate with weights w
+#       X'u*       = S'w
+#       b* - b_r   = A S'w
+#       X_g'e*_g   = w_g S_g - H_g A S'w
+#    so a replicate costs a few small matrix-vector products,
+#    and a batch of replicates is a handful of einsum calls.
+#
+
+#
+import numpy as np
+from scipy import stats
+
+from panel_transform import PanelIndex
+from cluster_cov import cluster_codes, cluster_scores, cluster_blocks
+from wald_batch import compile_restrictions
+from instrument import timed
+from fit_cache import model_of
+
+
+#
+# six point distribution of Webb (2014)
+WEBB = np.array([-np.sqrt(1.5), -1.0, -np.sqrt(0.5),
+                 np.sqrt(0.5), 1.0, np.sqrt(1.5)])
+
+
+def draw_weights(rng, kind, reps, nclusters):
+    if kind == 'rademacher':
+        return 2.0 * rng.integers(0, 2, size=(reps, nclusters)) - 1.0
+    elif kind == 'webb':
+        return WEBB[rng.integers(0, 6, size=(reps, nclusters))]
+    raise ValueError('unknown weight distribution: {}'.format(kind))
+
+
+#
+# compile restriction strings into R and q (cached)
+def restrictions(names, hypothesis):
+    return compile_restrictions(names, hypothesis)
+
+
+class WildTestResult:
+
+    def __init__(self, stat, df, boot_stats, weights, hypothesis):
+        self.stat = stat
+        self.df = df
+        self.pval = stats.chi2.sf(stat, df)
+        self.boot_stats = boot_stats
+        self.boot_pval = np.mean(boot_stats >= stat)
+        self.reps = len(boot_stats)
+        self.weights = weights
+        self.hypothesis = hypothesis
+
+    def __str__(self):
+        return ('Wild cluster bootstrap Wald test\n'
+                'H0: {}\n'
+                'Statistic: {:.4f}\n'
+                'Asymptotic P-value (chi2({})): {:.4f}\n'
+                'Bootstrap P-value ({} reps, {} weights): {:.4f}'
+                .format(', '.join(self.hypothesis), self.stat, self.df,
+                        self.pval, self.reps, self.weights, self.boot_pval))
+
+    def __repr__(self):
+        return self.__str__()
+
+
+#
+# WCR bootstrap on arrays
+#   X, y   : (n x K) design and (n,) dependent variable
+#   groups : cluster labels (n,)
+#   R, q   : restrictions R b = q
+#   scale  : small sample factor of the cluster covariance, it
+#            changes the statistic but not the bootstrap p-value
+def wild_cluster_wald(X, y, groups, R, q, reps=9999, weights='rademacher',
+                      seed=None, chunk=None, scale=1.0, hypothesis=()):
+    X = np.asarray(X, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64).reshape(-1)
+    R = np.atleast_2d(np.asarray(R, dtype=np.float64))
+    q = np.asarray(q, dtype=np.float64).reshape(-1)
+    codes, G = cluster_codes(groups)
+    J, K = R.shape
+
+    #
+    # single factorization of X'X
+    A = np.linalg.inv(X.T @ X)
+    b = A @ (X.T @ y)
+    C = R @ A
+    b_r = b - C.T @ np.linalg.solve(C @ R.T, R @ b - q)
+    u_r = y - X @ b_r
+
+    #
+    # per cluster quantities
+    H = cluster_blocks(X, codes, G)
+    S = cluster_scores(X * u_r[:, None], codes, G)
+    CS = S @ C.T
+    P = np.einsum('jk,gkl->gjl', C, H)
+
+    #
+    # statistic for the original sample
+    u = y - X @ b
+    z0 = cluster_scores(X * u[:, None], codes, G) @ C.T
+    num0 = R @ b - q
+    stat = float(num0 @ np.linalg.solve(scale * (z0.T @ z0), num0))
+
+    #
+    # bootstrap replicates in batches
+    rng = np.random.default_rng(seed)
+    if chunk is None:
+        chunk = max(1, 2 ** 22 // (G * max(J, K)))
+    boot = np.empty(reps)
+    for start in range(0, reps, chunk):
+        n = min(chunk, reps - start)
+        w = draw_weights(rng, weights, n, G)
+        t = w @ S
+        d = t @ A
+        num = t @ C.T
+        z = w[:, :, None] * CS[None] - np.einsum('gjl,bl->bgj', P, d)
+        V = scale * np.einsum('bgj,bgi->bji', z, z)
+        boot[start:start + n] = np.einsum(
+            'bj,bj->b', num, np.linalg.solve(V, num[..., None])[..., 0])
+    return WildTestResult(stat, J, boot, weights, list(hypothesis))
+
+
+#
+# design, dependent variable and clusters of a fitted model
+#   linearmodels: PooledOLS, PanelOLS (entity effects) and
+#   RandomEffects, clustered by entity unless groups is given
+#   statsmodels: OLS, groups must be given
+#   the scale matches the default clustered covariance of each
+#   package, n/(n-K) in linearmodels and G/(G-1)(n-1)/(n-K) in
+#   statsmodels
+def model_arrays(res, groups=None):
+    model = model_of(res)
+    if hasattr(model, 'dependent'):
+        y = model.dependent.values2d[:, 0]
+        X = model.exog.values2d
+        entity = np.asarray(model.dependent.entity_ids).reshape(-1)
+        kind = type(model).__name__
+        if kind == 'RandomEffects':
+            #
+            # quasi-demean with the estimated theta, entity_ids
+            # are positions in res.theta
+            index = PanelIndex(entity)
+            theta = res.theta['theta'].to_numpy()[index.labels]
+            y = index.quasi_demean(y, theta)
+            X = index.quasi_demean(X, theta)
+        elif kind == 'PanelOLS':
+            if model.time_effects or model.other_effects:
+                raise NotImplementedError('only entity effects are supported')
+            if model.entity_effects:
+                index = PanelIndex(entity)
+                if model.has_constant:
+                    y = index.demean(y) + y.mean()
+                    X = index.demean(X) + X.mean(axis=0)
+                else:
+                    y = index.demean(y)
+                    X = index.demean(X)
+        elif kind != 'PooledOLS':
+            raise NotImplementedError('{} is not supported'.format(kind))
+        if groups is None:
+            groups = entity
+        scale = len(y) / (len(y) - X.shape[1])
+    else:
+        y = np.asarray(model.endog)
+        X = np.asarray(model.exog)
+        if groups is None:
+            raise ValueError('groups are required for statsmodels results')
+        n, k = X.shape
+        G = cluster_codes(groups)[1]
+        scale = G / (G - 1) * (n - 1) / (n - k)
+    return X, y, groups, scale
+
+
+#
+# WCR bootstrap for a fitted model and restriction strings,
+# the same strings that are passed to res.wald_test(formula=...)
+@timed('wild_bootstrap')
+def wild_wald_test(res, hypothesis, reps=9999, weights='rademacher',
+                   seed=None, groups=None):
+    if isinstance(hypothesis, str):
+        hypothesis = [hypothesis]
+    X, y, groups, scale = model_arrays(res, groups)
+    R, q = restrictions(res.params.index, hypothesis)
+    return wild_cluster_wald(X, y, groups, R, q, reps=reps, weights=weights,
+                             seed=seed, scale=scale, hypothesis=hypothesis)
@@ -2,9 +2,14 @@
 # coding: utf-8
 #
 
-import pandas as pd
-import wooldridge as woo
-mroz = woo.dataWoo('mroz')
+from crosstab import Crosstab
+from lab_data import load_data
+mroz = load_data('woo:mroz')
+
+#
+# inlf and educ are coded once, every table below is
+# computed from their counts (same tables as pd.crosstab)
+tabs = Crosstab(mroz)
 
 #
 # basic table of value
@@ -12,25 +17,25 @@ print(mroz['inlf'].value_counts())
 
 #
 # a one way table
-owt = pd.crosstab(mroz['inlf'],columns='count')
+owt = tabs.table('inlf')
 print(owt)
 
 #
 # a one way table
-print(pd.crosstab(mroz['inlf'],columns='count',margins=True))
+print(tabs.table('inlf', margins=True))
 
 #
 # one way table with frequencies
-print(pd.crosstab(mroz['inlf'],columns='count',normalize='all'))
+print(tabs.table('inlf', normalize='all'))
 
 #
 # one way table with frequencies
-print(pd.crosstab(mroz['educ'],columns='count',normalize='all'))
+print(tabs.table('educ', normalize='all'))
 
 #
 # a two way table
-print(pd.crosstab(mroz['educ'],mroz['inlf'],margins=True))
+print(tabs.table('educ', 'inlf', margins=True))
 
 #
 # a two way table with frequencies
-print(pd.crosstab(mroz['educ'],mroz['inlf'],normalize='all',margins=True))
+print(tabs.table('educ', 'inlf', normalize='all', margins=True))